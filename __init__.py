@@ -0,0 +1,4 @@
+
+# Django 1.7+ calls SearcherConfig.ready() at startup, older versions start
+# the ContentDB warmup when the URLs are first loaded (see urls.py)
+default_app_config = 'omeroweb.omero_searcher.apps.SearcherConfig'
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Inverted file (IVF) index for approximate searches of large ContentDBs
+
+The normalised features of a scale are partitioned by k-means clustering.
+The index holds the cluster centroids and the rows belonging to each cluster,
+sorted by cluster. A search only scores rows in the nprobe clusters with
+centroids nearest to each reference, so increasing nprobe increases recall
+at the cost of latency.
+"""
+
+import logging
+import math
+
+import numpy
+
+logger = logging.getLogger('searcher')
+
+# Number of k-means iterations used to train the centroids
+KMEANS_ITERATIONS = 10
+
+# Maximum number of rows per partition used to train the centroids
+TRAINING_ROWS_PER_PARTITION = 64
+
+# Number of rows assigned to partitions at a time
+CHUNK_ROWS = 16384
+
+
+def numPartitions(rows):
+    """
+    The default number of partitions for a scale with this many rows
+    """
+    return max(1, int(round(4 * math.sqrt(rows))))
+
+
+def nearestCentroids(x, centroids, cnorms, n=1):
+    """
+    Find the n nearest centroids to each row of x
+    @return an array of centroid indices with shape (rows, n)
+    """
+    d2 = numpy.dot(x, centroids.T)
+    d2 *= -2
+    d2 += cnorms
+    if n == 1:
+        return d2.argmin(axis=1)[:, numpy.newaxis]
+    if n >= len(centroids):
+        return numpy.tile(numpy.arange(len(centroids)), (len(x), 1))
+    return numpy.argpartition(d2, n - 1, axis=1)[:, :n]
+
+
+def kmeans(x, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Cluster the rows of x into k partitions using Lloyd's algorithm
+    @return the centroids as a (k x features) float64 array
+    """
+    rng = numpy.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for i in xrange(iterations):
+        labels = nearestCentroids(
+            x, centroids, numpy.square(centroids).sum(axis=1))[:, 0]
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, numpy.newaxis]
+        # Move empty partitions to random rows
+        empty = numpy.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty))]
+    return centroids
+
+
+class IvfIndex(object):
+    """
+    Partitions of the rows of a ContentDB scale
+    The rows in partition i are rows[offsets[i]:offsets[i + 1]]
+    """
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = centroids
+        self.cnorms = numpy.square(
+            centroids.astype(numpy.float64)).sum(axis=1)
+        self.offsets = offsets
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, zfeats, nlist=None, seed=0):
+        """
+        Partition the rows of a normalised feature matrix
+        """
+        n = len(zfeats)
+        if nlist is None:
+            nlist = numPartitions(n)
+        nlist = min(nlist, n)
+
+        rng = numpy.random.RandomState(seed)
+        ntrain = min(n, nlist * TRAINING_ROWS_PER_PARTITION)
+        sample = numpy.sort(rng.choice(n, ntrain, replace=False))
+        centroids = kmeans(
+            numpy.asarray(zfeats[sample], dtype=numpy.float64), nlist,
+            seed=seed)
+        cnorms = numpy.square(centroids).sum(axis=1)
+
+        labels = numpy.empty(n, dtype=numpy.int64)
+        for start in xrange(0, n, CHUNK_ROWS):
+            x = numpy.asarray(zfeats[start:start + CHUNK_ROWS],
+                              dtype=numpy.float64)
+            labels[start:start + CHUNK_ROWS] = nearestCentroids(
+                x, centroids, cnorms)[:, 0]
+
+        rows = numpy.argsort(labels, kind='mergesort')
+        offsets = numpy.zeros(nlist + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(labels, minlength=nlist),
+                     out=offsets[1:])
+        logger.debug('Built IVF index with %d partitions for %d rows',
+                     nlist, n)
+        return cls(centroids.astype(numpy.float32), offsets, rows)
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as f:
+            return cls(f['centroids'], f['offsets'], f['rows'])
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            numpy.savez(f, centroids=self.centroids, offsets=self.offsets,
+                        rows=self.rows)
+
+    def probe(self, queries, nprobe):
+        """
+        Find the rows in the nprobe partitions nearest to each query
+        @param queries a (queries x features) array of normalised features
+        @return a sorted array of row offsets
+        """
+        nearest = numpy.unique(nearestCentroids(
+                numpy.asarray(queries, dtype=numpy.float64),
+                self.centroids.astype(numpy.float64), self.cnorms, nprobe))
+        if len(nearest) == len(self):
+            return numpy.sort(self.rows)
+        return numpy.sort(numpy.concatenate(
+                [self.rows[self.offsets[p]:self.offsets[p + 1]]
+                 for p in nearest]))
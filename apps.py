@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+from django.apps import AppConfig
+
+
+class SearcherConfig(AppConfig):
+    name = 'omeroweb.omero_searcher'
+    label = 'omero_searcher'
+    verbose_name = 'OMERO.searcher'
+
+    def ready(self):
+        # Starts the ContentDB warmup if enabled
+        from . import warmup
+        warmup.start()
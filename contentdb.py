@@ -0,0 +1,1410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Access to the ContentDB for the OMERO.searcher web-app
+
+Loading a ContentDB means unpickling the whole file, which is by far the most
+expensive part of a search, so ContentDBs are kept in a process-wide cache.
+Entries are revalidated against the name, modification time and size of the
+ContentDB file each time they are requested, and are only reloaded if the
+file has changed.
+
+The pickled ContentDB is a dictionary keyed by scale, each value being a list
+of rows:
+    0:INDEX 1:server 2:username 3-5:URLs
+    6:iid 7:pixels 8:channel 9:zslice 10:timepoint 11...:features
+Cached ContentDBs are converted into a columnar form, with one contiguous
+float32 feature matrix and compact integer columns per scale.
+
+The columnar form is also saved next to the pickled ContentDB as a set of
+.npy files and a JSON metadata sidecar recording which pickled ContentDB it
+was generated from. This columnar store is memory-mapped read-only, so all
+OMERO.web worker processes share the same page-cache pages and don't need to
+unpickle anything. If the store is missing or out of date the first process
+to load the pickled ContentDB rewrites it.
+
+Ranking uses z-score normalised features. The per-feature statistics for each
+scale are saved in a second sidecar, and the columnar store also includes the
+pre-normalised feature matrix so that searches don't need to recalculate
+them. The saved statistics record the version of the pickled ContentDB they
+describe, and compacting the journal merges the new rows into them instead
+of rescanning the whole ContentDB.
+
+When the columnar store is written by a script large scales are also given
+an approximate nearest-neighbour index, see annindex, and a reduced
+dimension projection of the features, see projection.
+
+Rows in the ContentDB journal (see journal) are overlaid on the ContentDB
+when loading. The journal signature is part of the version, so cached
+ContentDBs are updated when rows are appended to the journal, but the
+columnar store only holds the pickled ContentDB. The journal rows are kept in
+memory after the memory-mapped rows of each scale, normalised using the
+statistics of the stored rows, and stored rows replaced by a journal row are
+excluded from searches. The journal is compacted into the pickled ContentDB
+and the columnar store rewritten by the scripts which append to it.
+
+Each generation of the columnar store has a lock file. Processes using a
+generation hold a shared lock on it, and old generations are only deleted
+once no process holds the lock, so a store can be replaced whilst it's being
+searched.
+"""
+
+import cPickle
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+from collections import defaultdict, OrderedDict
+
+import numpy
+
+import pyslid
+from omero_searcher_config import omero_contentdb_path
+from omero_searcher_config import contentdb_cache_max_bytes
+from omero_searcher_config import contentdb_columnar_store
+from omero_searcher_config import ann_index_min_rows
+from omero_searcher_config import pca_dims
+from omero_searcher_config import pca_min_rows
+from omero_searcher_config import contentdb_quantization
+from omero_searcher_config import quantization_min_rows
+from omero_searcher_config import pq_subspaces
+pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
+
+from annindex import IvfIndex
+from projection import PcaProjection
+import quantize
+import journal
+
+logger = logging.getLogger('searcher')
+
+# Number of rows copied at a time by iterNpz
+EXPORT_CHUNK_ROWS = 65536
+
+# Columns of each scale saved by iterNpz
+EXPORT_COLUMNS = ('feats', 'iid', 'px', 'c', 'z', 't', 'owner')
+
+# Number of bytes of each exported array sent at a time by iterNpz
+EXPORT_BLOCK_BYTES = 1 << 20
+
+
+def getVersion(conn, ftset, did=None):
+    """
+    Get a cheap fingerprint of the current ContentDB file and journal for a
+    feature set
+    Returns a tuple (filename, mtime, size, journal-signature), or None if
+    there is no ContentDB
+    """
+    dbname, dbname_next, result = pyslid.database.direct.getRecentName(
+        conn, ftset, did)
+    if not dbname:
+        return None
+    return fileVersion(dbname, journal.journalDir(conn, ftset, did))
+
+
+def fileVersion(dbname, jdir):
+    """
+    Get the version of a ContentDB file and its journal directory, see
+    getVersion
+    """
+    try:
+        st = os.stat(os.path.join(omero_contentdb_path, dbname))
+    except OSError:
+        return None
+    return (dbname, st.st_mtime, st.st_size, journal.signature(jdir))
+
+
+def localContentDBs(ftset):
+    """
+    Find the most recent ContentDB file of each group for a feature set, for
+    use without an OMERO session. The current ContentDB is recorded in
+    OMERO, but is normally the file with the highest count.
+    @return a dictionary of group-id: file name
+    """
+    pattern = re.compile(r'^(\d+)_all_%s_content_db_(\d+)\.pkl$' %
+                         re.escape(ftset))
+    latest = {}
+    for name in os.listdir(omero_contentdb_path):
+        m = pattern.match(name)
+        if m:
+            gid, count = long(m.group(1)), long(m.group(2))
+            if gid not in latest or count > latest[gid][0]:
+                latest[gid] = (count, name)
+    return dict((gid, name) for gid, (count, name) in latest.iteritems())
+
+
+def retrieveFile(dbname):
+    """
+    Read a pickled ContentDB file, returns the same as
+    pyslid.database.direct.retrieve
+    """
+    try:
+        with open(os.path.join(omero_contentdb_path, dbname), 'rb') as f:
+            return cPickle.load(f), 'Good'
+    except IOError as e:
+        return [], 'Failed to read ContentDB %s: %s' % (dbname, e)
+
+
+def parseOwner(username):
+    """
+    Owners are recorded as a user ID, but older ContentDBs may contain user
+    names. These are recorded as -1.
+    """
+    try:
+        return int(username)
+    except ValueError:
+        return -1
+
+
+class FeatureStats(object):
+    """
+    Per-feature count, mean, sum of squared deviations, minimum and maximum,
+    which can be updated incrementally using the parallel algorithm of Chan
+    et al. for combining means and variances.
+    """
+
+    def __init__(self, count, mean, m2, fmin, fmax):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.fmin = fmin
+        self.fmax = fmax
+
+    @classmethod
+    def fromFeats(cls, feats):
+        feats = numpy.asarray(feats, dtype=numpy.float64)
+        if feats.ndim == 1:
+            feats = feats.reshape((1, -1))
+        mean = feats.mean(axis=0)
+        m2 = numpy.square(feats - mean).sum(axis=0)
+        return cls(len(feats), mean, m2, feats.min(axis=0), feats.max(axis=0))
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d['count'], numpy.array(d['mean']), numpy.array(d['m2']),
+                   numpy.array(d['min']), numpy.array(d['max']))
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'min': self.fmin.tolist(),
+            'max': self.fmax.tolist(),
+            }
+
+    def merge(self, other):
+        """
+        Return the statistics of the union of both sets of rows
+        """
+        if self.count == 0:
+            return other
+        if other.count == 0:
+            return self
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / n
+        m2 = self.m2 + other.m2 + numpy.square(delta) * (
+            float(self.count) * other.count / n)
+        return FeatureStats(n, mean, m2, numpy.minimum(self.fmin, other.fmin),
+                            numpy.maximum(self.fmax, other.fmax))
+
+    @property
+    def std(self):
+        """
+        The population standard deviation plus a small offset to avoid
+        division by zero, as used by ricerca
+        """
+        return numpy.sqrt(self.m2 / self.count) + 1e-10
+
+
+class RowIndex(object):
+    """
+    Sorted index of the superids of a ContentDB scale
+    Each (iid, px, c, z, t) is packed into a single int64 key using a mixed
+    radix based on the maximum of each column. keys is sorted and order
+    contains the row offset of each key, duplicates are in row order.
+    """
+
+    def __init__(self, radices, keys, order):
+        self.radices = radices
+        self.keys = keys
+        self.order = order
+
+    @classmethod
+    def build(cls, cols):
+        """
+        Index the superid columns (iid, px, c, z, t) of a ContentDB scale
+        Returns None if the keys won't fit in an int64
+        """
+        radices = [int(col.max()) + 1 if len(col) else 1 for col in cols]
+        if reduce(lambda a, b: a * b, radices) >= 2 ** 63 or (
+            len(cols[0]) and min(int(col.min()) for col in cols) < 0):
+            return None
+        index = cls(radices, None, None)
+        keys = index.pack(cols)
+        index.order = numpy.argsort(keys, kind='mergesort')
+        index.keys = keys[index.order]
+        return index
+
+    def pack(self, cols):
+        keys = numpy.zeros(len(cols[0]), dtype=numpy.int64)
+        for radix, col in zip(self.radices, cols):
+            keys *= radix
+            keys += col
+        return keys
+
+    def find(self, iid, px, c, z, t):
+        """
+        Find the row offset of a superid, or None if it isn't present
+        If there are duplicates the last is returned
+        """
+        key = 0
+        for radix, v in zip(self.radices, (iid, px, c, z, t)):
+            if v < 0 or v >= radix:
+                return None
+            key = key * radix + v
+        i = numpy.searchsorted(self.keys, key, side='right') - 1
+        if i < 0 or self.keys[i] != key:
+            return None
+        return int(self.order[i])
+
+
+class StackedRows(object):
+    """
+    The rows of one matrix followed by the rows of another, without copying
+    either. Supports the row indexing used by ranking and iterNpz, a row
+    offset, a slice, or an array of row offsets, returning an array.
+    """
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.shape = (len(first) + len(second),) + first.shape[1:]
+        self.dtype = first.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        # The first matrix is memory-mapped and shared between processes
+        return self.second.nbytes
+
+    def __getitem__(self, rows):
+        n0 = len(self.first)
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            if step != 1:
+                return self[numpy.arange(start, stop, step)]
+            if stop <= n0:
+                return numpy.asarray(self.first[start:stop])
+            if start >= n0:
+                return self.second[start - n0:stop - n0]
+            return numpy.concatenate(
+                (self.first[start:], self.second[:stop - n0]))
+        if numpy.isscalar(rows):
+            if rows < n0:
+                return self.first[rows]
+            return self.second[rows - n0]
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        out = numpy.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        first = rows < n0
+        out[first] = self.first[rows[first]]
+        out[~first] = self.second[rows[~first] - n0]
+        return out
+
+
+class ColumnarScale(object):
+    """
+    All rows from one scale of a ContentDB
+    feats is a (rows x features) float32 matrix, the remaining attributes are
+    integer arrays with one element per row
+    After normalize() has been called zfeats is the z-score normalised feats
+    and stats the FeatureStats used to normalise it
+    ivf is an optional IvfIndex of zfeats
+    rowindex is a RowIndex, created on first use if it wasn't loaded
+    bitmaps is set by rowfilter
+    zfeatsPath is the file zfeats is memory-mapped from, if any
+    pca is an optional PcaProjection of zfeats and pfeats the projected rows
+    codec is an optional codec from quantize and codes the encoded zfeats
+    stored is set if journal rows have been overlaid on this scale, see
+    overlaid, and is the scale of the rows before the journal rows. ivf, pca
+    and codec only cover these rows.
+    live is None, or a boolean mask of the rows which haven't been replaced
+    by a journal row
+    """
+
+    def __init__(self, scale, feats, iid, px, c, z, t, owner,
+                 zfeats=None, stats=None, ivf=None, rowindex=None):
+        self.scale = scale
+        self.feats = feats
+        self.iid = iid
+        self.px = px
+        self.c = c
+        self.z = z
+        self.t = t
+        self.owner = owner
+        self.zfeats = zfeats
+        self.stats = stats
+        self.znorms = None
+        self.ivf = ivf
+        self.rowindex = rowindex
+        self.bitmaps = None
+        self.zfeatsPath = None
+        self.pca = None
+        self.pfeats = None
+        self.codec = None
+        self.codes = None
+        self.stored = None
+        self.live = None
+
+    @classmethod
+    def fromRows(cls, scale, rows):
+        n = len(rows)
+        if n:
+            feats = numpy.array([r[11:] for r in rows], dtype=numpy.float32)
+        else:
+            feats = numpy.zeros((0, 0), dtype=numpy.float32)
+        ids = numpy.array([r[6:11] for r in rows], dtype=numpy.int64)
+        ids = ids.reshape((n, 5))
+        owner = numpy.array([parseOwner(r[2]) for r in rows],
+                            dtype=numpy.int64)
+        return cls(scale, feats, ids[:, 0].copy(), ids[:, 1].copy(),
+                   ids[:, 2].astype(numpy.int32),
+                   ids[:, 3].astype(numpy.int32),
+                   ids[:, 4].astype(numpy.int32), owner)
+
+    def __len__(self):
+        return len(self.iid)
+
+    @property
+    def storedRows(self):
+        """
+        The number of rows covered by ivf, pca and codec
+        """
+        if self.stored is None:
+            return len(self)
+        return len(self.stored)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (
+                self.feats, self.zfeats, self.iid, self.px, self.c, self.z,
+                self.t, self.owner) if a is not None)
+
+    def normalize(self, stats=None):
+        """
+        Calculate the z-score normalised features
+        @param stats the FeatureStats for this scale, if None or not
+        consistent with the number of rows they will be recalculated
+        """
+        if stats is None or stats.count != len(self) or (
+            len(stats.mean) != self.feats.shape[1]):
+            stats = FeatureStats.fromFeats(self.feats)
+        self.stats = stats
+        self.zfeats = ((self.feats - stats.mean) / stats.std).astype(
+            numpy.float32)
+        self.znorms = None
+        self.zfeatsPath = None
+        self.pca = None
+        self.pfeats = None
+        self.codec = None
+        self.codes = None
+
+    def rowNorms(self):
+        """
+        The squared Euclidean norm of every normalised row, calculated on
+        first use
+        """
+        if self.znorms is None:
+            start = 0
+            znorms = numpy.empty(len(self), dtype=numpy.float64)
+            if self.stored is not None:
+                # The stored scale keeps its own norms between journal updates
+                start = len(self.stored)
+                znorms[:start] = self.stored.rowNorms()
+            for start in xrange(start, len(self), 65536):
+                z = numpy.asarray(self.zfeats[start:start + 65536],
+                                  dtype=numpy.float64)
+                znorms[start:start + 65536] = numpy.square(z).sum(axis=1)
+            self.znorms = znorms
+        return self.znorms
+
+    def superid(self, row):
+        return '%d.%d.%d.%d.%d' % (self.iid[row], self.px[row], self.c[row],
+                                   self.z[row], self.t[row])
+
+    def superids(self, rows):
+        return [self.superid(r) for r in rows]
+
+    def merged(self, other):
+        """
+        Return a new ColumnarScale with the rows of other added, replacing
+        any rows with the same iid/px/c/z/t. Duplicates within either scale
+        are also removed, keeping the last.
+        """
+        if len(self) and len(other) and (
+            self.feats.shape[1] != other.feats.shape[1]):
+            raise ValueError('Number of features does not match: %d %d' % (
+                    self.feats.shape[1], other.feats.shape[1]))
+        cols = [numpy.concatenate((getattr(self, k), getattr(other, k)))
+                for k in ('iid', 'px', 'c', 'z', 't')]
+        n = len(cols[0])
+        order = numpy.lexsort([numpy.arange(n)] + cols[::-1])
+        same = numpy.ones(max(n - 1, 0), dtype=bool)
+        for col in cols:
+            col = col[order]
+            same &= col[1:] == col[:-1]
+        last = numpy.ones(n, dtype=bool)
+        last[:-1] = ~same
+        keep = numpy.sort(order[last])
+
+        n0 = len(self)
+        feats = []
+        if n0:
+            feats.append(self.feats[keep[keep < n0]])
+        if len(other):
+            feats.append(other.feats[keep[keep >= n0] - n0])
+        feats = numpy.concatenate(feats) if feats else self.feats
+        return ColumnarScale(
+            self.scale, feats, cols[0][keep], cols[1][keep], cols[2][keep],
+            cols[3][keep], cols[4][keep], numpy.concatenate(
+                (self.owner, other.owner))[keep])
+
+    def overlaid(self, other):
+        """
+        Return a new ColumnarScale with the rows of other after the rows of
+        this scale, which must be normalised. Unlike merged this doesn't copy
+        the features of this scale, other is normalised using the statistics
+        of this scale, and rows of this scale with the same iid/px/c/z/t as a
+        row of other are excluded using live.
+        """
+        if self.feats.shape[1] != other.feats.shape[1]:
+            raise ValueError('Number of features does not match: %d %d' % (
+                    self.feats.shape[1], other.feats.shape[1]))
+        # Remove duplicates within other
+        other = ColumnarScale.fromRows(self.scale, []).merged(other)
+        zfeats = ((other.feats - self.stats.mean) / self.stats.std).astype(
+            numpy.float32)
+
+        n0 = len(self)
+        live = numpy.ones(n0 + len(other), dtype=bool)
+        for r in xrange(len(other)):
+            row = self.findRow(other.iid[r], other.px[r], other.c[r],
+                               other.z[r], other.t[r])
+            if row is not None:
+                live[row] = False
+
+        s = ColumnarScale(
+            self.scale, StackedRows(self.feats, other.feats),
+            *[numpy.concatenate((getattr(self, k), getattr(other, k)))
+              for k in ('iid', 'px', 'c', 'z', 't', 'owner')],
+            zfeats=StackedRows(self.zfeats, zfeats), stats=self.stats,
+            ivf=self.ivf)
+        s.stored = self
+        s.live = None if live.all() else live
+        s.zfeatsPath = self.zfeatsPath
+        s.pca = self.pca
+        s.pfeats = self.pfeats
+        s.codec = self.codec
+        s.codes = self.codes
+        return s
+
+    def getRowIndex(self):
+        """
+        Get the RowIndex, or None if the superids can't be indexed
+        """
+        if self.rowindex is None:
+            self.rowindex = RowIndex.build(
+                (self.iid, self.px, self.c, self.z, self.t)) or False
+        return self.rowindex or None
+
+    def findRow(self, iid, px, c, z, t):
+        """
+        Find the row offset of a superid, or None if it isn't present
+        If there are duplicates the last (most recent) is returned
+        """
+        if self.stored is not None:
+            n0 = len(self.stored)
+            match = numpy.flatnonzero(
+                (self.iid[n0:] == iid) & (self.px[n0:] == px) &
+                (self.c[n0:] == c) & (self.z[n0:] == z) & (self.t[n0:] == t))
+            if len(match):
+                return n0 + match[-1]
+            return self.stored.findRow(iid, px, c, z, t)
+        index = self.getRowIndex()
+        if index:
+            return index.find(iid, px, c, z, t)
+        match = numpy.flatnonzero(
+            (self.iid == iid) & (self.px == px) & (self.c == c) &
+            (self.z == z) & (self.t == t))
+        if len(match) == 0:
+            return None
+        return match[-1]
+
+
+class ColumnarContentDB(object):
+    """
+    A ContentDB converted into a ColumnarScale for each scale
+    """
+
+    def __init__(self, info, scales, mapped=False):
+        self.info = info
+        self.scales = scales
+        # True if the arrays are memory-mapped from the columnar store
+        self.mapped = mapped
+        # The version of the pickled ContentDB, if known, see getVersion()
+        self.version = None
+        # The GenerationLock of the columnar store, if mapped
+        self.storeLock = None
+
+    @classmethod
+    def fromRows(cls, cdb):
+        scales = dict((k, ColumnarScale.fromRows(k, rows))
+                      for k, rows in cdb.iteritems() if k != 'info')
+        return cls(cdb.get('info'), scales)
+
+    @property
+    def nbytes(self):
+        return sum(s.nbytes for s in self.scales.itervalues())
+
+    def normalize(self, stats=None):
+        """
+        Normalise every non-empty scale
+        @param stats optional dictionary of scale: FeatureStats
+        """
+        stats = stats or {}
+        for scale, s in self.scales.iteritems():
+            if len(s):
+                s.normalize(stats.get(scale))
+
+    def merged(self, cdb):
+        """
+        Return a new ColumnarContentDB with rows added from a dictionary of
+        scale: ContentDB rows, see ColumnarScale.merged
+        """
+        scales = dict(self.scales)
+        for scale, rows in cdb.iteritems():
+            if scale == 'info':
+                continue
+            new = ColumnarScale.fromRows(scale, rows)
+            if scale in scales:
+                new = scales[scale].merged(new)
+            scales[scale] = new
+        return ColumnarContentDB(self.info, scales)
+
+    def overlaid(self, cdb):
+        """
+        Return a new ColumnarContentDB with rows from a dictionary of scale:
+        ContentDB rows overlaid on this normalised ContentDB, see
+        ColumnarScale.overlaid. Scales which are empty or new are merged.
+        """
+        scales = dict(self.scales)
+        for scale, rows in cdb.iteritems():
+            if scale == 'info':
+                continue
+            new = ColumnarScale.fromRows(scale, rows)
+            old = scales.get(scale)
+            if old is not None and len(old):
+                new = old.overlaid(new)
+            else:
+                new = ColumnarScale.fromRows(scale, []).merged(new)
+                new.normalize()
+            scales[scale] = new
+        db = ColumnarContentDB(self.info, scales, self.mapped)
+        db.storeLock = self.storeLock
+        return db
+
+    def closestScale(self, scale):
+        """
+        Find the ContentDB scale closest to the requested scale, in the same
+        way as ricerca
+        """
+        keys = sorted(self.scales.keys())
+        dscale = keys[0]
+        for key in keys:
+            if abs(key - scale) < abs(dscale - scale):
+                dscale = key
+        return dscale
+
+
+def storeName(dbname):
+    """
+    The pickled ContentDB filename includes a counter which is incremented on
+    every update, strip it to get a stable name for the columnar store
+    """
+    return dbname.rsplit('_content_db_', 1)[0]
+
+
+def storeMetaPath(dbname):
+    return os.path.join(
+        omero_contentdb_path, storeName(dbname) + '.columnar.json')
+
+
+def generationLockPath(generation):
+    return os.path.join(omero_contentdb_path, generation + '.lock')
+
+
+class GenerationLock(object):
+    """
+    A shared lock on a generation of the columnar store, held by this
+    process until the object is garbage collected. POSIX record locks are
+    used since they aren't inherited by forked processes, such as the shard
+    scoring pool, but they are released when any file descriptor for the
+    lock file is closed by the process, and a process can always lock a file
+    it has already locked. So each process only opens a lock file once, and
+    never probes the lock file of a generation it holds, see removeUnused.
+    """
+
+    _locks = weakref.WeakValueDictionary()
+    _registryLock = threading.Lock()
+
+    def __init__(self, f):
+        self.f = f
+
+    @classmethod
+    def acquire(cls, generation, create=False):
+        """
+        Get a shared lock on a generation, blocking whilst it's being deleted
+        @param create if True create the lock file for a new generation
+        @return a GenerationLock, or None if the generation doesn't exist
+        """
+        path = generationLockPath(generation)
+        with cls._registryLock:
+            lock = cls._locks.get(path)
+            if lock is None:
+                try:
+                    f = open(path, 'a+' if create else 'r')
+                except IOError:
+                    return None
+                fcntl.lockf(f, fcntl.LOCK_SH)
+                try:
+                    current = os.stat(path).st_ino
+                except OSError:
+                    current = None
+                if current != os.fstat(f.fileno()).st_ino:
+                    # Deleted whilst waiting for the lock
+                    f.close()
+                    return None
+                lock = cls(f)
+                cls._locks[path] = lock
+            return lock
+
+    @classmethod
+    def removeUnused(cls, generation, remove):
+        """
+        Call remove() with an exclusive lock on a generation if no process is
+        using it. This is done holding the registry lock, so the generation
+        can't be acquired by this process in the meantime, and the lock file
+        isn't opened if this process holds the generation.
+        @return True if remove was called
+        """
+        path = generationLockPath(generation)
+        with cls._registryLock:
+            if path in cls._locks:
+                return False
+            try:
+                f = open(path, 'r+')
+            except IOError:
+                return False
+            with f:
+                try:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # In use by another process
+                    return False
+                remove()
+                return True
+
+
+def removeUnusedGenerations(dbname, current):
+    """
+    Delete the generations of a columnar store other than current which
+    aren't in use by any process, see GenerationLock. Should be called with
+    the StatsLock held.
+    """
+    pattern = re.compile(r'^(%s\.[0-9a-f]{12})\.lock$' % re.escape(
+            storeName(dbname)))
+    names = os.listdir(omero_contentdb_path)
+    for name in names:
+        m = pattern.match(name)
+        if not m or m.group(1) == current:
+            continue
+        generation = m.group(1)
+
+        def remove():
+            for n in names:
+                if n.startswith(generation + '.') and n != name:
+                    try:
+                        os.remove(os.path.join(omero_contentdb_path, n))
+                    except OSError:
+                        pass
+            os.remove(generationLockPath(generation))
+
+        if GenerationLock.removeUnused(generation, remove):
+            logger.info('Removed columnar ContentDB %s', generation)
+
+
+def readStoreMeta(dbname):
+    try:
+        with open(storeMetaPath(dbname)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def statsPath(dbname):
+    return os.path.join(
+        omero_contentdb_path, storeName(dbname) + '.stats.json')
+
+
+class StatsLock(object):
+    """
+    Exclusive lock on the statistics and columnar store sidecars, since
+    several feature calculation scripts may update them at the same time
+    """
+
+    def __init__(self, dbname):
+        self.path = statsPath(dbname) + '.lock'
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def readStats(version):
+    """
+    Read the saved statistics of a version of the pickled ContentDB, see
+    getVersion
+    @return a dictionary of scale: FeatureStats, empty if the saved
+    statistics are for another version
+    """
+    try:
+        with open(statsPath(version[0])) as f:
+            d = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if tuple(d.get('source', ())) != tuple(version[:3]):
+        return {}
+    return dict((float(k), FeatureStats.fromDict(v))
+                for k, v in d['scales'].iteritems())
+
+
+def writeStats(version, stats):
+    """
+    Save the statistics of a version of the pickled ContentDB
+    @param stats a dictionary of scale: FeatureStats
+    """
+    path = statsPath(version[0])
+    tmppath = '%s.%s.tmp' % (path, uuid.uuid4().hex[:12])
+    with open(tmppath, 'w') as f:
+        json.dump({
+                'source': list(version[:3]),
+                'scales': dict((repr(k), v.toDict())
+                               for k, v in stats.iteritems()),
+                }, f)
+    os.rename(tmppath, path)
+
+
+def updateStats(before, after, feats):
+    """
+    Merge new ContentDB rows into the saved statistics
+    @param before the version of the pickled ContentDB before the rows were
+    added, nothing is done if the saved statistics are for another version
+    @param after the version of the pickled ContentDB including the rows
+    @param feats a dictionary of scale: list of feature rows
+    """
+    with StatsLock(before[0]):
+        stats = readStats(before)
+        if not stats:
+            return
+        for scale, f in feats.iteritems():
+            new = FeatureStats.fromFeats(f)
+            old = stats.get(scale)
+            if old is not None and len(old.mean) == len(new.mean):
+                stats[scale] = old.merge(new)
+            else:
+                stats[scale] = new
+        writeStats(after, stats)
+
+
+def compactJournal(conn, ftset, did=None):
+    """
+    Merge the journal into the pickled ContentDB, see journal.compact, and
+    the new rows into the saved statistics
+    @return answer (True if successful)
+    @return Message
+    """
+    before = getVersion(conn, ftset, did)
+
+    def merged(feats):
+        after = getVersion(conn, ftset, did)
+        if before and after:
+            updateStats(before, after, feats)
+
+    return journal.compact(conn, ftset, did, merged)
+
+
+def writeStore(db, version, index=False):
+    """
+    Save a ColumnarContentDB as the columnar store for a pickled ContentDB
+    @param version the version of the pickled ContentDB, see getVersion(),
+    the journal is not part of the store
+    @param index if True build an IVF index for scales with at least
+    ann_index_min_rows rows, a PCA projection for scales with at least
+    pca_min_rows rows and quantized features for scales with at least
+    quantization_min_rows rows
+    """
+    dbname = version[0]
+    # Files are never overwritten, a new generation is written and the
+    # metadata sidecar atomically replaced, so that processes which have
+    # mapped the old generation are unaffected. Old generations are removed
+    # once they're no longer used.
+    generation = '%s.%s' % (storeName(dbname), uuid.uuid4().hex[:12])
+    # Prevents the new generation being removed before it's used
+    lock = GenerationLock.acquire(generation, create=True)
+    meta = {
+        'generation': generation,
+        'source': list(version[:3]),
+        'info': db.info,
+        'scales': [],
+        }
+
+    # Use the saved statistics if they're consistent with the ContentDB,
+    # otherwise recalculate and save them
+    with StatsLock(dbname):
+        db.normalize(readStats(version))
+        writeStats(version, dict(
+                (scale, s.stats) for scale, s in db.scales.iteritems()
+                if s.stats is not None))
+
+    for n, scale in enumerate(sorted(db.scales.keys())):
+        s = db.scales[scale]
+        sm = {
+            'scale': scale,
+            'rows': len(s),
+            'feats': '%s.%d.feats.npy' % (generation, n),
+            'ids': '%s.%d.ids.npy' % (generation, n),
+            }
+        numpy.save(os.path.join(omero_contentdb_path, sm['feats']),
+                   numpy.ascontiguousarray(s.feats, dtype=numpy.float32))
+        ids = numpy.column_stack((s.iid, s.px, s.c, s.z, s.t, s.owner))
+        numpy.save(os.path.join(omero_contentdb_path, sm['ids']),
+                   ids.astype(numpy.int64).reshape((len(s), 6)))
+        if s.zfeats is not None:
+            sm['zfeats'] = '%s.%d.zfeats.npy' % (generation, n)
+            sm['stats'] = s.stats.toDict()
+            numpy.save(os.path.join(omero_contentdb_path, sm['zfeats']),
+                       s.zfeats)
+            rowindex = s.getRowIndex()
+            if rowindex:
+                sm['rowkeys'] = '%s.%d.rowkeys.npy' % (generation, n)
+                sm['radices'] = rowindex.radices
+                numpy.save(os.path.join(omero_contentdb_path, sm['rowkeys']),
+                           numpy.vstack((rowindex.keys, rowindex.order)))
+            if index and ann_index_min_rows and len(s) >= ann_index_min_rows:
+                sm['ivf'] = '%s.%d.ivf.npz' % (generation, n)
+                IvfIndex.build(s.zfeats).save(
+                    os.path.join(omero_contentdb_path, sm['ivf']))
+            if (index and pca_dims and pca_min_rows and
+                len(s) >= pca_min_rows and pca_dims < s.zfeats.shape[1]):
+                sm['pca'] = '%s.%d.pca.npz' % (generation, n)
+                sm['pfeats'] = '%s.%d.pfeats.npy' % (generation, n)
+                pca = PcaProjection.fit(s.zfeats, pca_dims)
+                pca.save(os.path.join(omero_contentdb_path, sm['pca']))
+                pca.projectAll(s.zfeats, numpy.lib.format.open_memmap(
+                        os.path.join(omero_contentdb_path, sm['pfeats']),
+                        mode='w+', dtype=numpy.float32,
+                        shape=(len(s), pca.dims))).flush()
+            if (index and contentdb_quantization != 'float32' and
+                quantization_min_rows and len(s) >= quantization_min_rows):
+                sm['codec'] = '%s.%d.codec.npz' % (generation, n)
+                sm['codes'] = '%s.%d.codes.npy' % (generation, n)
+                codec = quantize.train(
+                    contentdb_quantization, s.zfeats, pq_subspaces)
+                quantize.save(
+                    codec, os.path.join(omero_contentdb_path, sm['codec']))
+                codec.encodeAll(s.zfeats, numpy.lib.format.open_memmap(
+                        os.path.join(omero_contentdb_path, sm['codes']),
+                        mode='w+', dtype=codec.dtype,
+                        shape=codec.codeShape(s.zfeats))).flush()
+        meta['scales'].append(sm)
+
+    with StatsLock(dbname):
+        old = readStoreMeta(dbname)
+        if not index and old and old['source'] == meta['source']:
+            # Another process has already written this version, possibly
+            # with an index, so keep that one
+            logger.info('Columnar ContentDB for %s already written', version)
+            current = old.get('generation')
+        else:
+            metapath = storeMetaPath(dbname)
+            tmppath = '%s.%s.tmp' % (metapath, generation)
+            with open(tmppath, 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmppath, metapath)
+            logger.info('Wrote columnar ContentDB %s for %s',
+                        generation, version)
+            current = generation
+            if old and 'generation' not in old:
+                # Written before generations were locked
+                removeFiles(old)
+        del lock
+        removeUnusedGenerations(dbname, current)
+
+
+def removeFiles(meta):
+    """
+    Delete the files of the columnar store described by meta
+    """
+    for sm in meta['scales']:
+        for k in ('feats', 'ids', 'zfeats', 'ivf', 'rowkeys', 'pca',
+                  'pfeats', 'codec', 'codes'):
+            if k not in sm:
+                continue
+            try:
+                os.remove(os.path.join(omero_contentdb_path, sm[k]))
+            except OSError:
+                pass
+
+
+def readStore(version):
+    """
+    Memory-map the columnar store for a pickled ContentDB
+    Returns a ColumnarContentDB without the journal rows, or None if the
+    store is missing or was not generated from this version of the pickled
+    ContentDB
+    """
+    meta = readStoreMeta(version[0])
+    if not meta or tuple(meta['source'][:3]) != tuple(version[:3]):
+        return None
+    lock = None
+    if 'generation' in meta:
+        # Keeps the files whilst the returned ContentDB is in use
+        lock = GenerationLock.acquire(meta['generation'])
+        if lock is None:
+            logger.warn('Columnar ContentDB %s has been removed', version)
+            return None
+
+    scales = {}
+    try:
+        for sm in meta['scales']:
+            feats = numpy.load(
+                os.path.join(omero_contentdb_path, sm['feats']), mmap_mode='r')
+            ids = numpy.load(
+                os.path.join(omero_contentdb_path, sm['ids']), mmap_mode='r')
+            zfeatsPath = None
+            if 'zfeats' in sm:
+                zfeatsPath = os.path.join(omero_contentdb_path, sm['zfeats'])
+                zfeats = numpy.load(zfeatsPath, mmap_mode='r')
+                stats = FeatureStats.fromDict(sm['stats'])
+            elif sm['rows']:
+                # Written before normalised features were saved
+                return None
+            else:
+                zfeats = None
+                stats = None
+            if 'ivf' in sm:
+                ivf = IvfIndex.load(
+                    os.path.join(omero_contentdb_path, sm['ivf']))
+            else:
+                ivf = None
+            if 'rowkeys' in sm:
+                rowkeys = numpy.load(
+                    os.path.join(omero_contentdb_path, sm['rowkeys']),
+                    mmap_mode='r')
+                rowindex = RowIndex(sm['radices'], rowkeys[0], rowkeys[1])
+            else:
+                rowindex = None
+            scale = sm['scale']
+            scales[scale] = ColumnarScale(
+                scale, feats, ids[:, 0], ids[:, 1], ids[:, 2], ids[:, 3],
+                ids[:, 4], ids[:, 5], zfeats, stats, ivf, rowindex)
+            scales[scale].zfeatsPath = zfeatsPath
+            if 'pca' in sm:
+                scales[scale].pca = PcaProjection.load(
+                    os.path.join(omero_contentdb_path, sm['pca']))
+                scales[scale].pfeats = numpy.load(
+                    os.path.join(omero_contentdb_path, sm['pfeats']),
+                    mmap_mode='r')
+            if 'codec' in sm:
+                scales[scale].codec = quantize.load(
+                    os.path.join(omero_contentdb_path, sm['codec']))
+                scales[scale].codes = numpy.load(
+                    os.path.join(omero_contentdb_path, sm['codes']),
+                    mmap_mode='r')
+    except (IOError, ValueError) as e:
+        # Most likely replaced by a newer generation whilst reading
+        logger.warn('Failed to read columnar ContentDB %s: %s', version, e)
+        return None
+
+    db = ColumnarContentDB(meta['info'], scales, mapped=True)
+    db.storeLock = lock
+    return db
+
+
+def rebuildStore(conn, ftset, did=None):
+    """
+    Write the columnar store and approximate search indices for the current
+    pickled ContentDB, for use by scripts which update the ContentDB. Rows
+    in the journal are not included, compact it first.
+    @return answer (True if successful)
+    @return Message
+    """
+    version = getVersion(conn, ftset, did)
+    if version is None:
+        return False, 'No ContentDB found for %s' % ftset
+    cdb, message = pyslid.database.direct.retrieve(conn, ftset, did)
+    if message != 'Good':
+        return False, message
+    if getVersion(conn, ftset, did) != version:
+        return False, 'ContentDB for %s changed whilst reading' % ftset
+    db = ColumnarContentDB.fromRows(cdb)
+    del cdb
+    writeStore(db, version, index=True)
+    return True, 'Good'
+
+
+def saveRows(path, a, rows=None):
+    """
+    Save rows of an array as a .npy file, copying EXPORT_CHUNK_ROWS rows at
+    a time so that memory use doesn't depend on the size of the array
+    @param rows an array of row offsets, or None for all rows
+    """
+    n = len(a) if rows is None else len(rows)
+    if n == 0:
+        numpy.save(path, a[:0])
+        return
+    out = numpy.lib.format.open_memmap(
+        path, mode='w+', dtype=a.dtype, shape=(n,) + a.shape[1:])
+    for start in xrange(0, n, EXPORT_CHUNK_ROWS):
+        if rows is None:
+            chunk = a[start:start + EXPORT_CHUNK_ROWS]
+        else:
+            chunk = a[rows[start:start + EXPORT_CHUNK_ROWS]]
+        out[start:start + EXPORT_CHUNK_ROWS] = chunk
+    out.flush()
+    del out
+
+
+class StreamWriter(object):
+    """
+    A write only file object which keeps what is written until it's taken
+    with pop(), so that a zip archive can be generated a piece at a time.
+    Only tell() is supported, not seek().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.pos += len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zipMember(zf, out, path, name):
+    """
+    Add a file to a zip archive written to a StreamWriter, generating the
+    archive data. The CRC is calculated before the header is written so the
+    archive doesn't have to be seekable.
+    """
+    def blocks():
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(EXPORT_BLOCK_BYTES), ''):
+                yield block
+
+    zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.external_attr = 0600 << 16
+    zinfo.file_size = zinfo.compress_size = os.path.getsize(path)
+    crc = 0
+    for block in blocks():
+        crc = zipfile.crc32(block, crc)
+    zinfo.CRC = crc & 0xffffffff
+    zinfo.header_offset = out.tell()
+    out.write(zinfo.FileHeader())
+    yield out.pop()
+    for block in blocks():
+        out.write(block)
+        yield out.pop()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[name] = zinfo
+
+
+def iterNpz(db, selected=None):
+    """
+    Generate a ColumnarContentDB as an uncompressed NPZ archive, readable
+    with numpy.load. info holds the feature set name, scales the scale of
+    each exported scale, and feats_<n>, iid_<n>, px_<n>, c_<n>, z_<n>, t_<n>
+    and owner_<n> the columns of the n-th exported scale.
+    Each array is written to a temporary file a chunk at a time and then
+    sent, so large ContentDBs can be exported without holding them or the
+    archive in memory or on disk.
+    @param selected optional function which takes a ColumnarScale and
+    returns an array of the rows to export, or None to skip the scale
+    """
+    tmpdir = tempfile.mkdtemp(prefix='contentdb-export-')
+    try:
+        out = StreamWriter()
+        zf = zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+        def add(name, a, rows=None):
+            path = os.path.join(tmpdir, name + '.npy')
+            saveRows(path, a, rows)
+            for data in zipMember(zf, out, path, name + '.npy'):
+                yield data
+            os.remove(path)
+
+        scales = []
+        for scale in sorted(db.scales.keys()):
+            s = db.scales[scale]
+            rows = None if selected is None else selected(s)
+            if selected is not None and rows is None:
+                continue
+            if s.live is not None:
+                # Skip rows replaced by journal rows
+                if rows is None:
+                    rows = numpy.flatnonzero(s.live)
+                else:
+                    rows = rows[s.live[rows]]
+            n = len(scales)
+            for k in EXPORT_COLUMNS:
+                for data in add('%s_%d' % (k, n), getattr(s, k), rows):
+                    yield data
+            scales.append(scale)
+        for data in add('scales', numpy.array(scales, dtype=numpy.float64)):
+            yield data
+        for data in add('info', numpy.array([db.info])):
+            yield data
+        zf.close()
+        yield out.pop()
+        logger.info('Exported %d scales of ContentDB %s', len(scales),
+                    db.info)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def exportNpz(db, f, selected=None):
+    """
+    Write a ColumnarContentDB to a file as an uncompressed NPZ archive, see
+    iterNpz
+    @param f a writeable file object
+    """
+    for data in iterNpz(db, selected):
+        f.write(data)
+
+
+class ContentDBCache(object):
+    """
+    A least recently used cache of ContentDBs keyed by (group-id,
+    feature-set, dataset-id), bounded by the memory used by all entries.
+    ContentDBs are stored per group, so the group is part of the key.
+    """
+
+    class Entry(object):
+        def __init__(self, version, db, base, message, size):
+            self.version = version
+            self.db = db
+            # db without the journal rows
+            self.base = base
+            self.message = message
+            self.size = size
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Separate locks for loading so that concurrent requests for the same
+        # ContentDB only load it once, without blocking other feature sets
+        self.loadLocks = defaultdict(threading.Lock)
+
+    def totalSize(self):
+        return sum(e.size for e in self.entries.itervalues())
+
+    def lookup(self, key, version):
+        """
+        Return the cached entry if it matches version, marking it as the most
+        recently used
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version:
+                logger.debug('ContentDB %s changed: %s -> %s',
+                             key, entry.version, version)
+                return None
+            self.entries[key] = self.entries.pop(key)
+            return entry
+
+    def lookupBase(self, key, version):
+        """
+        Return the cached entry if it's for the same pickled ContentDB as
+        version, though possibly a different journal
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version[:3] != version[:3]:
+                return None
+            return entry
+
+    def store(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            if entry.size > self.maxBytes:
+                logger.warn('ContentDB %s (~%d bytes) exceeds the cache '
+                            'limit (%d bytes), not caching',
+                            key, entry.size, self.maxBytes)
+                return
+            self.entries[key] = entry
+            while self.totalSize() > self.maxBytes:
+                k, e = self.entries.popitem(last=False)
+                logger.debug('Evicting ContentDB %s (~%d bytes)', k, e.size)
+
+    def get(self, conn, ftset, did=None):
+        """
+        Get a ContentDB, returns a tuple (ColumnarContentDB, message) where
+        message is the message returned by pyslid.database.direct.retrieve.
+        If the ContentDB couldn't be loaded the first element will be None.
+        """
+        gid = pyslid.database.direct.getCurrentGroupId(conn)
+        return self.load(
+            (gid, ftset, did), lambda: getVersion(conn, ftset, did),
+            lambda: pyslid.database.direct.retrieve(conn, ftset, did),
+            journal.groupJournalDir(gid, ftset, did))
+
+    def load(self, key, currentVersion, retrieve, jdir):
+        """
+        Get a ContentDB, see get
+        @param key (group-id, feature-set, dataset-id)
+        @param currentVersion function returning the current version of the
+        ContentDB, see getVersion
+        @param retrieve function returning the pickled ContentDB and a
+        message, see pyslid.database.direct.retrieve
+        @param jdir the journal directory of the ContentDB
+        """
+        version = currentVersion()
+        if version is None:
+            with self.lock:
+                self.entries.pop(key, None)
+            cdb, message = retrieve()
+            return None, message
+
+        entry = self.lookup(key, version)
+        if entry:
+            return entry.db, entry.message
+
+        with self.loadLocks[key]:
+            # Another thread may have loaded it whilst we were waiting
+            entry = self.lookup(key, version)
+            if entry:
+                return entry.db, entry.message
+
+            # If only the journal has changed reuse the pickled ContentDB
+            entry = self.lookupBase(key, version)
+            if entry:
+                base, message = entry.base, entry.message
+            else:
+                base, message = self.loadBase(version, currentVersion,
+                                              retrieve)
+                if base is None:
+                    return None, message
+
+            db = base
+            rows = journal.readRows(jdir)
+            if rows:
+                db = base.overlaid(rows)
+
+            # The file may have been replaced whilst it was being read, in
+            # which case don't risk associating it with the wrong version
+            if currentVersion() != version:
+                logger.debug('ContentDB %s changed during load', key)
+                return db, message
+
+            db.version = version
+            # Mapped arrays are shared page-cache, not private memory
+            size = 0 if base.mapped else base.nbytes
+            size += sum(db.scales[scale].nbytes for scale in rows)
+            entry = self.Entry(version, db, base, message, size)
+            logger.info('Loaded ContentDB %s %s (%d bytes)',
+                        key, version, entry.size)
+            self.store(key, entry)
+            return db, message
+
+    def loadBase(self, version, currentVersion, retrieve):
+        """
+        Load the normalised pickled ContentDB, from the columnar store if
+        possible, see load
+        @return (ColumnarContentDB, message), the first element is None if
+        the ContentDB couldn't be loaded
+        """
+        if contentdb_columnar_store:
+            db = readStore(version)
+            if db is not None:
+                return db, 'Good'
+
+        cdb, message = retrieve()
+        if message != 'Good':
+            return None, message
+        db = ColumnarContentDB.fromRows(cdb)
+        del cdb
+
+        if contentdb_columnar_store and (
+            (currentVersion() or ())[:3] == version[:3]):
+            try:
+                writeStore(db, version)
+                db = readStore(version) or db
+            except (IOError, OSError) as e:
+                logger.warn('Failed to write columnar ContentDB %s: %s',
+                            version, e)
+
+        if not db.mapped:
+            db.normalize()
+        return db, message
+
+
+_cache = ContentDBCache(contentdb_cache_max_bytes)
+
+
+def load(conn, ftset, did=None):
+    """
+    Cached columnar replacement for pyslid.database.direct.retrieve
+    The returned ContentDB is shared between requests and must not be modified
+    """
+    return _cache.get(conn, ftset, did)
+
+
+def preload(gid, ftset, dbname):
+    """
+    Load a ContentDB file found by localContentDBs into the cache without an
+    OMERO session
+    """
+    jdir = journal.groupJournalDir(gid, ftset)
+    return _cache.load((gid, ftset, None), lambda: fileVersion(dbname, jdir),
+                       lambda: retrieveFile(dbname), jdir)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Feature calculation for single images, shared by the Feature Calculation
+script and the featurequeue command line tool
+"""
+
+import itertools
+import sys
+
+import omero
+import omero.model
+from omero.rtypes import unwrap
+
+import pyslid
+
+# 0 or 1 based indexing in the UI?
+IDX_OFFSET = 0
+
+# Number of images whose existing features are looked up together
+EXISTING_BATCH_IMAGES = 500
+
+
+def listExistingCZTS(conn, imageId, ftset):
+    """
+    List the available CZT and scales for features associated with an image
+    feature table.
+    Returns a list of tuples (C, Z, T, scale)
+    """
+    try:
+        ftnames, ftvalues = pyslid.features.get(
+            conn, 'vector', imageId, set=ftset)
+        return [r[1:5] for r in ftvalues]
+    except pyslid.utilities.PyslidException:
+        return []
+
+
+def findFeatureTables(conn, imageIds, ftset):
+    """
+    Find the field feature tables attached to many images with one query,
+    instead of calling pyslid.features.hasTable on each image
+    Returns a dictionary of image-id: OriginalFile id of the most recent table
+    """
+    query = ('select iml.parent.id, f.id, f.name from ImageAnnotationLink iml '
+             'join iml.child fileAnn join fileAnn.file f '
+             'where iml.parent.id in (:ids) and f.name like :filename '
+             'order by f.id')
+    params = omero.sys.ParametersI()
+    params.addIds(imageIds)
+    params.addString('filename', 'iid-%%_feature-%s_field.h5' % ftset)
+    tables = {}
+    qs = conn.getQueryService()
+    for r in qs.projection(query, params, conn.SERVICE_OPTS):
+        iid, fid, name = [unwrap(x) for x in r]
+        # The name pattern also matches other images and feature sets
+        if name == 'iid-%d_feature-%s_field.h5' % (iid, ftset):
+            tables[iid] = fid
+    return tables
+
+
+def readExistingCZTS(conn, fileId):
+    """
+    Read the CZT and scale of every row of a feature table without reading
+    the features
+    Returns a list of tuples (C, Z, T, scale), or None if the table couldn't
+    be read
+    """
+    try:
+        table = conn.getSharedResources().openTable(
+            omero.model.OriginalFileI(fileId, False), conn.SERVICE_OPTS)
+    except omero.ServerError as e:
+        sys.stderr.write('Failed to open feature table id:%d: %s\n' % (
+                fileId, e))
+        return None
+    try:
+        # Columns are pixels, channel, zslice, timepoint, scale, features...
+        data = table.read([1, 2, 3, 4], 0, table.getNumberOfRows())
+        return zip(*[col.values for col in data.columns])
+    except omero.ServerError as e:
+        sys.stderr.write('Failed to read feature table id:%d: %s\n' % (
+                fileId, e))
+        return None
+    finally:
+        table.close()
+
+
+def existingFeatures(conn, images, ftset, recalc):
+    """
+    Pair each image with the CZT and scales it already has features for,
+    looking up EXISTING_BATCH_IMAGES images at a time so images without
+    feature tables don't need a query each
+    Generates (image, existing) where existing is a list of tuples
+    (C, Z, T, scale), or None if it should be looked up by extractFeatures
+    """
+    images = iter(images)
+    while True:
+        batch = list(itertools.islice(images, EXISTING_BATCH_IMAGES))
+        if not batch:
+            return
+        if recalc:
+            tables = {}
+        else:
+            tables = findFeatureTables(
+                conn, [im.getId() for im in batch], ftset)
+        for image in batch:
+            fid = tables.get(image.getId())
+            if fid is None:
+                yield image, []
+            else:
+                yield image, readExistingCZTS(conn, fid)
+
+
+def extractFeaturesOneChannel(conn, image, scale, ftset, scaleSet,
+                              channels, zslice, timepoint,
+                              disableCdb, cdbJournal):
+    """
+    Calculate features for one image, link to the image, save to the ContentDB
+    journal.
+    @param scaleSet a read write parameter, calculated scales should be
+    appended to this set so that the journal is only compacted at the end if
+    it has changed.
+    @param cdbJournal a journal.JournalWriter or journal.JournalBuffer
+    """
+    message = ''
+    imageId = image.getId()
+    pixels = 0
+
+    mid = 'image:%d c:%s z:%d t:%d' % (imageId, channels, zslice, timepoint)
+
+    print 'Calculating features ftset:%s scale:%e %s' % (ftset, scale, mid)
+    try:
+        [fids, features, scalec] = pyslid.features.calculate(
+            conn, imageId, scale, ftset, True, None,
+            pixels, channels, zslice, timepoint, debug=True)
+    except pyslid.utilities.PyslidException as e:
+        m = 'Feature calculation failed for %s\nException:%s\n' % (mid, e)
+        sys.stderr.write(m)
+        return message + m
+
+    if features is None:
+        m = 'Feature calculation failed for %s\n' % mid
+        sys.stderr.write(m)
+        return message + m
+
+    # Create an individual OMERO.table for this image
+    #print fids
+    #print features
+    answer = pyslid.features.link(
+        conn, imageId, scale, fids, features, ftset, field=True, rid=None,
+        pixels=0, channel=channels[0], zslice=zslice, timepoint=timepoint)
+
+    if answer:
+        print 'Extracted features from %s' % mid
+    else:
+        m = 'Failed to link features to %s\n' % mid
+        sys.stderr.write(m)
+        return message + m
+
+    if disableCdb:
+        print 'ContentDB update disabled'
+        return message
+
+    # Add to the global contentDB journal, this is merged into the ContentDB
+    # when it's loaded and compacted at the end
+    # TODO: Implement this per-dataset level (already supported by PySLID)
+    # TODO: Set servername, change update parameter from username to userid
+    server = 'NA'
+    # Username can change, UserId should be constant
+    username = image.getOwner().getId()
+    try:
+        cdbJournal.append(
+            server, username, scale,
+            imageId, pixels, channels[0], zslice, timepoint,
+            fids, features)
+        scaleSet.add(scale)
+        return message
+    except (IOError, OSError) as e:
+        um = str(e)
+
+    m = 'Failed to update ContentDB with %s : %s\n' % (mid, um)
+    sys.stderr.write(m)
+    return message + m
+
+
+def selectionError(image, ftset, channels, zselect, tselect):
+    """
+    Check that the requested Z-slice, timepoint and channels are in an image,
+    processing the image again won't change the result
+    @return an error message, or '' if they're all present
+    """
+    imageId = image.getId()
+    if zselect[0] and (zselect[1] < IDX_OFFSET or
+                       zselect[1] >= image.getSizeZ() + IDX_OFFSET):
+        return 'Z-slice %d not found in Image id:%d\n' % (zselect[1], imageId)
+    if tselect[0] and (tselect[1] < IDX_OFFSET or
+                       tselect[1] >= image.getSizeT() + IDX_OFFSET):
+        return 'Timepoint %d not found in Image id:%d\n' % (
+            tselect[1], imageId)
+    if channels[0] and (channels[1] < IDX_OFFSET or
+                        channels[1] >= image.getSizeC() + IDX_OFFSET):
+        return 'Channel %d not found in Image id:%d\n' % (
+            channels[1], imageId)
+    if ftset == 'slf34' and (channels[2] < IDX_OFFSET or
+                             channels[2] >= image.getSizeC() + IDX_OFFSET):
+        return 'Channel %d not found in Image id:%d\n' % (
+            channels[2], imageId)
+    return ''
+
+
+def extractFeatures(conn, image, scale, ftset, scaleSet,
+                    channels, zselect, tselect, recalc, disableCdb,
+                    cdbJournal, existing=None):
+    """
+    Extract features for the requested channel(s)
+    @param existing optional list of (C, Z, T, scale) already calculated for
+    this image, see existingFeatures
+    """
+
+    message = ''
+    imageId = image.getId()
+
+    m = selectionError(image, ftset, channels, zselect, tselect)
+    if m:
+        sys.stderr.write(m)
+        return message + m
+
+    if recalc:
+        existing = []
+    elif existing is None:
+        existing = listExistingCZTS(conn, imageId, ftset)
+
+    if not zselect[0]:
+        zslice = image.getSizeZ() / 2
+    else:
+        zslice = zselect[1] - IDX_OFFSET
+
+    if not tselect[0]:
+        timepoint = image.getSizeT() / 2
+    else:
+        timepoint = tselect[1] - IDX_OFFSET
+
+    allChannels = not channels[0]
+
+    if allChannels:
+        readoutCh = range(image.getSizeC())
+    else:
+        readoutCh = [channels[1] - IDX_OFFSET]
+
+    if ftset == 'slf34':
+        otherChs = [channels[2] - IDX_OFFSET]
+    else:
+        otherChs = []
+
+    for c in readoutCh:
+        chs = [c] + otherChs
+
+        if (c, zslice, timepoint, scale) in existing:
+            print 'Features already present for %d %d.%d.%d (%e)' % (
+                imageId, c, zslice, timepoint, scale)
+        else:
+            message += extractFeaturesOneChannel(
+                conn, image, scale, ftset, scaleSet, chs, zslice, timepoint,
+                disableCdb, cdbJournal)
+
+    return message
+
+
+def imageGenerator(parent):
+    """
+    Returns a sequence of images from one or more containers
+    """
+    if isinstance(parent, list):
+        for par in parent:
+            for im in imageGenerator(par):
+                yield im
+    elif parent.OMERO_CLASS == 'Image':
+        yield parent
+    elif parent.OMERO_CLASS == 'WellSample':
+        yield parent.getImage()
+    else:
+        print '%s: %d' % (parent.OMERO_CLASS, parent.id)
+        for ch in parent.listChildren():
+            for im in imageGenerator(ch):
+                yield im
@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Distributed feature calculation using a work queue on a shared filesystem
+
+The Feature Calculation script runs on a single OMERO processor. This command
+line tool instead splits the images of one or more containers into work
+units in a queue directory, so that any number of workers on other machines
+can calculate features for them:
+
+    python -m omeroweb.omero_searcher.featurequeue init QUEUE \\
+        -s SERVER -u USER --type Screen --ids 1 2 --featureset slf33
+    python -m omeroweb.omero_searcher.featurequeue work QUEUE -s SERVER ...
+    python -m omeroweb.omero_searcher.featurequeue status QUEUE
+    python -m omeroweb.omero_searcher.featurequeue merge QUEUE -s SERVER ...
+
+The queue directory contains
+    queue.json          the feature calculation parameters
+    units/NNNNNN.json   the image IDs of each unit
+    claims/NNNNNN.lock  a unit claimed by a worker, containing the worker's
+                        token, the modification time is updated after each
+                        image
+    shards/NNNNNN.jsonl the ContentDB rows of a finished unit, in the journal
+                        format
+    failed/NNNNNN.json  the images of a finished unit which failed
+    merged.json         the shards which have been merged
+
+Workers claim a unit by exclusively creating its lock file, and write its
+shard under a temporary name which is renamed when the unit is finished.
+Claims which haven't been updated for --stale seconds are assumed to belong
+to a failed worker and are taken over.
+
+Images which fail are recorded with the finished unit and queued again in a
+new unit NNNNNN-rK, up to --attempts times in total. Images which no longer
+exist, or don't have the requested Z-slice, timepoint or channels, would fail
+again so they're recorded but not queued again.
+
+The merge stage must run on a machine with access to the ContentDB
+directory. It adds the shards to the ContentDB journal, so searches include
+them straight away, then merges the journal into the ContentDB with one
+update per owner and scale and rebuilds the columnar store (see journal).
+"""
+
+import argparse
+import getpass
+import glob
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import time
+import uuid
+
+import omero
+import omero.clients
+from omero.gateway import BlitzGateway
+
+import pyslid
+# Explicit relative imports so this can be run with python -m
+from .omero_searcher_config import omero_contentdb_path
+pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
+
+from . import contentdb
+from . import featurecalc
+from . import journal
+
+logger = logging.getLogger('searcher')
+
+# Default number of images in each work unit
+UNIT_IMAGES = 100
+
+# Default number of seconds after which an unchanged claim is taken over
+STALE_CLAIM_SECONDS = 3600
+
+# Default number of times an image is processed before it's left as failed
+MAX_ATTEMPTS = 3
+
+CONTAINER_TYPES = ['Project', 'Dataset', 'Screen', 'Plate',
+                   'PlateAcquisition', 'Well', 'Image']
+
+
+class WorkQueue(object):
+    """
+    A queue directory, see the module documentation
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def sub(self, *names):
+        return os.path.join(self.path, *names)
+
+    def unitPath(self, unit):
+        return self.sub('units', '%s.json' % unit)
+
+    def claimPath(self, unit):
+        return self.sub('claims', '%s.lock' % unit)
+
+    def shardPath(self, unit):
+        return self.sub('shards', '%s.jsonl' % unit)
+
+    def failedPath(self, unit):
+        return self.sub('failed', '%s.json' % unit)
+
+    def create(self, params, imageIds, unitImages):
+        """
+        Write the parameters and split the images into units
+        """
+        for d in ('units', 'claims', 'shards', 'failed'):
+            os.makedirs(self.sub(d))
+        for n, start in enumerate(xrange(0, len(imageIds), unitImages)):
+            writeJson(self.unitPath('%06d' % n),
+                      {'images': imageIds[start:start + unitImages]})
+        params['units'] = n + 1 if imageIds else 0
+        writeJson(self.sub('queue.json'), params)
+
+    def params(self):
+        with open(self.sub('queue.json')) as f:
+            return json.load(f)
+
+    def units(self):
+        return sorted(os.path.basename(p)[:-len('.json')]
+                      for p in glob.glob(self.sub('units', '*.json')))
+
+    def images(self, unit):
+        with open(self.unitPath(unit)) as f:
+            return json.load(f)['images']
+
+    def attempt(self, unit):
+        """
+        The number of times the images in a unit have been processed before
+        """
+        with open(self.unitPath(unit)) as f:
+            return json.load(f).get('attempt', 0)
+
+    def requeue(self, unit, failures, permanent=None):
+        """
+        Record the images of a unit which failed, and queue them again in a
+        new unit unless they've been processed the maximum number of times
+        @param failures a dict of image ID to error message
+        @param permanent a dict of image ID to error message for images
+        which would fail again, these aren't queued
+        @return the new unit or None
+        """
+        attempt = self.attempt(unit) + 1
+        if not os.path.isdir(self.sub('failed')):
+            os.makedirs(self.sub('failed'))
+        writeJson(self.failedPath(unit), {
+                'attempt': attempt,
+                'failures': dict((str(k), v) for k, v in failures.iteritems()),
+                'permanent': dict(
+                    (str(k), v) for k, v in (permanent or {}).iteritems()),
+                })
+        if (not failures or
+            attempt >= self.params().get('attempts', MAX_ATTEMPTS)):
+            return None
+        retry = '%s-r%d' % (unit.split('-')[0], attempt)
+        writeJson(self.unitPath(retry),
+                  {'images': sorted(failures), 'attempt': attempt})
+        return retry
+
+    def failed(self):
+        """
+        The images which failed permanently or in their last attempt, and
+        haven't been queued again
+        @return a dict of image ID to error message
+        """
+        attempts = self.params().get('attempts', MAX_ATTEMPTS)
+        failed = {}
+        for p in glob.glob(self.sub('failed', '*.json')):
+            with open(p) as f:
+                d = json.load(f)
+            if d['attempt'] >= attempts:
+                failed.update((long(k), v) for k, v in d['failures'].items())
+            failed.update(
+                (long(k), v) for k, v in d.get('permanent', {}).items())
+        return failed
+
+    def finished(self, unit):
+        return os.path.exists(self.shardPath(unit))
+
+    def claim(self, unit, stale):
+        """
+        Try to claim a unit
+        @return a token identifying the claim if this process now holds it,
+        otherwise None
+        """
+        path = self.claimPath(unit)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            age = None
+        if age is not None:
+            if age < stale:
+                return None
+            # Only one worker can rename the stale claim
+            stalePath = '%s.stale.%s' % (path, uuid.uuid4().hex)
+            try:
+                os.rename(path, stalePath)
+            except OSError:
+                return None
+            # Another worker may have taken over the claim, or its owner
+            # updated it, since its age was read
+            age = time.time() - os.path.getmtime(stalePath)
+            if age < stale:
+                # Put back the live claim, unless the unit was claimed whilst
+                # it was renamed
+                try:
+                    os.link(stalePath, path)
+                except OSError:
+                    logger.warn('Claim on unit %s was replaced', unit)
+                os.remove(stalePath)
+                return None
+            os.remove(stalePath)
+            logger.warn('Taking over unit %s, not updated for %ds', unit, age)
+        token = '%s %d %s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None
+        os.write(fd, '%s\n' % token)
+        os.close(fd)
+        # The unit may have been finished since it was checked
+        if self.finished(unit):
+            self.release(unit, token)
+            return None
+        return token
+
+    def claimNext(self, stale):
+        """
+        Claim the first unfinished unit which isn't held by another worker
+        @return (unit, token), or (None, None) if there are none
+        """
+        for unit in self.units():
+            if not self.finished(unit):
+                token = self.claim(unit, stale)
+                if token:
+                    return unit, token
+        return None, None
+
+    def owns(self, unit, token):
+        """
+        Check whether a claim is still held, it may have been taken over
+        """
+        try:
+            with open(self.claimPath(unit)) as f:
+                return f.read().strip() == token
+        except IOError:
+            return False
+
+    def heartbeat(self, unit, token):
+        if self.owns(unit, token):
+            try:
+                os.utime(self.claimPath(unit), None)
+            except OSError:
+                pass
+
+    def release(self, unit, token):
+        """
+        Remove a claim if it's still held by token, a claim which was taken
+        over belongs to the new owner
+        """
+        if self.owns(unit, token):
+            try:
+                os.remove(self.claimPath(unit))
+            except OSError:
+                pass
+
+    def merged(self):
+        try:
+            with open(self.sub('merged.json')) as f:
+                return set(json.load(f))
+        except IOError:
+            return set()
+
+
+class ShardWriter(journal.JournalWriter):
+    """
+    Writes the ContentDB rows of a unit in the journal format, to a
+    temporary file until commit() is called
+    """
+
+    def __init__(self, path):
+        self.final = path
+        self.dir = os.path.dirname(path)
+        self.path = '%s.%s.tmp' % (path, uuid.uuid4().hex[:8])
+
+    def commit(self):
+        if os.path.exists(self.path):
+            os.rename(self.path, self.final)
+        else:
+            # No new rows
+            with open(self.final, 'w'):
+                pass
+
+
+def writeJson(path, data):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def connect(args):
+    """
+    Create a BlitzGateway from the command line arguments, joining an
+    existing session if --key is given
+    """
+    client = omero.client(args.server, args.port)
+    if args.key:
+        client.joinSession(args.key)
+    else:
+        password = args.password or os.environ.get('OMERO_PASSWORD') or (
+            getpass.getpass())
+        client.createSession(args.user, password)
+    client.enableKeepAlive(60)
+    conn = BlitzGateway(client_obj=client)
+    if args.group is not None:
+        conn.setGroupForSession(args.group)
+    return conn
+
+
+def init(args):
+    queue = WorkQueue(args.queue)
+    if os.path.exists(queue.sub('queue.json')):
+        sys.exit('Queue %s already exists' % args.queue)
+    conn = connect(args)
+    try:
+        objects = list(conn.getObjects(args.type, args.ids))
+        if not objects:
+            sys.exit('No %s found with IDs %s' % (args.type, args.ids))
+        seen = set()
+        imageIds = []
+        for im in featurecalc.imageGenerator(objects):
+            if im.getId() not in seen:
+                seen.add(im.getId())
+                imageIds.append(im.getId())
+    finally:
+        conn.close()
+
+    params = {
+        'featureset': args.featureset,
+        'scale': args.scale,
+        'channels': [args.channel is not None,
+                     args.channel or featurecalc.IDX_OFFSET,
+                     args.reference_channel],
+        'zselect': [args.z is not None, args.z or 0],
+        'tselect': [args.t is not None, args.t or 0],
+        'recalc': args.recalculate,
+        'attempts': args.attempts,
+        'created': time.time(),
+        }
+    queue.create(params, imageIds, args.unit_images)
+    print 'Queued %d images in %d units' % (
+        len(imageIds), queue.params()['units'])
+
+
+def processUnit(conn, queue, unit, token, params):
+    """
+    Calculate features for the images in a unit and write its shard, images
+    which fail are queued again unless they would fail again
+    @return a dict of image ID to error message for the failed images
+    """
+    ftset = str(params['featureset'])
+    channels = tuple(params['channels'])
+    zselect = tuple(params['zselect'])
+    tselect = tuple(params['tselect'])
+    shard = ShardWriter(queue.shardPath(unit))
+    # The shard is only read once it's committed, so the unit's rows are
+    # written in one go
+    rows = journal.JournalBuffer(shard)
+    imageIds = queue.images(unit)
+    failures = {}
+    permanent = {}
+    found = set()
+    for image, existing in featurecalc.existingFeatures(
+        conn, conn.getObjects('Image', imageIds), ftset, params['recalc']):
+        iid = image.getId()
+        found.add(iid)
+        try:
+            msg = featurecalc.selectionError(
+                image, ftset, channels, zselect, tselect)
+            if msg:
+                permanent[iid] = msg
+            else:
+                msg = featurecalc.extractFeatures(
+                    conn, image, params['scale'], ftset, set(), channels,
+                    zselect, tselect, params['recalc'], False, rows, existing)
+                if msg:
+                    failures[iid] = msg
+        except Exception as e:
+            logger.error('Feature calculation failed for image %d', iid,
+                         exc_info=True)
+            failures[iid] = ('Feature calculation failed for Image id:%d\n'
+                             'Exception:%s\n' % (iid, e))
+        queue.heartbeat(unit, token)
+    for iid in imageIds:
+        if iid not in found:
+            permanent[iid] = 'Image id:%d not found\n' % iid
+    rows.flush()
+    # Queue the failures before the unit is finished so they can't be lost
+    if failures or permanent:
+        retry = queue.requeue(unit, failures, permanent)
+        if retry:
+            logger.warn('Queued %d failed images in unit %s',
+                        len(failures), retry)
+    shard.commit()
+    failures.update(permanent)
+    return failures
+
+
+def work(args):
+    queue = WorkQueue(args.queue)
+    params = queue.params()
+    conn = connect(args)
+    processed = 0
+    try:
+        while args.max_units is None or processed < args.max_units:
+            unit, token = queue.claimNext(args.stale)
+            if unit is None:
+                break
+            print 'Processing unit %s' % unit
+            try:
+                failures = processUnit(conn, queue, unit, token, params)
+            finally:
+                queue.release(unit, token)
+            print 'Finished unit %s, %d images with errors' % (
+                unit, len(failures))
+            processed += 1
+    finally:
+        conn.close()
+    print 'Processed %d units' % processed
+
+
+def status(args):
+    queue = WorkQueue(args.queue)
+    units = queue.units()
+    finished = [u for u in units if queue.finished(u)]
+    claimed = [u for u in units if not queue.finished(u) and
+               os.path.exists(queue.claimPath(u))]
+    print 'Units: %d finished: %d claimed: %d pending: %d merged: %d' % (
+        len(units), len(finished), len(claimed),
+        len(units) - len(finished) - len(claimed), len(queue.merged()))
+    failed = queue.failed()
+    if failed:
+        print 'Failed images: %s' % ' '.join(
+            str(iid) for iid in sorted(failed))
+
+
+def merge(args):
+    queue = WorkQueue(args.queue)
+    params = queue.params()
+    ftset = str(params['featureset'])
+    units = queue.units()
+    unfinished = [u for u in units if not queue.finished(u)]
+    if unfinished and not args.partial:
+        sys.exit('%d units are unfinished, use --partial to merge the '
+                 'finished units' % len(unfinished))
+    merged = queue.merged()
+    pending = [u for u in units if queue.finished(u) and u not in merged]
+
+    conn = connect(args)
+    try:
+        # Add the shards to the journal, the file name identifies the queue
+        # so repeated merges replace rather than duplicate them
+        jdir = journal.journalDir(conn, ftset)
+        if not os.path.isdir(jdir):
+            os.makedirs(jdir)
+        qid = os.path.basename(os.path.abspath(args.queue))
+        for unit in pending:
+            if os.path.getsize(queue.shardPath(unit)) == 0:
+                continue
+            dest = os.path.join(jdir, 'queue-%s-%s%s' % (
+                    qid, unit, journal.JOURNAL_SUFFIX))
+            shutil.copyfile(queue.shardPath(unit), dest + '.tmp')
+            os.rename(dest + '.tmp', dest)
+        writeJson(queue.sub('merged.json'), sorted(merged.union(pending)))
+        print 'Added %d shards to the ContentDB journal' % len(pending)
+
+        a, msg = contentdb.compactJournal(conn, ftset)
+        print msg
+        if not a:
+            sys.exit('Failed to merge the ContentDB journal: %s' % msg)
+        a, msg = contentdb.rebuildStore(conn, ftset)
+        if not a:
+            sys.exit('Failed to save columnar ContentDB: %s' % msg)
+    finally:
+        conn.close()
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Distributed OMERO.searcher feature calculation')
+    sub = parser.add_subparsers()
+
+    def command(name, fn, help, server=True):
+        p = sub.add_parser(name, help=help)
+        p.set_defaults(fn=fn)
+        p.add_argument('queue', help='Queue directory on a shared filesystem')
+        if server:
+            p.add_argument('-s', '--server', required=True)
+            p.add_argument('-p', '--port', type=int, default=4064)
+            p.add_argument('-u', '--user')
+            p.add_argument('-w', '--password',
+                           help='Default $OMERO_PASSWORD or prompt')
+            p.add_argument('-k', '--key', help='Join an existing session')
+            p.add_argument('-g', '--group', type=long)
+        return p
+
+    p = command('init', init, 'Create a queue of images')
+    p.add_argument('--type', choices=CONTAINER_TYPES, default='Screen')
+    p.add_argument('--ids', type=long, nargs='+', required=True)
+    p.add_argument('--featureset', default='slf33')
+    p.add_argument('--scale', type=float, default=1.0)
+    p.add_argument('--channel', type=int,
+                   help='Readout channel, default all channels')
+    p.add_argument('--reference-channel', type=int,
+                   default=featurecalc.IDX_OFFSET + 1,
+                   help='slf34 reference channel')
+    p.add_argument('--z', type=int, help='Z-slice, default the middle')
+    p.add_argument('--t', type=int, help='Timepoint, default the middle')
+    p.add_argument('--recalculate', action='store_true',
+                   help='Recalculate existing features')
+    p.add_argument('--unit-images', type=int, default=UNIT_IMAGES)
+    p.add_argument('--attempts', type=int, default=MAX_ATTEMPTS,
+                   help='Number of times to try failed images')
+
+    p = command('work', work, 'Process units until none are left')
+    p.add_argument('--stale', type=int, default=STALE_CLAIM_SECONDS,
+                   help='Take over claims not updated for this many seconds')
+    p.add_argument('--max-units', type=int)
+
+    command('status', status, 'Report the progress of a queue', False)
+
+    p = command('merge', merge, 'Merge finished units into the ContentDB')
+    p.add_argument('--partial', action='store_true',
+                   help='Merge the finished units even if some are unfinished')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parseArgs(argv)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
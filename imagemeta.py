@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Local index of image metadata used by searches
+
+For each group and user the owner, name, datasets, plate and channel names
+of every image visible to the user are read from OMERO with a few bulk
+queries and held in memory. The index records the highest update event it has
+seen, and is brought up to date by only reading objects with a later update
+event, at most once every imagemeta_refresh_interval seconds.
+
+Deletions aren't visible as update events, so the index is rebuilt from
+scratch in a background thread every imagemeta_full_refresh_interval seconds,
+and the old index is used until the new one is ready. Until then a deleted
+image or link may remain in the index, so callers must still check that
+images exist before displaying them.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import numpy
+
+import omero
+from omero.rtypes import rlong, unwrap
+
+import pyslid
+
+from omero_searcher_config import imagemeta_refresh_interval
+from omero_searcher_config import imagemeta_full_refresh_interval
+
+logger = logging.getLogger('searcher')
+
+UNNAMED_CHANNEL = '[No channel name]'
+
+# Number of rows fetched by each metadata query
+QUERY_PAGE_SIZE = 50000
+
+
+def projectionPages(conn, query, since):
+    """
+    Run a HQL projection a page at a time, generating unwrapped result rows
+    @param since passed to the query as the :since parameter
+    """
+    qs = conn.getQueryService()
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.add('since', rlong(since))
+        params.page(offset, QUERY_PAGE_SIZE)
+        rs = qs.projection(query, params, conn.SERVICE_OPTS)
+        for r in rs:
+            yield [unwrap(x) for x in r]
+        if len(rs) < QUERY_PAGE_SIZE:
+            break
+        offset += QUERY_PAGE_SIZE
+
+
+def channelKey(iid, c):
+    """
+    Combine image ID and channel index columns into a single key
+    """
+    return (numpy.asarray(iid, dtype=numpy.int64) << 16) + c
+
+
+class ImageMetadata(object):
+    """
+    Metadata for all images in a group visible to one user
+    generation is incremented whenever the metadata changes
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Held while reading from OMERO, so only one thread refreshes
+        self.refreshLock = threading.Lock()
+        self.generation = 0
+        self.created = 0
+        self.checked = 0
+        self.replacer = None
+        self.clear()
+
+    def clear(self):
+        self.owners = {}
+        self.names = {}
+        self.datasets = {}
+        self.plates = {}
+        self.chnames = {}
+        self.lastEvent = -1
+        self.inverted = {}
+
+    def refresh(self, conn):
+        """
+        Read metadata for images updated since the last refresh, or
+        everything if this is the first refresh. The queries are run before
+        taking the lock so searches can use the current metadata meanwhile.
+        """
+        since = self.lastEvent
+        last = [since]
+
+        def rows(query):
+            rs = []
+            for r in projectionPages(conn, query, since):
+                last[0] = max(last[0], r[-1])
+                rs.append(r[:-1])
+            return rs
+
+        images = rows(
+            'select im.id, im.details.owner.id, im.name, '
+            'im.details.updateEvent.id from Image im '
+            'where im.details.updateEvent.id > :since order by im.id')
+        datasets = rows(
+            'select dl.child.id, dl.parent.id, dl.details.updateEvent.id '
+            'from DatasetImageLink dl '
+            'where dl.details.updateEvent.id > :since order by dl.id')
+        plates = rows(
+            'select ws.image.id, ws.well.plate.id, '
+            'ws.details.updateEvent.id from WellSample ws '
+            'where ws.details.updateEvent.id > :since order by ws.id')
+        channels = rows(
+            'select p.image.id, index(ch), lc.name, '
+            'ch.details.updateEvent.id, lc.details.updateEvent.id '
+            'from Pixels p join p.channels ch join ch.logicalChannel lc '
+            'where ch.details.updateEvent.id > :since '
+            'or lc.details.updateEvent.id > :since '
+            'order by p.id, index(ch)')
+        changed = len(images) + len(datasets) + len(plates) + len(channels)
+
+        with self.lock:
+            for iid, uid, name in images:
+                self.owners[iid] = uid
+                self.names[iid] = name
+            for iid, did in datasets:
+                self.datasets.setdefault(iid, set()).add(did)
+            for iid, pid in plates:
+                self.plates[iid] = pid
+            for iid, c, name, e1 in channels:
+                last[0] = max(last[0], e1)
+                names = self.chnames.setdefault(iid, [])
+                names.extend([None] * (c + 1 - len(names)))
+                names[c] = UNNAMED_CHANNEL if name is None else name
+
+            if since < 0:
+                self.created = time.time()
+            self.lastEvent = last[0]
+            self.checked = time.time()
+            if changed or since < 0:
+                self.generation += 1
+                self.inverted = {}
+        logger.debug('Refreshed image metadata: %d changes since event '
+                     '%d, %d images', changed, since, len(self.owners))
+
+    def update(self, conn, key):
+        """
+        Refresh the metadata if it's due. The first refresh is waited for,
+        after that incremental refreshes are skipped if another thread is
+        already refreshing, and full refreshes are run in the background.
+        @param key the key of this metadata in the registry, see replace
+        """
+        if not self.checked:
+            with self.refreshLock:
+                if not self.checked:
+                    self.refresh(conn)
+            return
+        now = time.time()
+        if now - self.created > imagemeta_full_refresh_interval:
+            self.replace(conn, key)
+        elif (now - self.checked > imagemeta_refresh_interval and
+              self.refreshLock.acquire(False)):
+            try:
+                self.refresh(conn)
+            finally:
+                self.refreshLock.release()
+
+    def replace(self, conn, key):
+        """
+        Start reading the metadata from scratch in a background thread, the
+        new metadata replaces this in the registry once it has been read
+        """
+        with self.lock:
+            if self.replacer is not None:
+                return
+            self.replacer = threading.Thread(
+                target=replaceMetadata, args=(conn, key, self),
+                name='imagemeta-%s-%s' % key)
+            self.replacer.daemon = True
+        self.replacer.start()
+
+    def exists(self, iid):
+        return iid in self.owners
+
+    def index(self, field):
+        """
+        Get the inverted index of a field, a dictionary of value: sorted
+        array of keys with that value. Keys are image IDs except for 'chname'
+        where they are channel keys. Each index is built with a single pass
+        over the images when first used after the metadata changes.
+        """
+        with self.lock:
+            if field not in self.inverted:
+                ks = defaultdict(list)
+                if field == 'owner':
+                    for iid, v in self.owners.iteritems():
+                        ks[v].append(iid)
+                elif field == 'dataset':
+                    for iid, v in self.datasets.iteritems():
+                        for did in v:
+                            ks[did].append(iid)
+                elif field == 'plate':
+                    for iid, v in self.plates.iteritems():
+                        ks[v].append(iid)
+                elif field == 'chname':
+                    for iid, v in self.chnames.iteritems():
+                        for c, name in enumerate(v):
+                            # channelKey for a single channel
+                            ks[name].append((iid << 16) + c)
+                else:
+                    raise ValueError('Invalid metadata field: %s' % field)
+                self.inverted[field] = dict(
+                    (v, numpy.unique(numpy.array(k, dtype=numpy.int64)))
+                    for v, k in ks.iteritems())
+            return self.inverted[field]
+
+    def keys(self, field, values):
+        """
+        Get a sorted array of the keys with any of the values of a field,
+        see index
+        """
+        index = self.index(field)
+        arrays = [index[v] for v in values if v in index]
+        if not arrays:
+            return numpy.zeros(0, dtype=numpy.int64)
+        if len(arrays) == 1:
+            return arrays[0]
+        return numpy.unique(numpy.concatenate(arrays))
+
+
+_metadata = {}
+_metadataLock = threading.Lock()
+
+
+def replaceMetadata(conn, key, old):
+    """
+    Read all metadata into a new ImageMetadata, and replace old with it
+    """
+    try:
+        md = ImageMetadata()
+        md.refresh(conn)
+        with _metadataLock:
+            if _metadata.get(key) is old:
+                _metadata[key] = md
+    except Exception:
+        logger.error('Failed to refresh image metadata for %s', key,
+                     exc_info=True)
+        # Keep using the old metadata, and try again after the next interval
+        with old.lock:
+            old.created = time.time()
+            old.replacer = None
+
+
+def getMetadata(conn):
+    """
+    Get the up to date ImageMetadata for the current group and user. What
+    a user can see depends on the group permissions, so each user has their
+    own metadata.
+    """
+    key = (pyslid.database.direct.getCurrentGroupId(conn), conn.getUserId())
+    with _metadataLock:
+        if key not in _metadata:
+            _metadata[key] = ImageMetadata()
+        md = _metadata[key]
+    md.update(conn, key)
+    return md
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Append-only journal of new ContentDB rows
+
+Every update of the pickled ContentDB rewrites the whole file, so adding
+features one image at a time costs O(N^2) I/O, and concurrent writers
+overwrite each other's updates. Instead feature calculation scripts append
+rows to a journal. Each writing process has its own journal file in a
+directory next to the ContentDB, so any number of processes can write at
+the same time.
+
+Each line of a journal file is a JSON object, either
+    {"fids": [feature names]}
+written at the start of every file, or a row
+    {"time": t, "scale": s, "server": ..., "owner": uid,
+     "id": [iid, pixels, channel, zslice, timepoint], "feats": [...]}
+Only complete lines are read, so a reader never sees a partly written row.
+
+Readers (see contentdb) merge the journal into the ContentDB when loading
+it, journal rows replacing ContentDB rows with the same superid. compact()
+folds the journal into the pickled ContentDB with one update per owner and
+scale and then deletes the merged journal files.
+
+Writers hold a shared lock whilst appending. compact() briefly takes an
+exclusive lock to rename the journal files it is going to merge, after which
+writers start new files. Renamed files are still read by readers until
+compaction has finished, and are picked up again by the next compaction if
+it fails.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict, OrderedDict
+
+import pyslid
+from omero_searcher_config import omero_contentdb_path
+
+logger = logging.getLogger('searcher')
+
+JOURNAL_SUFFIX = '.jsonl'
+COMPACTING_SUFFIX = '.compacting'
+
+
+def journalDir(conn, ftset, did=None):
+    """
+    The journal directory for a ContentDB
+    """
+    return groupJournalDir(
+        pyslid.database.direct.getCurrentGroupId(conn), ftset, did)
+
+
+def groupJournalDir(gid, ftset, did=None):
+    """
+    The journal directory for the ContentDB of a group
+    """
+    return os.path.join(omero_contentdb_path, '%s_%s_%s.journal' % (
+            gid, 'all' if did is None else did, ftset))
+
+
+def journalFiles(jdir, suffix=None):
+    """
+    List the journal files in a journal directory, including those being
+    compacted
+    @param suffix optionally only list files ending with this
+    """
+    try:
+        names = os.listdir(jdir)
+    except OSError:
+        return []
+    return [os.path.join(jdir, n) for n in sorted(names) if (
+            n.endswith(JOURNAL_SUFFIX) or n.endswith(COMPACTING_SUFFIX)) and (
+            suffix is None or n.endswith(suffix))]
+
+
+def size(jdir):
+    """
+    The total size in bytes of the journal files in a journal directory
+    """
+    total = 0
+    for path in journalFiles(jdir):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def signature(jdir):
+    """
+    A cheap fingerprint of the contents of a journal, '' if it's empty
+    """
+    sizes = []
+    for path in journalFiles(jdir):
+        try:
+            sizes.append('%s:%d' % (os.path.basename(path),
+                                    os.path.getsize(path)))
+        except OSError:
+            pass
+    if not sizes:
+        return ''
+    return hashlib.sha1('\n'.join(sizes)).hexdigest()
+
+
+class JournalLock(object):
+    """
+    Lock held by writers (shared) and by compaction whilst renaming journal
+    files (exclusive)
+    """
+
+    def __init__(self, jdir, exclusive):
+        self.path = os.path.join(jdir, 'append.lock')
+        self.op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, self.op)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+class JournalWriter(object):
+    """
+    Appends rows to this process's journal file
+    """
+
+    def __init__(self, conn, ftset, did=None):
+        self.dir = journalDir(conn, ftset, did)
+        self.path = os.path.join(self.dir, '%s-%d-%s%s' % (
+                socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8],
+                JOURNAL_SUFFIX))
+
+    def append(self, server, owner, scale, iid, px, c, z, t, fids, feats):
+        """
+        Append a single row
+        """
+        self.write(fids, [(server, owner, scale, iid, px, c, z, t, feats)])
+
+    def write(self, fids, rows):
+        """
+        Append rows, each a tuple
+        (server, owner, scale, iid, px, c, z, t, feats)
+        """
+        now = time.time()
+        lines = [json.dumps({
+                    'time': now,
+                    'scale': float(scale),
+                    'server': server,
+                    'owner': int(owner),
+                    'id': [int(x) for x in (iid, px, c, z, t)],
+                    'feats': [float(f) for f in feats],
+                    }) + '\n'
+                 for server, owner, scale, iid, px, c, z, t, feats in rows]
+
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # Created by another process
+                pass
+        with JournalLock(self.dir, False):
+            # The file may have been renamed by compaction since the last
+            # write, in which case this starts a new one
+            if not os.path.exists(self.path):
+                lines.insert(0, json.dumps({'fids': list(fids)}) + '\n')
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class JournalBuffer(object):
+    """
+    Collects rows in memory and appends them to a JournalWriter with a single
+    write, instead of one locked and synced write per row. A row replaces an
+    earlier buffered row with the same scale and superid.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.fids = None
+        self.rows = OrderedDict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, server, owner, scale, iid, px, c, z, t, fids, feats):
+        """
+        Buffer a single row, arguments as for JournalWriter.append
+        """
+        self.fids = fids
+        k = (float(scale), (iid, px, c, z, t))
+        self.rows.pop(k, None)
+        self.rows[k] = (server, owner, scale, iid, px, c, z, t, feats)
+
+    def flush(self):
+        """
+        Write and forget the buffered rows
+        @return the number of rows written
+        """
+        n = len(self.rows)
+        if n:
+            self.writer.write(self.fids, self.rows.values())
+            self.rows = OrderedDict()
+        return n
+
+
+def readJournal(paths):
+    """
+    Read the complete rows from journal files
+    @return (fids, rows) where rows is a list of row dictionaries sorted by
+    the time they were written
+    """
+    fids = None
+    rows = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                data = f.read()
+        except IOError:
+            # Removed by compaction
+            continue
+        # Ignore a partly written last line
+        for line in data[:data.rfind('\n') + 1].splitlines():
+            try:
+                r = json.loads(line)
+            except ValueError:
+                logger.warn('Invalid line in ContentDB journal %s', path)
+                continue
+            if 'fids' in r:
+                if fids is not None and fids != r['fids']:
+                    logger.warn('Feature IDs in ContentDB journal %s do not '
+                                'match other journal files, ignoring', path)
+                    break
+                fids = r['fids']
+            else:
+                rows.append(r)
+    rows.sort(key=lambda r: r['time'])
+    return fids, rows
+
+
+def contentRows(rows):
+    """
+    Convert journal rows into a dictionary of scale: list of ContentDB rows
+    in the same form as a pickled ContentDB
+    """
+    cdb = defaultdict(list)
+    for r in rows:
+        cdb[r['scale']].append(
+            [None, r['server'], r['owner'], '', '', ''] + r['id'] + r['feats'])
+    return cdb
+
+
+def readRows(jdir):
+    """
+    Read all rows from a journal as a dictionary of scale: ContentDB rows,
+    see contentRows
+    """
+    fids, rows = readJournal(journalFiles(jdir))
+    return contentRows(rows)
+
+
+def compact(conn, ftset, did=None, merged=None):
+    """
+    Merge the journal into the pickled ContentDB and remove duplicates
+    @param merged optional function called with a dictionary of scale: list
+    of the feature rows merged into the ContentDB, once it has been updated
+    @return answer (True if successful)
+    @return Message
+    """
+    jdir = journalDir(conn, ftset, did)
+    if not os.path.isdir(jdir):
+        return True, 'ContentDB journal is empty'
+
+    with open(os.path.join(jdir, 'compact.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # The rows are still read from the journal until the next
+            # compaction
+            return True, 'ContentDB journal is already being compacted'
+
+        with JournalLock(jdir, True):
+            for path in journalFiles(jdir, JOURNAL_SUFFIX):
+                os.rename(path, path + COMPACTING_SUFFIX)
+        paths = journalFiles(jdir, COMPACTING_SUFFIX)
+        fids, rows = readJournal(paths)
+
+        # Only keep the most recent row for each superid
+        latest = OrderedDict()
+        for r in rows:
+            k = (r['scale'], tuple(r['id']))
+            latest.pop(k, None)
+            latest[k] = r
+
+        groups = defaultdict(list)
+        for r in latest.itervalues():
+            groups[(r['server'], r['owner'], r['scale'])].append(r)
+
+        messages = []
+        for (server, owner, scale), rs in groups.iteritems():
+            iid, px, c, z, t = zip(*[r['id'] for r in rs])
+            answer, m = pyslid.database.direct.updateDataset(
+                conn, server, owner, scale, list(iid), list(px), list(c),
+                list(z), list(t), fids, [r['feats'] for r in rs], ftset,
+                did=did)
+            if not answer:
+                return False, (
+                    'Failed to update ContentDB user:%d scale:%e: %s' % (
+                        owner, scale, m))
+            messages.append(m)
+
+        for scale in set(scale for server, owner, scale in groups):
+            answer, m = pyslid.database.direct.removeDuplicates(
+                conn, scale, ftset, did=did)
+            if not answer:
+                return False, 'Failed to remove duplicates scale:%e: %s' % (
+                    scale, m)
+
+        if merged is not None:
+            feats = defaultdict(list)
+            for r in latest.itervalues():
+                feats[r['scale']].append(r['feats'])
+            merged(feats)
+
+        for path in paths:
+            os.remove(path)
+
+    logger.info('Compacted %d ContentDB journal rows from %d files',
+                len(latest), len(paths))
+    return True, 'Merged %d journal rows into the ContentDB' % len(latest)
+
+
+def mergeRows(cdb, rows):
+    """
+    Merge journal rows into a pickled ContentDB, for exporting it
+    @param cdb a pickled ContentDB dictionary, modified
+    @param rows a dictionary of scale: ContentDB rows from readRows, journal
+    rows replace earlier rows with the same superid
+    """
+    for scale, new in rows.iteritems():
+        latest = OrderedDict()
+        for r in cdb.get(scale, []) + new:
+            k = tuple(r[6:11])
+            latest.pop(k, None)
+            latest[k] = r
+        merged = latest.values()
+        # Number the journal rows after the existing rows
+        index = max([r[0] for r in merged if r[0] is not None] or [0])
+        for r in merged:
+            if r[0] is None:
+                index += 1
+                r[0] = long(index)
+        cdb[scale] = merged
+
+
+def discard(conn, ftset, did=None):
+    """
+    Delete the journal, for use when the ContentDB is rebuilt from the
+    feature tables which already include the journal rows
+    """
+    jdir = journalDir(conn, ftset, did)
+    if not os.path.isdir(jdir):
+        return
+    with open(os.path.join(jdir, 'compact.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with JournalLock(jdir, True):
+            for path in journalFiles(jdir):
+                os.remove(path)
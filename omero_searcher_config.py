@@ -7,3 +7,122 @@ omero_contentdb_path = '/OMERO/pyslid.data'
 # List of feature sets to display in the UI, the first will be the default
 enabled_featuresets = ['slf33', 'slf34']
 
+
+# Maximum memory (bytes) used by each OMERO.web process to cache ContentDBs
+# between searches. Least recently used feature sets are evicted first.
+# Set to 0 to disable caching.
+contentdb_cache_max_bytes = 1024 * 1024 * 1024
+
+# Save a memory-mapped columnar copy of each ContentDB alongside the pickled
+# ContentDB so that it can be shared between OMERO.web processes
+contentdb_columnar_store = True
+
+# Load the ContentDBs of all enabled_featuresets in a background thread when
+# each OMERO.web process starts, so the first search doesn't have to
+contentdb_warmup = False
+
+# Searches initially select this many rows more than the number of results
+# requested from the ranking, to allow for results which are removed by
+# filters. More rows are selected if required.
+search_candidate_margin = 100
+
+# Scales of a ContentDB with at least this many rows are given an approximate
+# nearest-neighbour index when the ContentDB is rebuilt or updated by a script.
+# Set to 0 to disable.
+ann_index_min_rows = 100000
+
+# Number of index partitions searched for each reference image, by feature
+# set, for example 16. Higher values are slower but return results closer to
+# an exact search. Feature sets which are missing or set to 0 always use an
+# exact search.
+ann_nprobe = {
+    'slf33': 0,
+    'slf34': 0,
+    }
+
+# Image owners, datasets, plates and channel names used by searches are held
+# in a local index. The index is checked for updates at most once in this many
+# seconds
+imagemeta_refresh_interval = 10
+
+# The local image index is rebuilt this often (seconds) to remove deleted
+# images and links
+imagemeta_full_refresh_interval = 3600
+
+# Number of searches for which ranking scores are cached in each OMERO.web
+# process, so that a search can be repeated with different filters or more
+# results without ranking again. Each entry uses about 9 bytes per ContentDB
+# row. Set to 0 to disable.
+search_result_cache_size = 16
+
+# Run searches from the search page in the background, polling until they
+# finish, instead of within a single web request. The status and results of
+# background searches are saved under omero_contentdb_path, so the polling
+# requests can be handled by any OMERO.web process.
+search_async = False
+
+# Maximum number of background searches run at the same time by each
+# OMERO.web process
+search_job_workers = 2
+
+# Maximum number of background searches waiting to run in each OMERO.web
+# process, further searches are rejected
+search_job_queue_size = 20
+
+# Background searches are kept for this many seconds after they last change.
+# A search which is still waiting or hasn't reported progress by then is
+# assumed to have been lost with its OMERO.web process.
+search_job_max_age = 600
+
+# Number of processes forked by the feature calculation script to calculate
+# features in parallel, this is also the default and the maximum for the
+# script's Worker_Processes parameter
+feature_calculation_processes = 1
+
+# Default number of images after which the feature calculation script checks
+# the size of the ContentDB journal, 0 to only check at the end of a run. See
+# journal_compact_bytes.
+feature_calculation_flush_images = 0
+
+# The feature calculation script only merges the ContentDB journal into the
+# ContentDB and rebuilds the columnar ContentDB once the journal is larger
+# than this many bytes, since each merge rewrites the whole ContentDB. New
+# features are included in searches before they are merged.
+journal_compact_bytes = 64 * 1024 * 1024
+
+# Maximum number of queries in a single request to the batch search API
+search_api_max_queries = 1000
+
+# Number of processes used to score large ContentDB scales in parallel, 0 to
+# score in the OMERO.web process. Only memory-mapped ContentDBs are scored in
+# parallel, see contentdb_columnar_store. The processes are forked from the
+# OMERO.web process when it starts.
+search_shard_processes = 0
+
+# Number of ContentDB rows in each shard scored in parallel, only scales with
+# at least twice this many rows are split
+search_shard_rows = 262144
+
+# Scales with at least pca_min_rows rows are given a projection onto their
+# first pca_dims principal components when the columnar ContentDB is written
+# by the feature calculation and rebuild ContentDB scripts, for example 32.
+# Set either to 0 to disable.
+pca_dims = 0
+pca_min_rows = 100000
+
+# Scales with at least quantization_min_rows rows are also given a compact
+# copy of their normalised features when the columnar ContentDB is written by
+# the feature calculation and rebuild ContentDB scripts:
+# - 'float32': none
+# - 'float16': half precision, half the size of the features
+# - 'sq8': 8-bit scalar quantization, a quarter of the size
+# - 'pq8': 8-bit product quantization with pq_subspaces bytes per row
+# These are used instead of the PCA projection to select the rows to re-score.
+contentdb_quantization = 'float32'
+quantization_min_rows = 100000
+pq_subspaces = 16
+
+# Number of rows selected using the quantized or projected features which are
+# re-scored using all features, for example 5000. Searches which need more
+# results fall back to scoring every row. Set to 0 to always use all features.
+search_rerank_rows = 0
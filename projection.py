@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Principal component projections of normalised ContentDB features
+
+When the columnar store is written by a script, scales with at least
+pca_min_rows rows are given a projection onto their first pca_dims principal
+components, and the projected feature matrix is stored with the other
+columns. Searches can then score every row in the reduced space, which is
+several times cheaper than using all features, and re-score only the best
+rows using all features (see ranking).
+"""
+
+import logging
+
+import numpy
+
+logger = logging.getLogger('searcher')
+
+# Maximum number of rows used to fit the projection
+TRAINING_ROWS = 100000
+
+# Number of rows projected at a time
+CHUNK_ROWS = 16384
+
+
+class PcaProjection(object):
+    """
+    A projection of normalised features onto principal components
+    components is a (dims x features) matrix of orthonormal rows, explained
+    the fraction of the variance of the training rows it retains
+    """
+
+    def __init__(self, mean, components, explained):
+        self.mean = mean
+        self.components = components
+        self.explained = explained
+
+    @property
+    def dims(self):
+        return len(self.components)
+
+    @classmethod
+    def fit(cls, zfeats, dims, seed=0):
+        """
+        Fit a projection to a sample of the rows of a normalised feature
+        matrix
+        """
+        n = len(zfeats)
+        rng = numpy.random.RandomState(seed)
+        if n > TRAINING_ROWS:
+            sample = numpy.sort(rng.choice(n, TRAINING_ROWS, replace=False))
+        else:
+            sample = numpy.arange(n)
+        x = numpy.asarray(zfeats[sample], dtype=numpy.float64)
+        mean = x.mean(axis=0)
+        x -= mean
+        cov = numpy.dot(x.T, x) / max(len(x) - 1, 1)
+        # eigh returns eigenvalues in increasing order
+        evals, evecs = numpy.linalg.eigh(cov)
+        order = numpy.argsort(evals)[::-1][:dims]
+        total = evals.clip(min=0).sum()
+        explained = evals[order].clip(min=0).sum() / total if total else 1.0
+        logger.debug('Fitted %d dimensional projection of %d features, '
+                     'explained variance %.3f', dims, x.shape[1], explained)
+        return cls(mean, evecs[:, order].T.copy(), float(explained))
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as f:
+            return cls(f['mean'], f['components'], float(f['explained']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            numpy.savez(f, mean=self.mean, components=self.components,
+                        explained=self.explained)
+
+    def project(self, x):
+        """
+        Project rows of normalised features, returns a float64 array
+        """
+        return numpy.dot(numpy.asarray(x, dtype=numpy.float64) - self.mean,
+                         self.components.T)
+
+    def projectAll(self, zfeats, out):
+        """
+        Project every row of a normalised feature matrix into out, a chunk
+        at a time
+        """
+        for start in xrange(0, len(zfeats), CHUNK_ROWS):
+            out[start:start + CHUNK_ROWS] = self.project(
+                zfeats[start:start + CHUNK_ROWS])
+        return out
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Compact codes for normalised ContentDB features
+
+When the columnar store is written by a script, every scale can be given a
+copy of its normalised features in a compact form, as selected by
+contentdb_quantization:
+- float16: half precision, 2 bytes per feature
+- sq8: 8-bit scalar quantization, each feature is mapped linearly from its
+  range onto 0-255, 1 byte per feature
+- pq8: 8-bit product quantization, the features are split into
+  pq_subspaces groups and each group is replaced by the index of the nearest
+  of 256 centroids, 1 byte per group
+
+Searches calculate approximate distances from the codes, so only the codes
+need to be read for every row, and then re-score the best rows using the
+full features (see ranking).
+"""
+
+import logging
+
+import numpy
+
+from annindex import kmeans
+
+logger = logging.getLogger('searcher')
+
+# Number of rows encoded at a time
+CHUNK_ROWS = 16384
+
+# Maximum number of rows per centroid used to train product quantization
+TRAINING_ROWS_PER_CENTROID = 64
+
+# Number of centroids in each product quantization subspace
+PQ_CENTROIDS = 256
+
+
+class Codec(object):
+    """
+    Base class for codecs
+    """
+
+    def encodeAll(self, zfeats, out):
+        """
+        Encode every row of a normalised feature matrix into out, a chunk at
+        a time
+        """
+        for start in xrange(0, len(zfeats), CHUNK_ROWS):
+            out[start:start + CHUNK_ROWS] = self.encode(
+                zfeats[start:start + CHUNK_ROWS])
+        return out
+
+
+class DecodingCodec(Codec):
+    """
+    Base class for codecs where distances are calculated by decoding
+    """
+
+    def prepare(self, q):
+        """
+        Prepare float64 query features for distances()
+        """
+        return q, numpy.square(q).sum(axis=1)
+
+    def distances(self, codes, prepared):
+        """
+        Calculate the squared Euclidean distances from each coded row to
+        each query, returns a (rows x queries) array
+        """
+        q, qnorms = prepared
+        z = self.decode(codes)
+        d2 = numpy.dot(z, q.T)
+        d2 *= -2
+        d2 += numpy.square(z).sum(axis=1)[:, numpy.newaxis]
+        d2 += qnorms
+        return d2
+
+
+class Float16Codec(DecodingCodec):
+
+    name = 'float16'
+    dtype = numpy.float16
+
+    @classmethod
+    def train(cls, zfeats):
+        return cls()
+
+    def codeShape(self, zfeats):
+        return zfeats.shape
+
+    def encode(self, x):
+        return numpy.asarray(x, dtype=numpy.float16)
+
+    def decode(self, codes):
+        return numpy.asarray(codes, dtype=numpy.float64)
+
+    def params(self):
+        return {}
+
+
+class ScalarCodec(DecodingCodec):
+    """
+    Each feature is quantized to 256 levels between lo and lo + 255 * step
+    """
+
+    name = 'sq8'
+    dtype = numpy.uint8
+
+    def __init__(self, lo, step):
+        self.lo = lo
+        self.step = step
+
+    @classmethod
+    def train(cls, zfeats):
+        lo = numpy.empty(zfeats.shape[1], dtype=numpy.float64)
+        lo.fill(numpy.inf)
+        hi = -lo
+        for start in xrange(0, len(zfeats), CHUNK_ROWS):
+            chunk = zfeats[start:start + CHUNK_ROWS]
+            lo = numpy.minimum(lo, chunk.min(axis=0))
+            hi = numpy.maximum(hi, chunk.max(axis=0))
+        step = (hi - lo) / 255.0
+        step[step == 0] = 1
+        return cls(lo, step)
+
+    def codeShape(self, zfeats):
+        return zfeats.shape
+
+    def encode(self, x):
+        codes = numpy.rint((numpy.asarray(x, dtype=numpy.float64) - self.lo) /
+                           self.step)
+        return numpy.clip(codes, 0, 255).astype(numpy.uint8)
+
+    def decode(self, codes):
+        return self.lo + codes * self.step
+
+    def params(self):
+        return {'lo': self.lo, 'step': self.step}
+
+
+class ProductCodec(Codec):
+    """
+    centroids has shape (subspaces x PQ_CENTROIDS x subspace-features),
+    features are zero padded to a multiple of the number of subspaces
+    """
+
+    name = 'pq8'
+    dtype = numpy.uint8
+
+    def __init__(self, centroids):
+        self.centroids = centroids
+        self.cnorms = numpy.square(centroids).sum(axis=2)
+
+    @property
+    def subspaces(self):
+        return self.centroids.shape[0]
+
+    def pad(self, x):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        m, k, dsub = self.centroids.shape
+        if x.shape[1] < m * dsub:
+            x = numpy.hstack((x, numpy.zeros((len(x), m * dsub - x.shape[1]))))
+        return x.reshape((len(x), m, dsub))
+
+    @classmethod
+    def train(cls, zfeats, subspaces, seed=0):
+        n, d = zfeats.shape
+        subspaces = min(subspaces, d)
+        dsub = -(-d // subspaces)
+        k = min(PQ_CENTROIDS, n)
+        rng = numpy.random.RandomState(seed)
+        ntrain = min(n, PQ_CENTROIDS * TRAINING_ROWS_PER_CENTROID)
+        sample = numpy.sort(rng.choice(n, ntrain, replace=False))
+        x = numpy.zeros((ntrain, subspaces * dsub), dtype=numpy.float64)
+        x[:, :d] = zfeats[sample]
+        centroids = numpy.zeros((subspaces, PQ_CENTROIDS, dsub))
+        for j in xrange(subspaces):
+            centroids[j, :k] = kmeans(
+                x[:, j * dsub:(j + 1) * dsub], k, seed=seed)
+            # Duplicates of the first centroid are never chosen by argmin
+            centroids[j, k:] = centroids[j, 0]
+        logger.debug('Trained product quantizer with %d subspaces of %d '
+                     'features', subspaces, dsub)
+        return cls(centroids)
+
+    def codeShape(self, zfeats):
+        return (len(zfeats), self.subspaces)
+
+    def encode(self, x):
+        x = self.pad(x)
+        codes = numpy.empty((len(x), self.subspaces), dtype=numpy.uint8)
+        for j in xrange(self.subspaces):
+            d2 = numpy.dot(x[:, j], self.centroids[j].T)
+            d2 *= -2
+            d2 += self.cnorms[j]
+            codes[:, j] = d2.argmin(axis=1)
+        return codes
+
+    def prepare(self, q):
+        """
+        Calculate the squared distance from each query subspace to each
+        centroid, with shape (subspaces x PQ_CENTROIDS x queries)
+        """
+        q = self.pad(q)
+        tables = numpy.empty((self.subspaces, PQ_CENTROIDS, len(q)))
+        for j in xrange(self.subspaces):
+            diff = self.centroids[j][:, numpy.newaxis, :] - q[:, j]
+            tables[j] = numpy.square(diff).sum(axis=2)
+        return tables
+
+    def distances(self, codes, tables):
+        """
+        Approximate the squared distance from each coded row to each query
+        by summing the distances from the query to the row's centroids
+        """
+        d2 = tables[0][codes[:, 0]]
+        for j in xrange(1, self.subspaces):
+            d2 += tables[j][codes[:, j]]
+        return d2
+
+    def params(self):
+        return {'centroids': self.centroids}
+
+
+CODECS = dict((c.name, c) for c in (Float16Codec, ScalarCodec, ProductCodec))
+
+
+def train(mode, zfeats, subspaces):
+    """
+    Create a codec for a normalised feature matrix
+    @param mode one of the names in CODECS
+    """
+    if mode == ProductCodec.name:
+        return ProductCodec.train(zfeats, subspaces)
+    return CODECS[mode].train(zfeats)
+
+
+def save(codec, path):
+    with open(path, 'wb') as f:
+        numpy.savez(f, name=codec.name, **codec.params())
+
+
+def load(path):
+    with numpy.load(path) as f:
+        params = dict((k, f[k]) for k in f.files if k != 'name')
+        return CODECS[str(f['name'])](**params)
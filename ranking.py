@@ -0,0 +1,895 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Vectorised content ranking over a ColumnarContentDB
+
+This reproduces the results of ricerca.content.rankingWrapper, but works on
+the columnar arrays from contentdb instead of lists of ContentDB rows:
+- features are z-score normalised over all rows of the chosen scale, this is
+  precalculated by contentdb
+- the distance from a row to the reference set is the FALCON aggregate
+  (mean(d ** alpha)) ** alpha of the Euclidean distances d to each reference
+- rows are sorted by increasing distance
+- if there are positive and negative references the ranks of the positive
+  ranking and the reversed negative ranking are averaged
+
+Distances to all references are calculated with one matrix product per chunk
+of rows. Only the best rows are sorted: a Ranking uses partial selection to
+find the top k rows and extends this on demand, since most searches only
+display a few tens of results.
+
+Rows excluded by a search filter are not scored, but may still be used as
+references.
+
+If a scale has an IVF index (see annindex) searches may be approximate, only
+scoring rows in the index partitions nearest to the references. If this does
+not return enough results the search falls back to an exact ranking.
+
+Large scales of memory-mapped ContentDBs can be split into fixed size row
+shards scored in parallel by a pool of processes (search_shard_processes).
+Each shard process returns only the rows and scores of its own best n rows,
+which are merged to give the best n rows overall. If more rows are needed
+the shards are scored again for twice as many. Rankings with positive and
+negative references need the scores of every row, so their shard scores are
+concatenated. The pool is forked when OMERO.web starts (see
+startShardPool), before any threads are started; without it scales aren't
+sharded.
+
+Scales with quantized features (see quantize) or a PCA projection (see
+projection) can be ranked approximately by scoring every row using the
+reduced features and then re-scoring the best rows using all features.
+Quantized features are used if a scale has both.
+
+Scores are cached by reference set, so a search repeated with different
+filters or a larger number of results only selects from the cached scores,
+scoring any rows which weren't required before.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import threading
+from collections import defaultdict, OrderedDict
+
+import numpy
+
+from omero_searcher_config import search_result_cache_size
+from omero_searcher_config import search_shard_processes
+from omero_searcher_config import search_shard_rows
+
+logger = logging.getLogger('searcher')
+
+ALPHA = -5
+
+# Number of ContentDB rows processed at a time
+CHUNK_ROWS = 4096
+
+# Maximum number of reference sets scored together by batchRankingWrapper
+CHUNK_QUERIES = 64
+
+# Default number of rows selected from each shard, see rankingWrapper
+SHARD_TOP_ROWS = 1000
+
+
+def falconRows(zfeats, znorms, q, qnorms, bounds, rows=None, alpha=ALPHA):
+    """
+    Calculate the FALCON scores of rows of a normalised feature matrix, see
+    falconScores
+    @param znorms the squared norms of the rows of zfeats, or None to
+    calculate them as required
+    @param q the features of all references as a float64 array
+    @param qnorms the squared norms of q
+    @param bounds the references in set n are q[bounds[n]:bounds[n + 1]]
+    @param rows a slice with start and stop, or a sorted array of row
+    offsets, default all rows
+    @return an array of scores with shape (reference sets x rows)
+    """
+    if rows is None:
+        rows = slice(0, len(zfeats))
+    if isinstance(rows, slice):
+        nrows = rows.stop - rows.start
+    else:
+        nrows = len(rows)
+    scores = numpy.empty((len(bounds) - 1, nrows), dtype=numpy.float64)
+
+    with numpy.errstate(divide='ignore', over='ignore'):
+        for start in xrange(0, nrows, CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, nrows)
+            if isinstance(rows, slice):
+                chunk = slice(rows.start + start, rows.start + end)
+            else:
+                chunk = rows[start:end]
+            z = numpy.asarray(zfeats[chunk], dtype=numpy.float64)
+            if znorms is None:
+                zn = numpy.square(z).sum(axis=1)
+            else:
+                zn = znorms[chunk]
+            # |z - q|^2 = |z|^2 + |q|^2 - 2 z.q
+            d2 = numpy.dot(z, q.T)
+            d2 *= -2
+            d2 += zn[:, numpy.newaxis]
+            d2 += qnorms
+            falconAggregate(d2, bounds, scores[:, start:end], alpha)
+
+    return scores
+
+
+def falconAggregate(d2, bounds, out, alpha=ALPHA):
+    """
+    Calculate FALCON scores from squared distances
+    @param d2 a (rows x references) array of squared distances, overwritten
+    @param out a (reference sets x rows) array for the scores
+    """
+    numpy.maximum(d2, 0, out=d2)
+    # d ** alpha == (d ** 2) ** (alpha / 2)
+    p = numpy.power(d2, alpha / 2.0)
+    for n in xrange(len(bounds) - 1):
+        total = p[:, bounds[n]:bounds[n + 1]].mean(axis=1)
+        # A zero distance gives an infinite total and a score of 0
+        out[n] = numpy.power(total, alpha)
+
+
+def referenceQueries(cdbscale, refsets):
+    """
+    Get the reference features, their squared norms and the bounds of each
+    reference set, see falconRows
+    """
+    allrefs = numpy.concatenate([numpy.asarray(r, dtype=numpy.int64)
+                                 for r in refsets])
+    q = numpy.asarray(cdbscale.zfeats[allrefs], dtype=numpy.float64)
+    qnorms = numpy.square(q).sum(axis=1)
+    bounds = numpy.cumsum([0] + [len(r) for r in refsets])
+    return q, qnorms, bounds
+
+
+def sharded(cdbscale, nrows):
+    """
+    Whether nrows rows of a scale are scored in shards
+    """
+    return bool(shardPool() is not None and cdbscale.zfeatsPath and
+                nrows >= 2 * search_shard_rows)
+
+
+def shardRows(cdbscale, rows=None):
+    """
+    Split the rows of a scale into shards
+    @param rows optional sorted array of rows, default all
+    @return (shards, rest), a list of row slices or arrays of the rows in
+    the zfeatsPath file, and the remaining journal rows
+    """
+    # Only the stored rows are in the zfeatsPath file, any journal rows
+    # after them are scored in this process
+    stored = cdbscale.storedRows
+    if rows is None:
+        shards = [slice(start, min(start + search_shard_rows, stored))
+                  for start in xrange(0, stored, search_shard_rows)]
+        rest = slice(stored, len(cdbscale))
+    else:
+        split = numpy.searchsorted(rows, stored)
+        shards = [rows[start:min(start + search_shard_rows, split)]
+                  for start in xrange(0, split, search_shard_rows)]
+        rest = rows[split:]
+    logger.debug('Scoring %d rows of scale %s in %d shards',
+                 len(cdbscale) if rows is None else len(rows),
+                 cdbscale.scale, len(shards))
+    return shards, rest
+
+
+def rowOffsets(rows):
+    """
+    Convert a slice or array of rows to an array
+    """
+    if isinstance(rows, slice):
+        return numpy.arange(rows.start, rows.stop, dtype=numpy.int64)
+    return rows
+
+
+def selectTop(rows, scores, n):
+    """
+    Get the best n of rows and their scores, in no particular order
+    """
+    top = topRows(scores, n)
+    return rows[top], scores[top]
+
+
+def falconScores(cdbscale, refsets, rows=None, alpha=ALPHA):
+    """
+    Calculate the FALCON distance from every row of a scale to one or more
+    sets of reference rows. Distances to the references in all sets are
+    calculated together. Large memory-mapped scales may be split into shards
+    which are scored in parallel by a process pool, see shardPool. Use
+    falconTop if only the best rows are required.
+    @param refsets a list of lists of row offsets
+    @param rows optional sorted array of the rows to be scored, default all
+    @return a list of score arrays, one for each reference set, with one
+    element for each scored row
+    """
+    zfeats = cdbscale.zfeats
+    q, qnorms, bounds = referenceQueries(cdbscale, refsets)
+    nrows = len(zfeats) if rows is None else len(rows)
+    if sharded(cdbscale, nrows):
+        shards, rest = shardRows(cdbscale, rows)
+        scores = shardPool().map(scoreShard, [
+                (cdbscale.zfeatsPath, shard, q, qnorms, bounds, alpha)
+                for shard in shards])
+        scores.append(falconRows(zfeats, None, q, qnorms, bounds, rest, alpha))
+        scores = numpy.concatenate(scores, axis=1)
+    else:
+        scores = falconRows(zfeats, cdbscale.rowNorms(), q, qnorms, bounds,
+                            rows, alpha)
+    return list(scores)
+
+
+def falconTop(cdbscale, refsets, n, rows=None, alpha=ALPHA):
+    """
+    Find the n rows of a scale with the lowest FALCON distance to each of one
+    or more sets of reference rows. If the scale is split into shards each
+    shard process only returns its best n rows, see falconScores.
+    @param n the number of rows to select
+    @param rows optional sorted array of the rows to select from, default all
+    @return a list of (rows, scores) for each reference set, the offsets and
+    scores of the best n rows in no particular order
+    """
+    zfeats = cdbscale.zfeats
+    q, qnorms, bounds = referenceQueries(cdbscale, refsets)
+    nrows = len(zfeats) if rows is None else len(rows)
+    if not sharded(cdbscale, nrows):
+        scores = falconRows(zfeats, cdbscale.rowNorms(), q, qnorms, bounds,
+                            rows, alpha)
+        rows = rowOffsets(slice(0, nrows)) if rows is None else rows
+        return [selectTop(rows, s, n) for s in scores]
+
+    shards, rest = shardRows(cdbscale, rows)
+    tops = shardPool().map(topShard, [
+            (cdbscale.zfeatsPath, shard, q, qnorms, bounds, alpha, n)
+            for shard in shards])
+    rest = rowOffsets(rest)
+    tops.append([selectTop(rest, s, n) for s in falconRows(
+                zfeats, None, q, qnorms, bounds, rest, alpha)])
+    merged = []
+    for i in xrange(len(refsets)):
+        merged.append(selectTop(
+                numpy.concatenate([t[i][0] for t in tops]),
+                numpy.concatenate([t[i][1] for t in tops]), n))
+    return merged
+
+
+_shardPool = None
+_shardPoolLock = threading.Lock()
+
+
+def startShardPool():
+    """
+    Fork the processes used to score shards if search_shard_processes is
+    set. multiprocessing forks the calling process, which is only safe
+    before it has started any threads, so this is called when OMERO.web
+    starts (see warmup.start).
+    """
+    global _shardPool
+    with _shardPoolLock:
+        if search_shard_processes and _shardPool is None:
+            logger.info('Starting %d shard scoring processes',
+                        search_shard_processes)
+            _shardPool = multiprocessing.Pool(search_shard_processes)
+
+
+def shardPool():
+    """
+    The process pool used to score shards, or None if it hasn't been
+    started
+    """
+    return _shardPool
+
+
+# Memory-mapped feature matrices opened by a shard scoring process
+_shardFeats = OrderedDict()
+
+# Maximum number of memory-mapped feature matrices kept open by each shard
+# scoring process
+SHARD_OPEN_FILES = 8
+
+
+def scoreShard(args):
+    """
+    Score one shard of a scale in a shard scoring process, the normalised
+    features are memory-mapped from the columnar store so the process shares
+    the same page-cache pages as OMERO.web. The file isn't removed whilst
+    OMERO.web is using the ContentDB, see contentdb.GenerationLock.
+    @param args (zfeats-path, rows, q, qnorms, bounds, alpha), see falconRows
+    """
+    path, rows, q, qnorms, bounds, alpha = args
+    zfeats = _shardFeats.pop(path, None)
+    if zfeats is None:
+        zfeats = numpy.load(path, mmap_mode='r')
+    _shardFeats[path] = zfeats
+    while len(_shardFeats) > SHARD_OPEN_FILES:
+        _shardFeats.popitem(last=False)
+    return falconRows(zfeats, None, q, qnorms, bounds, rows, alpha)
+
+
+def topShard(args):
+    """
+    Select the best rows of one shard in a shard scoring process, see
+    scoreShard
+    @param args (zfeats-path, rows, q, qnorms, bounds, alpha, n)
+    @return a list of (rows, scores) of the best n rows of the shard for
+    each reference set
+    """
+    n = args[-1]
+    rows = rowOffsets(args[1])
+    return [selectTop(rows, s, n) for s in scoreShard(args[:-1])]
+
+
+def referenceRows(cdbscale, superids):
+    """
+    Find the ContentDB rows corresponding to a list of superids
+    Superids which aren't in the ContentDB are ignored
+    """
+    rows = []
+    for sid in superids:
+        r = cdbscale.findRow(*[long(x) for x in sid.split('.')])
+        if r is None:
+            logger.warn('Reference %s not found in ContentDB scale %s',
+                        sid, cdbscale.scale)
+        else:
+            rows.append(r)
+    return rows
+
+
+def combinePosandNeg(pos_scores, neg_scores):
+    """
+    Average the rank of each row in the positive ordering and the reversed
+    negative ordering. This requires a full sort of both sets of scores.
+    """
+    n = len(pos_scores)
+    ranks = numpy.empty(n, dtype=numpy.float64)
+    ranks[numpy.argsort(pos_scores, kind='mergesort')] = numpy.arange(n)
+    neg_order = numpy.argsort(neg_scores, kind='mergesort')
+    ranks[neg_order[::-1]] += numpy.arange(n)
+    ranks /= 2
+    return ranks
+
+
+class Ranking(object):
+    """
+    Rows of a ContentDB scale ordered by increasing key, sorted lazily
+    @param keys the sort key for every row, lower is better
+    @param scores the score to display for every row, or None
+    @param candidates the rows which may be returned
+    @param fallback optional function returning a Ranking of all eligible
+    rows, used by batches() if the candidates run out
+    """
+
+    def __init__(self, cdbscale, keys, scores, candidates, fallback=None):
+        self.cdbscale = cdbscale
+        self.keys = keys
+        self.scores = scores
+        self.candidates = candidates
+        self.fallback = fallback
+        self.sorted = numpy.zeros(0, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def top(self, n):
+        """
+        Get the best n rows in rank order
+        """
+        n = min(n, len(self.candidates))
+        if n > len(self.sorted):
+            ckeys = self.keys[self.candidates]
+            if n < len(ckeys):
+                part = numpy.argpartition(ckeys, n - 1)[:n]
+            else:
+                part = numpy.arange(len(ckeys))
+            # Break ties by row order so results are stable
+            order = numpy.lexsort((part, ckeys[part]))
+            self.sorted = self.candidates[part[order]]
+        return self.sorted[:n]
+
+    def batches(self, k, margin, start=0):
+        """
+        Generate successive arrays of rows in rank order, starting with the
+        best k + margin after the first start rows and doubling the number of
+        selected rows each time more are requested, for callers which filter
+        the results further
+        """
+        for rows in self.allBatches(start + k, margin):
+            if start >= len(rows):
+                start -= len(rows)
+                continue
+            yield rows[start:]
+            start = 0
+
+    def allBatches(self, k, margin):
+        """
+        Generate successive arrays of rows in rank order, see batches
+        """
+        n = 0
+        size = k + margin
+        while n < len(self):
+            rows = self.top(size)
+            yield rows[n:]
+            n = len(rows)
+            size *= 2
+
+        if self.fallback is not None:
+            logger.debug('Approximate ranking exhausted after %d rows', n)
+            seen = self.top(n)
+            exact = self.fallback()
+            self.keys = exact.keys
+            self.scores = exact.scores
+            for rows in exact.batches(k, margin):
+                yield rows[~numpy.in1d(rows, seen)]
+
+    def score(self, row):
+        if self.scores is None:
+            return 0
+        return float(self.scores[row])
+
+
+class Scores(object):
+    """
+    The keys and scores of the rows of a ContentDB scale for one set of
+    references. Rows are scored when first required, so that a filtered
+    search only scores the rows which pass the filter, and later searches
+    with other filters only score the remaining rows.
+    Unscored rows have a key of inf.
+    """
+
+    def __init__(self, cdbscale, pos, neg):
+        self.cdbscale = cdbscale
+        self.refsets = [r for r in (pos, neg) if r]
+        # Combined positive and negative rankings can't be partially scored
+        self.combined = bool(pos and neg)
+        self.keys = numpy.empty(len(cdbscale), dtype=numpy.float64)
+        self.keys.fill(numpy.inf)
+        self.scored = numpy.zeros(len(cdbscale), dtype=bool)
+        self.complete = False
+        self.probed = {}
+        self.reduced = {}
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.scored.nbytes
+
+    @property
+    def scores(self):
+        """
+        The scores to display, or None for combined rankings
+        """
+        return None if self.combined else self.keys
+
+    def score(self, rows=None):
+        """
+        Ensure rows (default all) are scored
+        """
+        with self.lock:
+            if self.complete:
+                return
+            if self.combined:
+                scores = falconScores(self.cdbscale, self.refsets)
+                self.keys[:] = combinePosandNeg(scores[0], scores[1])
+                rows = None
+            elif rows is None and not self.scored.any():
+                self.keys[:] = falconScores(self.cdbscale, self.refsets)[0]
+            else:
+                if rows is None:
+                    missing = numpy.flatnonzero(~self.scored)
+                else:
+                    missing = rows[~self.scored[rows]]
+                if len(missing):
+                    self.keys[missing] = falconScores(
+                        self.cdbscale, self.refsets, missing)[0]
+                    self.scored[missing] = True
+            if rows is None:
+                self.scored[:] = True
+                self.complete = True
+
+    def top(self, rows, n):
+        """
+        Ensure the best n of rows (default all) are scored, without scoring
+        all of them, see falconTop
+        @return a sorted array of the scored rows, which includes the best n
+        """
+        with self.lock:
+            if rows is None:
+                rows = numpy.arange(len(self.cdbscale))
+            if not self.complete:
+                missing = rows[~self.scored[rows]]
+                best, keys = falconTop(self.cdbscale, self.refsets, n,
+                                       missing)[0]
+                self.keys[best] = keys
+                self.scored[best] = True
+            return rows[self.scored[rows]]
+
+    def probe(self, nprobe):
+        """
+        Get the rows in the IVF index partitions nearest to the references
+        """
+        with self.lock:
+            if nprobe not in self.probed:
+                self.probed[nprobe] = self.cdbscale.ivf.probe(
+                    self.cdbscale.zfeats[self.refsets[0]], nprobe)
+            return self.probed[nprobe]
+
+    def rerank(self, candidates, n):
+        """
+        Get the best n candidate rows using the reduced features of the
+        scale, see reducedScores
+        """
+        key = (n, hashlib.sha1(candidates).hexdigest())
+        with self.lock:
+            if key not in self.reduced:
+                self.reduced[key] = reducedCandidates(
+                    self.cdbscale, self.refsets[0], candidates, n)
+            return self.reduced[key]
+
+
+class ScoreCache(object):
+    """
+    A least recently used cache of Scores, keyed by the ContentDB, its
+    version, the scale and the references
+    Entries for other versions of a ContentDB are removed when a new entry
+    is stored.
+    """
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(image_refs_dict):
+        """
+        A digest of the reference superids and their pos/neg flags
+        """
+        refs = sorted((k, v[1]) for k, v in image_refs_dict.iteritems())
+        return hashlib.sha1(repr(refs)).hexdigest()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def store(self, key, entry):
+        if self.maxEntries <= 0:
+            return
+        name, version = key[:2]
+        with self.lock:
+            for k in self.entries.keys():
+                if k[0] == name and k[1] != version:
+                    del self.entries[k]
+            self.entries[key] = entry
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+
+_scoreCache = ScoreCache(search_result_cache_size)
+
+
+def getScores(db, cdbscale, image_refs_dict, pos, neg):
+    """
+    Get the cached Scores for a search, or create and cache them
+    """
+    if db.version is None:
+        return Scores(cdbscale, pos, neg)
+    # The first element of the version identifies the ContentDB file, which
+    # is unique to the group, feature set and dataset
+    key = (db.version[0].rsplit('_content_db_', 1)[0], db.version,
+           cdbscale.scale, ScoreCache.fingerprint(image_refs_dict))
+    scores = _scoreCache.lookup(key)
+    if scores is None:
+        scores = Scores(cdbscale, pos, neg)
+        _scoreCache.store(key, scores)
+    else:
+        logger.debug('Using cached scores %s', key)
+    return scores
+
+
+def rankingWrapper(db, image_refs_dict, eligible=None, nprobe=0, rerank=0,
+                   n=0):
+    """
+    Rank a ContentDB against a set of reference images
+    Scores are cached between searches if the version of the ContentDB is
+    known, so repeating a search with different filters or more results
+    doesn't recalculate them
+    @param db a ColumnarContentDB
+    @param image_refs_dict a dictionary of superid: [(scale, ''), pn], where
+    pn is 1 for positive and -1 for negative references
+    @param eligible optional function which takes a ContentDB scale and
+    returns a boolean mask of the rows which may be returned
+    @param nprobe if greater than 0 and the scale has an IVF index only score
+    rows in the nprobe partitions nearest to each reference, falling back to
+    an exact ranking if these are exhausted.
+    @param rerank if greater than 0 and the scale has quantized features or a
+    PCA projection select the best rerank rows using the reduced features,
+    and only score these using all features, falling back to an exact
+    ranking if these are exhausted.
+    Searches with both positive and negative references are always exact.
+    @param n the number of rows expected to be needed, default
+    SHARD_TOP_ROWS. If the scale is scored in shards only the best n rows
+    are scored at first, and then twice as many each time they run out.
+    @return (ranking, dscale), ranking is a Ranking of db.scales[dscale] or
+    None if no references were found in the ContentDB
+    """
+    scale = max(v[0][0] for v in image_refs_dict.itervalues())
+    dscale = db.closestScale(scale)
+    cdbscale = db.scales[dscale]
+    logger.debug('Ranking %d rows at scale %s', len(cdbscale), dscale)
+
+    if len(cdbscale) == 0:
+        return None, dscale
+
+    pos = referenceRows(cdbscale, [
+            k for k, v in image_refs_dict.iteritems() if v[1] == 1])
+    neg = referenceRows(cdbscale, [
+            k for k, v in image_refs_dict.iteritems() if v[1] == -1])
+    if not pos and not neg:
+        return None, dscale
+
+    scores = getScores(db, cdbscale, image_refs_dict, pos, neg)
+
+    eligible = eligibleMask(cdbscale, eligible)
+    if eligible is None:
+        candidates = numpy.arange(len(cdbscale))
+    else:
+        candidates = numpy.flatnonzero(eligible)
+
+    def exactRanking(n=n or SHARD_TOP_ROWS):
+        rows = None if eligible is None else candidates
+        if (not scores.combined and n < len(candidates) and
+            sharded(cdbscale, len(candidates))):
+            best = scores.top(rows, n)
+            if len(best) < len(candidates):
+                return Ranking(cdbscale, scores.keys, scores.scores, best,
+                               lambda: exactRanking(2 * n))
+        scores.score(rows)
+        return Ranking(cdbscale, scores.keys, scores.scores, candidates)
+
+    selected = candidates
+    if nprobe > 0 and cdbscale.ivf is not None and not scores.combined:
+        selected = scores.probe(nprobe)
+        # Journal rows aren't in the index
+        if cdbscale.storedRows < len(cdbscale):
+            selected = numpy.concatenate((selected, numpy.arange(
+                        cdbscale.storedRows, len(cdbscale))))
+        if eligible is not None:
+            selected = selected[eligible[selected]]
+        logger.debug('Approximate ranking of %d rows, nprobe:%d',
+                     len(selected), nprobe)
+
+    if (rerank > 0 and hasReducedFeatures(cdbscale) and
+        not scores.combined and len(selected) > rerank):
+        selected = scores.rerank(selected, rerank)
+        logger.debug('Re-scoring %d rows selected using %s', len(selected),
+                     reducedFeaturesName(cdbscale))
+
+    if selected is not candidates:
+        scores.score(selected)
+        return Ranking(cdbscale, scores.keys, scores.scores, selected,
+                       exactRanking), dscale
+
+    return exactRanking(), dscale
+
+
+def eligibleMask(cdbscale, eligible=None):
+    """
+    Get a boolean mask of the rows of a scale which may be returned, or None
+    if any row may be returned. Rows replaced by journal rows are excluded.
+    @param eligible optional function which takes a ContentDB scale and
+    returns a boolean mask of the rows which may be returned
+    """
+    mask = None if eligible is None else eligible(cdbscale)
+    if cdbscale.live is not None:
+        mask = cdbscale.live if mask is None else mask & cdbscale.live
+    return mask
+
+
+def topRows(keys, n):
+    """
+    Get the offsets of the n lowest keys, in no particular order
+    """
+    if n >= len(keys):
+        return numpy.arange(len(keys))
+    return numpy.argpartition(keys, n - 1)[:n]
+
+
+def hasReducedFeatures(cdbscale):
+    """
+    Whether a scale has quantized or projected features for approximate
+    rankings
+    """
+    return cdbscale.codes is not None or cdbscale.pfeats is not None
+
+
+def reducedFeaturesName(cdbscale):
+    """
+    A description of the reduced features of a scale
+    """
+    if cdbscale.codes is not None:
+        return '%s quantized features' % cdbscale.codec.name
+    return '%d dimensional projection' % cdbscale.pca.dims
+
+
+def codeRows(codec, codes, q, bounds, rows, alpha=ALPHA):
+    """
+    Calculate approximate FALCON scores of rows from quantized features, see
+    falconRows
+    @param codec the codec from quantize used to encode codes
+    @param rows a sorted array of row offsets
+    """
+    prepared = codec.prepare(q)
+    scores = numpy.empty((len(bounds) - 1, len(rows)), dtype=numpy.float64)
+    with numpy.errstate(divide='ignore', over='ignore'):
+        for start in xrange(0, len(rows), CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, len(rows))
+            d2 = codec.distances(codes[rows[start:end]], prepared)
+            falconAggregate(d2, bounds, scores[:, start:end], alpha)
+    return scores
+
+
+def reducedScores(cdbscale, refs, rows):
+    """
+    Calculate approximate FALCON scores of rows using the quantized features
+    of a scale, or otherwise its PCA projection
+    @param refs a list of reference row offsets
+    @param rows a sorted array of row offsets
+    """
+    q = numpy.asarray(cdbscale.zfeats[refs], dtype=numpy.float64)
+    if cdbscale.codes is not None:
+        return codeRows(cdbscale.codec, cdbscale.codes, q, [0, len(refs)],
+                        rows)[0]
+    q = cdbscale.pca.project(q)
+    return falconRows(cdbscale.pfeats, None, q, numpy.square(q).sum(axis=1),
+                      [0, len(refs)], rows)[0]
+
+
+def reducedCandidates(cdbscale, refs, rows, n):
+    """
+    Select the best n of rows using the reduced features of a scale. Journal
+    rows don't have reduced features so are always selected.
+    @return a sorted array of row offsets
+    """
+    split = numpy.searchsorted(rows, cdbscale.storedRows)
+    rows, journalRows = rows[:split], rows[split:]
+    scores = reducedScores(cdbscale, refs, rows)
+    return numpy.concatenate((numpy.sort(rows[topRows(scores, n)]),
+                              journalRows))
+
+
+def reducedRecall(cdbscale, rerank, k=10, queries=20, seed=0):
+    """
+    Estimate the recall of rankings using the reduced features of a scale
+    compared with exact rankings, for queries with a single random reference
+    @return (recall of the top k rows using only the reduced features,
+    recall of the top k rows after re-scoring the best rerank rows)
+    """
+    if cdbscale.stored is not None:
+        cdbscale = cdbscale.stored
+    rng = numpy.random.RandomState(seed)
+    refs = rng.choice(len(cdbscale), min(queries, len(cdbscale)),
+                      replace=False)
+    rows = numpy.arange(len(cdbscale))
+    exact = falconScores(cdbscale, [[r] for r in refs])
+    k = min(k, len(cdbscale))
+    reduced = reranked = 0
+    for r, keys in zip(refs, exact):
+        truth = set(topRows(keys, k))
+        scores = reducedScores(cdbscale, [r], rows)
+        reduced += len(truth.intersection(topRows(scores, k)))
+        selected = topRows(scores, rerank)
+        reranked += len(truth.intersection(
+                selected[topRows(keys[selected], k)]))
+    total = float(k * len(refs))
+    return reduced / total, reranked / total
+
+
+def referenceScale(db, superids):
+    """
+    Find the largest scale of a ContentDB containing any of the superids,
+    or None
+    """
+    for scale in sorted(db.scales.keys(), reverse=True):
+        cdbscale = db.scales[scale]
+        for sid in superids:
+            row = cdbscale.findRow(*[long(x) for x in sid.split('.')])
+            if row is not None:
+                return scale
+    return None
+
+
+def batchRankingWrapper(db, queries, numret, eligible=None):
+    """
+    Rank a ContentDB against many independent sets of reference images
+    Queries at the same scale are scored together, CHUNK_QUERIES at a time,
+    so the distances to all of their references are calculated in one pass
+    over the ContentDB
+    @param db a ColumnarContentDB
+    @param queries a list of (scale, refs), refs is a dictionary of
+    superid: pn where pn is 1 for positive and -1 for negative references.
+    If scale is None the largest scale containing a reference is used.
+    @param numret the number of results for each query
+    @param eligible optional function which takes a ContentDB scale and
+    returns a boolean mask of the rows which may be returned
+    @return a list of (superids, scores, dscale) for each query, superids is
+    None if the references weren't found, scores is None if the query has
+    positive and negative references
+    """
+    results = [(None, None, None)] * len(queries)
+    groups = defaultdict(list)
+    for i, (scale, refs) in enumerate(queries):
+        if scale is None:
+            dscale = referenceScale(db, refs.keys())
+            if dscale is None:
+                continue
+        else:
+            dscale = db.closestScale(scale)
+        cdbscale = db.scales[dscale]
+        pos = referenceRows(
+            cdbscale, [k for k, v in refs.iteritems() if v == 1])
+        neg = referenceRows(
+            cdbscale, [k for k, v in refs.iteritems() if v == -1])
+        if pos or neg:
+            groups[dscale].append((i, pos, neg))
+        else:
+            results[i] = (None, None, dscale)
+
+    for dscale, group in groups.iteritems():
+        cdbscale = db.scales[dscale]
+        mask = eligibleMask(cdbscale, eligible)
+        if mask is None:
+            candidates = numpy.arange(len(cdbscale))
+        else:
+            candidates = numpy.flatnonzero(mask)
+        logger.debug('Batch ranking %d queries against %d of %d rows at '
+                     'scale %s', len(group), len(candidates), len(cdbscale),
+                     dscale)
+
+        for start in xrange(0, len(group), CHUNK_QUERIES):
+            chunk = group[start:start + CHUNK_QUERIES]
+            refsets = [r for i, pos, neg in chunk for r in (pos, neg) if r]
+            if not any(pos and neg for i, pos, neg in chunk):
+                rows = None if mask is None else candidates
+                for (i, pos, neg), (best, keys) in zip(chunk, falconTop(
+                        cdbscale, refsets, numret, rows)):
+                    order = numpy.lexsort((best, keys))
+                    results[i] = (cdbscale.superids(best[order]),
+                                  [float(k) for k in keys[order]], dscale)
+                continue
+
+            if mask is None:
+                # Combined rankings need every row to be scored
+                allscores = iter(falconScores(cdbscale, refsets))
+            else:
+                allscores = iter(falconScores(cdbscale, refsets, candidates))
+
+            def nextScores():
+                scores = next(allscores)
+                if len(scores) == len(cdbscale):
+                    return scores
+                keys = numpy.empty(len(cdbscale), dtype=numpy.float64)
+                keys.fill(numpy.inf)
+                keys[candidates] = scores
+                return keys
+
+            for i, pos, neg in chunk:
+                if pos and neg:
+                    keys = combinePosandNeg(nextScores(), nextScores())
+                    ranked = Ranking(cdbscale, keys, None, candidates)
+                else:
+                    keys = nextScores()
+                    ranked = Ranking(cdbscale, keys, keys, candidates)
+                rows = ranked.top(numret)
+                scores = None
+                if ranked.scores is not None:
+                    scores = [ranked.score(r) for r in rows]
+                results[i] = (cdbscale.superids(rows), scores, dscale)
+
+    return results
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Bitmap indices for filtering ContentDB rows before ranking
+
+Searches can be restricted by channel index, owner, dataset, plate and
+channel name. Each field of a filter corresponds to a packed bitmap with one
+bit per row of a ContentDB scale, and a filter is evaluated by AND-ing the
+bitmaps of the fields together.
+
+Channel indices come from the ContentDB, owners, datasets, plates and channel
+names from the local image metadata index (see imagemeta). The bitmap of a
+field is calculated by looking up the images with any of the allowed values
+in the inverted index of the field, and then matching the rows against all
+of them at once. The most recently used ROW_BITMAPS bitmaps are stored with
+the ContentDB scale, so they are discarded when the ContentDB changes. They
+are also discarded when the metadata index changes.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from imagemeta import channelKey
+
+logger = logging.getLogger('searcher')
+
+# Maximum number of field bitmaps kept for each ContentDB scale, each takes
+# one bit per row
+ROW_BITMAPS = 32
+
+
+class RowBitmaps(object):
+    """
+    Packed bitmaps over the rows of a ContentDB scale, created on demand
+    """
+
+    def __init__(self, cdbscale, metadata):
+        self.cdbscale = cdbscale
+        self.metadata = metadata
+        self.generation = metadata.generation
+        self.bitmaps = OrderedDict()
+        self.lock = threading.Lock()
+
+    def anyOf(self, field, values):
+        """
+        Get the bitmap of rows where field has any of the values
+        """
+        k = (field, tuple(sorted(set(values))))
+        with self.lock:
+            bits = self.bitmaps.pop(k, None)
+            if bits is None:
+                bits = numpy.packbits(self.rowMask(field, k[1]))
+            self.bitmaps[k] = bits
+            while len(self.bitmaps) > ROW_BITMAPS:
+                self.bitmaps.popitem(last=False)
+            return bits
+
+    def rowMask(self, field, values):
+        s = self.cdbscale
+        if not values:
+            return numpy.zeros(len(s), dtype=bool)
+        if field == 'c':
+            return numpy.in1d(s.c, values)
+        keys = self.metadata.keys(field, values)
+        if field == 'chname':
+            return numpy.in1d(channelKey(s.iid, s.c), keys)
+        return numpy.in1d(s.iid, keys)
+
+    def mask(self, channels, owners, datasets, plates, chnames):
+        """
+        Get a boolean mask of the rows which pass all filters. Rows must be
+        in one of the datasets or one of the plates. A filter which is None
+        doesn't restrict the rows, if only one of datasets and plates is None
+        it's treated as empty.
+        """
+        bits = numpy.empty((len(self.cdbscale) + 7) // 8, dtype=numpy.uint8)
+        bits.fill(0xff)
+        if channels is not None:
+            bits &= self.anyOf('c', channels)
+        if owners is not None:
+            bits &= self.anyOf('owner', owners)
+        if datasets is not None or plates is not None:
+            bits &= (self.anyOf('dataset', datasets or []) |
+                     self.anyOf('plate', plates or []))
+        if chnames is not None:
+            bits &= self.anyOf('chname', chnames)
+        return numpy.unpackbits(bits)[:len(self.cdbscale)].astype(bool)
+
+
+def getBitmaps(md, cdbscale):
+    """
+    Get the RowBitmaps for a ContentDB scale and the current metadata
+    @param md the ImageMetadata for the group
+    """
+    bitmaps = cdbscale.bitmaps
+    if (bitmaps is None or bitmaps.metadata is not md or
+        bitmaps.generation != md.generation):
+        bitmaps = RowBitmaps(cdbscale, md)
+        cdbscale.bitmaps = bitmaps
+    return bitmaps
+
+
+def filterMask(md, cdbscale, channels, owners, datasets, plates, chnames):
+    """
+    Get a boolean mask of the rows of a ContentDB scale which pass a search
+    filter, see RowBitmaps.mask
+    """
+    return getBitmaps(md, cdbscale).mask(
+        channels, owners, datasets, plates, chnames)
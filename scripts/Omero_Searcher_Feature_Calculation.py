@@ -3,199 +3,280 @@ from omero.util import script_utils
 import omero.model
 from omero.rtypes import rstring, rlong
 from datetime import datetime
-import itertools
+from collections import OrderedDict
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
 import sys
 
 import pyslid
 from omeroweb.omero_searcher.omero_searcher_config import omero_contentdb_path
 from omeroweb.omero_searcher.omero_searcher_config import enabled_featuresets
+from omeroweb.omero_searcher.omero_searcher_config import feature_calculation_processes
+from omeroweb.omero_searcher.omero_searcher_config import feature_calculation_flush_images
+from omeroweb.omero_searcher.omero_searcher_config import journal_compact_bytes
 pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
+from omeroweb.omero_searcher import contentdb
+from omeroweb.omero_searcher import journal
+from omeroweb.omero_searcher.featurecalc import IDX_OFFSET
+from omeroweb.omero_searcher.featurecalc import EXISTING_BATCH_IMAGES
+from omeroweb.omero_searcher.featurecalc import existingFeatures
+from omeroweb.omero_searcher.featurecalc import extractFeatures
+from omeroweb.omero_searcher.featurecalc import imageGenerator
 
 
-# 0 or 1 based indexing in the UI?
-IDX_OFFSET = 0
-
 supportedDataTypes = ['Project', 'Dataset', 'Image',
                       'Screen', 'Plate', 'PlateAcquisition', 'Well']
 
 
-def listExistingCZTS(conn, imageId, ftset):
+class Checkpoint(object):
     """
-    List the available CZT and scales for features associated with an image
-    feature table.
-    Returns a list of tuples (C, Z, T, scale)
+    Records the images processed by a feature calculation run, so that if the
+    script fails a run with the same parameters resumes after the last
+    processed image. New ContentDB rows are written to the journal as each
+    image is processed, before it is recorded here, so the journal holds the
+    pending rows and the checkpoint only needs to record which images are
+    done.
+    Each line is JSON {"iid": image-id, "superids": [superids added]}. The
+    checkpoint is removed when the run finishes.
     """
-    try:
-        ftnames, ftvalues = pyslid.features.get(
-            conn, 'vector', imageId, set=ftset)
-        return [r[1:5] for r in ftvalues]
-    except pyslid.utilities.PyslidException:
-        return []
 
-
-def extractFeaturesOneChannel(conn, image, scale, ftset, scaleSet,
-                              channels, zslice, timepoint,
-                              disableCdb):
+    def __init__(self, conn, params):
+        key = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+        gid = pyslid.database.direct.getCurrentGroupId(conn)
+        self.path = os.path.join(
+            omero_contentdb_path, 'checkpoints',
+            '%s_%s_%s.checkpoint' % (gid, params['ftset'], key[:16]))
+
+    def processed(self):
+        """
+        The IDs of the images processed by a previous run
+        """
+        try:
+            with open(self.path) as f:
+                data = f.read()
+        except IOError:
+            return set()
+        done = set()
+        # Ignore a partly written last line
+        for line in data[:data.rfind('\n') + 1].splitlines():
+            try:
+                done.add(json.loads(line)['iid'])
+            except (ValueError, KeyError):
+                pass
+        return done
+
+    def record(self, imageId, superids):
+        """
+        Record a processed image, may be called by several processes
+        """
+        line = json.dumps({'iid': imageId, 'superids': superids}) + '\n'
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            # Already exists
+            pass
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RecordingJournal(journal.JournalBuffer):
     """
-    Calculate features for one image, link to the image, save to the ContentDB.
-    @param scaleSet a read write parameter, calculated scales should be
-    appended to this set so that a single removeDuplicates call can be made at
-    the end.
+    Buffers the rows of an image for a journal.JournalWriter, so they are
+    written together, remembering their superids
     """
-    message = ''
-    imageId = image.getId()
-    pixels = 0
 
-    mid = 'image:%d c:%s z:%d t:%d' % (imageId, channels, zslice, timepoint)
+    def take(self):
+        """
+        Write the rows appended since the last call
+        @return their superids
+        """
+        superids = ['%d.%d.%d.%d.%d' % k[1] for k in self.rows]
+        self.flush()
+        return superids
 
-    print 'Calculating features ftset:%s scale:%e %s' % (ftset, scale, mid)
-    try:
-        [fids, features, scalec] = pyslid.features.calculate(
-            conn, imageId, scale, ftset, True, None,
-            pixels, channels, zslice, timepoint, debug=True)
-    except pyslid.utilities.PyslidException as e:
-        m = 'Feature calculation failed for %s\nException:%s\n' % (mid, e)
-        sys.stderr.write(m)
-        return message + m
 
-    if features is None:
-        m = 'Feature calculation failed for %s\n' % mid
+def calculateImage(conn, image, existing, checkpoint, cdbJournal, fargs):
+    """
+    Calculate features for one image, recording it in the checkpoint if
+    there were no errors
+    @param cdbJournal a RecordingJournal
+    @param fargs the extractFeatures arguments between image and cdbJournal
+    """
+    print 'Processing image id:%d' % image.getId()
+    msg = extractFeatures(conn, image, *(fargs + (cdbJournal, existing)))
+    try:
+        superids = cdbJournal.take()
+    except (IOError, OSError) as e:
+        m = 'Failed to update ContentDB with image:%d : %s\n' % (
+            image.getId(), e)
         sys.stderr.write(m)
-        return message + m
+        return msg + m + '\n'
+    if not msg:
+        checkpoint.record(image.getId(), superids)
+    return msg + '\n'
 
-    # Create an individual OMERO.table for this image
-    #print fids
-    #print features
-    answer = pyslid.features.link(
-        conn, imageId, scale, fids, features, ftset, field=True, rid=None,
-        pixels=0, channel=channels[0], zslice=zslice, timepoint=timepoint)
 
-    if answer:
-        print 'Extracted features from %s' % mid
-    else:
-        m = 'Failed to link features to %s\n' % mid
+def flushContentDB(conn, ftset):
+    """
+    If the journal is larger than journal_compact_bytes merge it into the
+    ContentDB, and regenerate the columnar ContentDB with its approximate
+    search indices now rather than on the first search. Smaller journals are
+    left for searches to read, since merging rewrites the whole ContentDB.
+    @return (False if the journal should have been merged but wasn't, error
+    messages)
+    """
+    size = journal.size(journal.journalDir(conn, ftset))
+    if size <= journal_compact_bytes:
+        print 'Leaving %d bytes of new features in the journal' % size
+        return True, ''
+
+    a, msg = contentdb.compactJournal(conn, ftset)
+    print msg
+    if not a:
+        m = 'Failed to compact ContentDB journal: %s\n' % msg
         sys.stderr.write(m)
-        return message + m
-
-    if disableCdb:
-        print 'ContentDB update disabled'
-        return message
-
-    # Create the global contentDB
-    # TODO: Implement this per-dataset level (already supported by PySLID)
-    # TODO: Set servername, change update parameter from username to userid
-    server = 'NA'
-    # Username can change, UserId should be constant
-    username = image.getOwner().getId()
-    try:
-        answer, um = pyslid.database.direct.update(
-            conn, server, username, scale,
-            imageId, pixels, channels[0], zslice, timepoint,
-            fids, features, ftset)
-        if answer:
-            scaleSet.add(scale)
-            return message
+        return False, m
 
-    except omero.SecurityViolation as e:
-        # Ignore e.serverStackTrace in client message
-        um = '%s %s' % (e.serverExceptionClass, e.message)
-
-    m = 'Failed to update ContentDB with %s : %s\n' % (mid, um)
+    a, msg = contentdb.rebuildStore(conn, ftset)
+    if a:
+        return True, ''
+    m = 'Failed to save columnar ContentDB: %s\n' % msg
     sys.stderr.write(m)
-    return message + m
+    return True, m
 
 
-def extractFeatures(conn, image, scale, ftset, scaleSet,
-                    channels, zselect, tselect, recalc, disableCdb):
+class WorkerPool(object):
     """
-    Extract features for the requested channel(s)
+    The feature calculation worker processes. These are forked before the
+    script connects to OMERO, since a process using Ice can't safely be
+    forked, and each worker joins the script's session with its own client
+    (see calculateImages). The number of processes running at the same time
+    is limited by a semaphore shared with the workers, so a run can use fewer
+    processes than were forked.
     """
 
-    message = ''
-    imageId = image.getId()
+    def __init__(self, processes):
+        self.processes = processes
+        self.slots = multiprocessing.Semaphore(processes)
+        self.pool = multiprocessing.Pool(
+            processes, initWorker, (self.slots,))
 
-    if recalc:
-        existing = []
-    else:
-        existing = listExistingCZTS(conn, imageId, ftset)
+    def imap_unordered(self, fn, args, processes):
+        """
+        Run fn on each of args using at most processes workers
+        """
+        # Hold the slots of the unused workers
+        held = max(0, self.processes - processes)
+        for n in xrange(held):
+            self.slots.acquire()
+        try:
+            for r in self.pool.imap_unordered(fn, args):
+                yield r
+        finally:
+            for n in xrange(held):
+                self.slots.release()
 
-    if not zselect[0]:
-        zslice = image.getSizeZ() / 2
-    else:
-        if (zselect[1] < IDX_OFFSET or
-            zselect[1] >= image.getSizeZ() + IDX_OFFSET):
-            m = 'Z-slice %d not found in Image id:%d\n' % (zselect[1], imageId)
-            sys.stderr.write(m)
-            return message + m
-        zslice = zselect[1] - IDX_OFFSET
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
-    if not tselect[0]:
-        timepoint = image.getSizeT() / 2
-    else:
-        if (tselect[1] < IDX_OFFSET or
-            tselect[1] >= image.getSizeT() + IDX_OFFSET):
-            m = 'Timepoint %d not found in Image id:%d\n' % (
-                tselect[1], imageId)
-            sys.stderr.write(m)
-            return message + m
-        timepoint = tselect[1] - IDX_OFFSET
 
-    allChannels = not channels[0]
+# The WorkerPool semaphore in a worker process
+_slots = None
 
-    if allChannels:
-        readoutCh = range(image.getSizeC())
-    else:
-        if (channels[1] < IDX_OFFSET or
-            channels[1] >= image.getSizeC() + IDX_OFFSET):
-            m = 'Channel %d not found in Image id:%d\n' % (channels[1], imageId)
-            sys.stderr.write(m)
-            return message + m
-        readoutCh = [channels[1] - IDX_OFFSET]
 
-    if ftset == 'slf34':
-        if (channels[2] < IDX_OFFSET or
-            channels[2] >= image.getSizeC() + IDX_OFFSET):
-            m = 'Channel %d not found in Image id:%d\n' % (channels[2], imageId)
-            sys.stderr.write(m)
-            return message + m
-        otherChs = [channels[2] - IDX_OFFSET]
-    else:
-        otherChs = []
+def initWorker(slots):
+    global _slots
+    _slots = slots
 
-    for c in readoutCh:
-        chs = [c] + otherChs
 
-        if (c, zslice, timepoint, scale) in existing:
-            print 'Features already present for %d %d.%d.%d (%e)' % (
-                imageId, c, zslice, timepoint, scale)
-        else:
-            message += extractFeaturesOneChannel(
-                conn, image, scale, ftset, scaleSet, chs, zslice, timepoint,
-                disableCdb)
+def calculateImages(args):
+    """
+    Calculate features for a slice of the images in a worker process, using
+    a new client joined to the script's session. Rows are written to the
+    worker's own journal file, the parent process updates the ContentDB.
+    @param args (client properties, session key, image IDs, Checkpoint,
+    extractFeatures arguments between image and cdbJournal)
+    @return (message, scales calculated, number of images)
+    """
+    with _slots:
+        return calculateSlice(*args)
 
-    return message
+
+def calculateSlice(props, sessionKey, imageIds, checkpoint, fargs):
+    """
+    Calculate features for a slice of the images, see calculateImages
+    """
+    scale, ftset, scaleSet, channels, zselect, tselect, recalc, disableCdb = (
+        fargs)
+    message = ''
+    client = omero.client(pmap=props)
+    try:
+        client.joinSession(sessionKey)
+        conn = omero.gateway.BlitzGateway(client_obj=client)
+        cdbJournal = RecordingJournal(journal.JournalWriter(conn, ftset))
+        for image, existing in existingFeatures(
+            conn, conn.getObjects('Image', imageIds), ftset, recalc):
+            message += calculateImage(
+                conn, image, existing, checkpoint, cdbJournal, fargs)
+    except Exception as e:
+        m = 'Feature calculation worker failed: %s\n' % e
+        sys.stderr.write(m)
+        message += m
+    finally:
+        # Only detaches from the session, which is still used by the script
+        client.closeSession()
+    return message, sorted(scaleSet), len(imageIds)
 
 
-def imageGenerator(parent):
+def calculateInPool(client, conn, pool, imageIds, processes, flushImages,
+                    checkpoint, scaleSet, fargs):
     """
-    Returns a sequence of images from one or more containers
+    Calculate features for images using a pool of worker processes, each
+    slice of images with its own session, checking whether to merge the
+    journal into the ContentDB every flushImages images
+    @param pool the WorkerPool
+    @param fargs the extractFeatures arguments between image and cdbJournal
     """
-    if isinstance(parent, list):
-        for par in parent:
-            for im in imageGenerator(par):
-                yield im
-    elif parent.OMERO_CLASS == 'Image':
-        yield parent
-    elif parent.OMERO_CLASS == 'WellSample':
-        yield parent.getImage()
-    else:
-        print '%s: %d' % (parent.OMERO_CLASS, parent.id)
-        for ch in parent.listChildren():
-            for im in imageGenerator(ch):
-                yield im
+    ftset = fargs[1]
+    size = max(1, min(EXISTING_BATCH_IMAGES, -(-len(imageIds) // processes)))
+    slices = [imageIds[n:n + size] for n in xrange(0, len(imageIds), size)]
+    print 'Calculating features for %d images using %d processes' % (
+        len(imageIds), processes)
+
+    props = client.getPropertyMap()
+    sessionKey = client.getSessionId()
+    message = ''
+    pending = 0
+    for msg, scales, n in pool.imap_unordered(calculateImages, [
+            (props, sessionKey, s, checkpoint, fargs) for s in slices],
+            processes):
+        message += msg
+        scaleSet.update(scales)
+        pending += n
+        if flushImages and scaleSet and pending >= flushImages:
+            message += flushContentDB(conn, ftset)[1]
+            pending = 0
+    return message
 
 
-def processImages(client, scriptParams):
+def processImages(client, scriptParams, pool=None):
+    """
+    @param pool the WorkerPool, or None to calculate features in this
+    process
+    """
     message = ''
 
     # for params with default values, we can get the value directly
@@ -216,16 +297,23 @@ def processImages(client, scriptParams):
         recalc = scriptParams['Recalculate_Existing_Features']
         scale = float(scriptParams['Scale'])
         disableCdb = scriptParams['Disable_ContentDB_Update']
+        processes = min(feature_calculation_processes, scriptParams.get(
+                'Worker_Processes', feature_calculation_processes))
+        flushImages = scriptParams.get(
+            'Flush_Images', feature_calculation_flush_images)
     else:
         recalc = False
         scale = 1.0
         disableCdb = False
+        processes = feature_calculation_processes
+        flushImages = feature_calculation_flush_images
 
     try:
         nimages = 0
         scaleSet = set()
 
         conn = omero.gateway.BlitzGateway(client_obj=client)
+        cdbJournal = RecordingJournal(journal.JournalWriter(conn, ftset))
 
         # Get the objects
         objects, logMessage = script_utils.getObjects(conn, scriptParams)
@@ -243,25 +331,53 @@ def processImages(client, scriptParams):
             sys.stderr.write(m)
             return message + m
 
-        images = imageGenerator(objects)
-        for image in images:
-            print 'Processing image id:%d' % image.getId()
-            msg = extractFeatures(
-                conn, image, scale, ftset, scaleSet,
-                channels, zselect, tselect, recalc, disableCdb)
-            message += msg + '\n'
-
-        # Finally tidy up by removing duplicates
-        for s in scaleSet:
-            print 'Removing duplicates from scale:%g' % s
-            a, msg = pyslid.database.direct.removeDuplicates(
-                conn, s, ftset, did=None)
-            print msg
-            if not a:
-                m = 'Failed to remove duplicates scale:%g\n %s' % (s, msg)
-                sys.stderr.write(m)
-                message += m
-
+        checkpoint = Checkpoint(conn, {
+                'type': dataType, 'ids': sorted(ids), 'ftset': ftset,
+                'channels': channels, 'z': zselect, 't': tselect,
+                'scale': scale, 'recalc': recalc, 'disableCdb': disableCdb})
+        done = checkpoint.processed()
+        if done:
+            m = 'Resuming, skipping %d images processed by a previous run\n' % (
+                len(done))
+            print m
+            message += m
+        images = (im for im in imageGenerator(objects)
+                  if im.getId() not in done)
+
+        fargs = (scale, ftset, scaleSet, channels, zselect, tselect, recalc,
+                 disableCdb)
+        if processes > 1 and pool is not None:
+            imageIds = list(OrderedDict.fromkeys(im.getId() for im in images))
+            # Worker processes collect their own scales
+            message += calculateInPool(
+                client, conn, pool, imageIds, processes, flushImages,
+                checkpoint, scaleSet, fargs[:2] + (set(),) + fargs[3:])
+        else:
+            pending = 0
+            for image, existing in existingFeatures(
+                conn, images, ftset, recalc):
+                message += calculateImage(
+                    conn, image, existing, checkpoint, cdbJournal, fargs)
+                pending += 1
+                if flushImages and scaleSet and pending >= flushImages:
+                    message += flushContentDB(conn, ftset)[1]
+                    pending = 0
+
+        # Finally fold the journal, including rows from any other feature
+        # calculation processes or an interrupted run, into the ContentDB if
+        # it has grown large enough. Otherwise the rows stay in the journal,
+        # where searches already include them, until a later run or the
+        # Rebuild ContentDB script merges them.
+        updated = scaleSet or done
+        flushed = True
+        if updated:
+            flushed, m = flushContentDB(conn, ftset)
+            message += m
+
+        # The journal still holds the new rows if compaction failed, they
+        # will be merged by the next run
+        if flushed:
+            checkpoint.remove()
 
     except:
         print message
@@ -274,6 +390,11 @@ def runScript():
     The main entry point of the script, as called by the client via the scripting service, passing the required parameters. 
     """
 
+    # The workers must be forked before connecting to OMERO
+    pool = None
+    if feature_calculation_processes > 1:
+        pool = WorkerPool(feature_calculation_processes)
+
     client = scripts.client(
         'OMERO.searcher Feature Calculation',
         'Calculate and link features',
@@ -354,12 +475,30 @@ def runScript():
             'Disable_ContentDB_Update', optional=False, grouping='7.3',
             description=(
                 'Do not update the main features ContentDB. '
-                'This allows multiple feature calculation processes to run in '
-                'parallel. '
-                'You must run the Omero Searcher Rebuild ContentDB script '
-                'yourself once all scripts have finished.'),
+                'Multiple feature calculation processes can update the '
+                'ContentDB in parallel, so this is only needed if you want '
+                'to run the Omero Searcher Rebuild ContentDB script '
+                'yourself later.'),
             default=False),
 
+        scripts.Long(
+            'Worker_Processes', optional=False, grouping='7.4',
+            description=(
+                'Number of processes calculating features in parallel, each '
+                'with its own session, at most '
+                'feature_calculation_processes.'),
+            min=1, max=feature_calculation_processes,
+            default=feature_calculation_processes),
+
+        scripts.Long(
+            'Flush_Images', optional=False, grouping='7.5',
+            description=(
+                'New features are added to the ContentDB journal. Every '
+                'this many images, and at the end, the journal is merged '
+                'into the ContentDB if it is larger than '
+                'journal_compact_bytes. 0 to only check at the end.'),
+            min=0, default=feature_calculation_flush_images),
+
 
         version = '0.0.1',
         authors = ['Murphy Lab'],
@@ -382,7 +521,7 @@ def runScript():
         print '%s' % scriptParams
 
         # Run the script
-        message += processImages(client, scriptParams) + '\n'
+        message += processImages(client, scriptParams, pool) + '\n'
         print '\nMessage:\n%s\n' % message
 
         stopTime = datetime.now()
@@ -392,6 +531,8 @@ def runScript():
 
     finally:
         client.closeSession()
+        if pool is not None:
+            pool.close()
 
 if __name__ == '__main__':
     runScript()
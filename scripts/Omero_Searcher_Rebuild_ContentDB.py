@@ -7,7 +7,11 @@ import sys
 import pyslid
 from omeroweb.omero_searcher.omero_searcher_config import omero_contentdb_path
 from omeroweb.omero_searcher.omero_searcher_config import enabled_featuresets
+from omeroweb.omero_searcher.omero_searcher_config import search_rerank_rows
 pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
+from omeroweb.omero_searcher import contentdb
+from omeroweb.omero_searcher import journal
+from omeroweb.omero_searcher import ranking
 
 
 class CdbArgs:
@@ -131,6 +135,55 @@ def saveToCdb(conn, ftset, cdbs):
     return message
 
 
+def saveColumnarStore(conn, ftset):
+    """
+    Write the memory-mapped columnar copy of the new ContentDB used by
+    OMERO.web
+    """
+    answer, m = contentdb.rebuildStore(conn, ftset)
+    if answer:
+        m = 'Saved columnar ContentDB\n'
+        sys.stdout.write(m)
+        m += reportReducedRecall(conn, ftset)
+    else:
+        m = 'Failed to save columnar ContentDB: %s\n' % m
+        sys.stderr.write(m)
+    return m
+
+
+def reportReducedRecall(conn, ftset):
+    """
+    Report the recall of searches using the quantized features or PCA
+    projections of the new ContentDB compared with searches using all
+    features
+    """
+    message = ''
+    db, m = contentdb.load(conn, ftset)
+    if db is None:
+        return message
+    for scale in sorted(db.scales.keys()):
+        s = db.scales[scale]
+        if not ranking.hasReducedFeatures(s):
+            continue
+        if s.codes is not None:
+            name = '%s quantization' % s.codec.name
+        else:
+            name = 'projection to %d dimensions (explained variance %.3f)' % (
+                s.pca.dims, s.pca.explained)
+        if search_rerank_rows:
+            reduced, reranked = ranking.reducedRecall(s, search_rerank_rows)
+            m = ('Scale:%e %s: top 10 recall %.3f, %.3f after re-scoring %d '
+                 'rows\n' % (scale, name, reduced, reranked,
+                             search_rerank_rows))
+        else:
+            reduced, reranked = ranking.reducedRecall(s, 1)
+            m = ('Scale:%e %s: top 10 recall %.3f, not used by searches '
+                 'since search_rerank_rows is 0\n' % (scale, name, reduced))
+        sys.stdout.write(m)
+        message += m
+    return message
+
+
 def processImages(client, scriptParams):
     message = ''
 
@@ -141,6 +194,10 @@ def processImages(client, scriptParams):
 
         cdbs = CdbArgs()
 
+        # The feature tables include everything in the journal, rows added
+        # after this are merged in when the new ContentDB is loaded
+        journal.discard(conn, ftset)
+
         # Get all images
         ims = conn.getObjects('Image', None)
         for im in ims:
@@ -149,6 +206,9 @@ def processImages(client, scriptParams):
 
         m = saveToCdb(conn, ftset, cdbs)
         message += m
+
+        m = saveColumnarStore(conn, ftset)
+        message += m
     except:
         print message
         raise
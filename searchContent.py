@@ -26,10 +26,11 @@ import os
 import pyslid.features
 import pyslid.utilities
 import pyslid.database.direct
-import ricerca.content
 
 from omero_searcher_config import omero_contentdb_path
 pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
+import contentdb
+import ranking
 
 import logging
 logger = logging.getLogger('searchContent')
@@ -69,79 +70,18 @@ def combinePosandNeg(pos_sorted,neg_sorted):
 
     return avg_sorted
 
-def processIDs(cdb_row):
-    info=cdb_row[6:11]
-    ID = ''.join([str(tmp)+'.' for tmp in info])[:-1]
-    return ID
-
-def processTestSetTwo(contentDB, image_refs_dict):
-    goodset = [['78615.0.0.0.0',0,[0,0,0,0,0,0,0,0,0]]]
-    return goodset
-             
-def processTestSet(contentDB,image_refs_dict,dscale):
-    #create dict with iids as keys and contentDB feature vector as value 
-    iid_contentDB_dict={}
-    for key in contentDB[dscale]:
-        iid_contentDB_dict[key[6]]=key
-
-    goodSet_pos = []
-    for ID in image_refs_dict:
-        items = ID.split('.')
-        iid = long(items[0])
-        pixels = long(items[1])
-        channel = long(items[2])
-        zslice = long(items[3])
-        timepoint = long(items[4])
-        rid=[]
-        field=True
-
-
-        feats=iid_contentDB_dict[iid][11:]
-        if len(feats) ==0:
-            MSG.append("feature table for "+str(iid)+"_"+featureset+" is not available: Please try with other featureset, channel, depth, or images")
-            MSG.append("No retrieved result")
-            return [], MSG
-        else:
-            goodSet_pos.append([ID, 1, feats])
-
-    return goodSet_pos
-
-
 def rankingWrapper(contentDB, image_refs_dict):
-    #determine resolution to use
-    keys = contentDB.keys()
-    keys.remove('info')
-    keys.sort()
-    dscale = keys[0]
-
-    scale = max([imgref[0] for imgref in image_refs_dict.values()])
-
-    #find the closest scale in the dictionary to the scale of the local images
-    for key in keys:
-        if abs(key - scale) < abs(dscale - scale):
-            dscale = key
-
-    if not contentDB.has_key( dscale ):
-       sys.exit("System error - scale not found in content database.")
-    else:
-       data=contentDB[dscale]
-
-    dataset=[]
-    for cdb_row in data:
-        ID=processIDs(cdb_row)
-        feat_vec = list(cdb_row[11:])
-        dataset.append([ID,0,feat_vec])
-
-    test_set=processTestSet(contentDB, image_refs_dict, dscale)
-
-    alpha = -5
-
-    #RANKING IMAGES USING RICERCA                                                                                                            
-    print "Ranking images"
-    normalization = 'zscore'
-    [sorted_iids,sorted_scores] = ricerca.content.ranking( alpha, dataset, test_set, normalization )
-
-    return [sorted_iids, sorted_scores, dscale]
+    """
+    Rank a ColumnarContentDB against a set of positive references
+    image_refs_dict has format image_refs_dict[superid]=(scale, '')
+    """
+    refs = dict((k, [v, 1]) for k, v in image_refs_dict.iteritems())
+    ranked, dscale = ranking.rankingWrapper(contentDB, refs)
+    if ranked is None:
+        return [[], [], dscale]
+    rows = ranked.top(len(ranked))
+    sorted_iids = contentDB.scales[dscale].superids(rows)
+    return [sorted_iids, [ranked.score(r) for r in rows], dscale]
 
     
 
@@ -181,8 +121,8 @@ def relevanceFeedback(conn, parameterMap, server, owner):
         did=long(start_did)
 
     #get contentDB
-    contentDB, message = pyslid.database.direct.retrieve(conn, featureset, did)
-    if len(contentDB) == 0:
+    contentDB, message = contentdb.load(conn, featureset, did)
+    if contentDB is None:
         MSG.append("contentDB for "+featureset+" is not available")
 
     if pos_image_dict:
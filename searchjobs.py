@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Background search jobs
+
+Searches submitted asynchronously are run by a fixed number of worker
+threads in each OMERO.web process, so long searches don't tie up web workers
+and concurrent searches can't exhaust them. Jobs are identified by a random
+job id and can only be read by the user who submitted them.
+
+A job runs in the process it was submitted to, but the status and result of
+each job are saved in the searchjobs directory of the ContentDB directory,
+so any OMERO.web process can answer the requests polling for them:
+    JOBID.json  the user, status and progress of the job, the modification
+                time is updated at each change
+    JOBID.pkl   the pickled result of a finished job
+Jobs are discarded search_job_max_age seconds after they last changed. A job
+which is still queued or running by then is assumed to have been lost with
+its process.
+"""
+
+import cPickle
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from Queue import Queue, Full
+
+from omero_searcher_config import omero_contentdb_path
+from omero_searcher_config import search_job_workers
+from omero_searcher_config import search_job_queue_size
+from omero_searcher_config import search_job_max_age
+
+logger = logging.getLogger('searcher')
+
+
+def writeFile(path, data):
+    """
+    Atomically replace a file
+    """
+    tmppath = '%s.%s.tmp' % (path, uuid.uuid4().hex[:12])
+    with open(tmppath, 'wb') as f:
+        f.write(data)
+    os.rename(tmppath, path)
+
+
+class SearchJob(object):
+    """
+    A search run by a JobPool
+    status is one of 'queued', 'running', 'done' or 'failed'
+    progress is a description of the current stage of the search
+    """
+
+    def __init__(self, path, userid, fn, jobid=None):
+        self.id = jobid or uuid.uuid4().hex
+        self.path = path
+        self.userid = userid
+        self.fn = fn
+        self.status = 'queued'
+        self.progress = 'Waiting for other searches to finish'
+
+    def statePath(self):
+        return os.path.join(self.path, self.id + '.json')
+
+    def resultPath(self):
+        return os.path.join(self.path, self.id + '.pkl')
+
+    def save(self):
+        writeFile(self.statePath(), json.dumps({
+                    'userid': self.userid, 'status': self.status,
+                    'progress': self.progress}))
+
+    def setProgress(self, message):
+        self.progress = message
+        self.save()
+
+    def run(self):
+        self.status = 'running'
+        try:
+            self.save()
+            result = self.fn(self.setProgress)
+            writeFile(self.resultPath(), cPickle.dumps(
+                    result, cPickle.HIGHEST_PROTOCOL))
+            self.status = 'done'
+            self.progress = 'Finished'
+        except Exception as e:
+            logger.error('Search job %s failed', self.id, exc_info=True)
+            self.status = 'failed'
+            self.progress = 'Search failed: %s' % e
+        # Release the connection and anything else held by the function
+        self.fn = None
+        try:
+            self.save()
+        except Exception:
+            logger.error('Failed to save search job %s', self.id,
+                         exc_info=True)
+
+    def result(self):
+        """
+        Read the result of a finished job
+        @return the result, or None if the job has expired
+        """
+        try:
+            with open(self.resultPath(), 'rb') as f:
+                return cPickle.load(f)
+        except IOError:
+            return None
+
+
+class JobPool(object):
+    """
+    A pool of worker threads running SearchJobs, started on first use
+    @param path the directory holding the jobs of all processes
+    """
+
+    def __init__(self, path, workers, queueSize, maxAge):
+        self.path = path
+        self.workers = workers
+        self.queue = Queue(queueSize)
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if not os.path.isdir(self.path):
+                try:
+                    os.makedirs(self.path)
+                except OSError:
+                    # Created by another process
+                    if not os.path.isdir(self.path):
+                        raise
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self.work,
+                                     name='searchjob-%d' % len(self.threads))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                self.queue.task_done()
+
+    def expire(self):
+        """
+        Remove the files of jobs which haven't changed for maxAge seconds
+        """
+        now = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if now - os.path.getmtime(path) > self.maxAge:
+                    os.remove(path)
+            except OSError:
+                # Removed by another process
+                pass
+
+    def submit(self, userid, fn):
+        """
+        Queue a search
+        @param fn the search, this is called with a function which can be
+        used to report progress, and should return the search result, which
+        must be picklable
+        @return a SearchJob, or None if too many searches are queued
+        """
+        self.start()
+        self.expire()
+        job = SearchJob(self.path, userid, fn)
+        job.save()
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            os.remove(job.statePath())
+            return None
+        return job
+
+    def get(self, userid, jobid):
+        """
+        Get a job submitted by this user in any process, or None
+        """
+        job = SearchJob(self.path, userid, None, jobid)
+        try:
+            with open(job.statePath()) as f:
+                state = json.load(f)
+            updated = os.path.getmtime(job.statePath())
+        except (IOError, OSError, ValueError):
+            return None
+        if state['userid'] != userid:
+            return None
+        job.status = state['status']
+        job.progress = state['progress']
+        if (job.status in ('queued', 'running') and
+            time.time() - updated > self.maxAge):
+            job.status = 'failed'
+            job.progress = 'Search was interrupted, please search again.'
+        return job
+
+
+_pool = JobPool(os.path.join(omero_contentdb_path, 'searchjobs'),
+                search_job_workers, search_job_queue_size, search_job_max_age)
+
+
+def submit(userid, fn):
+    return _pool.submit(userid, fn)
+
+
+def get(userid, jobid):
+    return _pool.get(userid, jobid)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Helpers for the OMERO.searcher unit tests
+
+The modules are imported from the top of the repository in the same way as
+the OMERO.web app imports them. contentdb and journal require pyslid, and
+imagemeta and the modules which use it require OMERO as well, tests which use
+them are skipped if these aren't installed.
+"""
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+REPOSITORY = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+sys.path.insert(0, REPOSITORY)
+
+try:
+    import pyslid
+except ImportError:
+    pyslid = None
+
+try:
+    import omero
+except ImportError:
+    omero = None
+
+
+def importPackaged(name):
+    """
+    Import a module which uses explicit relative imports, such as
+    featurequeue, as part of the package at the top of the repository
+    """
+    sys.path.insert(0, os.path.dirname(REPOSITORY))
+    try:
+        return importlib.import_module(
+            '%s.%s' % (os.path.basename(REPOSITORY), name))
+    finally:
+        sys.path.pop(0)
+
+
+def clusteredFeatures(rows, features, clusters, seed=0):
+    """
+    Random float32 features in well separated gaussian clusters
+    """
+    rng = numpy.random.RandomState(seed)
+    centres = rng.normal(0, 10, (clusters, features))
+    labels = rng.randint(0, clusters, rows)
+    return (centres[labels] + rng.normal(0, 1, (rows, features))).astype(
+        numpy.float32)
+
+
+def normalised(x):
+    """
+    z-score normalised float32 features
+    """
+    return ((x - x.mean(axis=0)) / x.std(axis=0)).astype(numpy.float32)
+
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    A test case with a temporary directory self.dir
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+def columnarScale(feats, scale=1.0, seed=0):
+    """
+    A normalised contentdb.ColumnarScale of feature rows, with superids
+    iid.0.c.0.0 for row r = 2 * iid + c and random owners
+    """
+    import contentdb
+    n = len(feats)
+    rows = numpy.arange(n, dtype=numpy.int64)
+    zeros = numpy.zeros(n, dtype=numpy.int32)
+    owner = numpy.random.RandomState(seed).randint(1, 4, n).astype(
+        numpy.int64)
+    s = contentdb.ColumnarScale(
+        scale, feats, rows // 2 + 1, zeros.astype(numpy.int64),
+        (rows % 2).astype(numpy.int32), zeros, zeros, owner)
+    s.normalize()
+    return s
+
+
+class MetadataConn(object):
+    """
+    A connection answering the imagemeta queries from lists of rows
+    @param images a list of (iid, owner, name)
+    @param datasets a list of (iid, dataset)
+    @param plates a list of (iid, plate)
+    @param channels a list of (iid, c, name)
+    @param userid the ID of the user
+    Every row has update event 1
+    """
+
+    SERVICE_OPTS = None
+
+    def __init__(self, images, datasets=(), plates=(), channels=(),
+                 userid=1):
+        self.userid = userid
+        self.results = [
+            ('from Image ', images), ('from DatasetImageLink ', datasets),
+            ('from WellSample ', plates), ('from Pixels ', channels)]
+        self.queries = 0
+
+    def getUserId(self):
+        return self.userid
+
+    def getQueryService(self):
+        return self
+
+    def projection(self, query, params, opts):
+        self.queries += 1
+        for k, rows in self.results:
+            if k in query:
+                if k == 'from Pixels ':
+                    return [list(r) + [1, 1] for r in rows]
+                return [list(r) + [1] for r in rows]
+        raise ValueError(query)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for annindex
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from searchertest import clusteredFeatures
+
+from annindex import IvfIndex
+
+
+def nearestRows(x, q, k):
+    d2 = numpy.square(x[:, numpy.newaxis, :] - q).sum(axis=2)
+    return numpy.argsort(d2, axis=0)[:k].T
+
+
+class TestIvfIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.x = clusteredFeatures(3000, 16, 30)
+        self.ivf = IvfIndex.build(self.x, 40)
+
+    def testPartitions(self):
+        self.assertEqual(len(self.ivf), 40)
+        self.assertEqual(self.ivf.offsets[-1], len(self.x))
+        # Every row is in exactly one partition
+        numpy.testing.assert_array_equal(
+            numpy.sort(self.ivf.rows), numpy.arange(len(self.x)))
+
+    def testRecall(self):
+        rng = numpy.random.RandomState(1)
+        queries = rng.choice(len(self.x), 50, replace=False)
+        truth = nearestRows(self.x, self.x[queries], 10)
+        recall = {}
+        for nprobe in (1, 4):
+            found = 0
+            for q, t in zip(queries, truth):
+                probed = self.ivf.probe(self.x[[q]], nprobe)
+                found += len(numpy.intersect1d(probed, t))
+            recall[nprobe] = found / float(truth.size)
+        self.assertTrue(recall[1] >= 0.8, recall)
+        self.assertTrue(recall[4] >= 0.98, recall)
+        self.assertTrue(recall[4] >= recall[1], recall)
+
+    def testProbeAll(self):
+        probed = self.ivf.probe(self.x[:2], len(self.ivf))
+        numpy.testing.assert_array_equal(probed, numpy.arange(len(self.x)))
+
+    def testProbeSorted(self):
+        probed = self.ivf.probe(self.x[[0, 1000, 2000]], 3)
+        numpy.testing.assert_array_equal(probed, numpy.unique(probed))
+
+    def testSaveLoad(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'ivf.npz')
+            self.ivf.save(path)
+            ivf = IvfIndex.load(path)
+        finally:
+            shutil.rmtree(d)
+        numpy.testing.assert_array_equal(ivf.centroids, self.ivf.centroids)
+        numpy.testing.assert_array_equal(
+            ivf.probe(self.x[:5], 2), self.ivf.probe(self.x[:5], 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for the columnar ContentDB row lookups
+"""
+
+import fcntl
+import multiprocessing
+import os
+import unittest
+from cStringIO import StringIO
+
+import numpy
+
+from searchertest import TempDirTestCase, clusteredFeatures, columnarScale
+from searchertest import pyslid
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestRowIndex(unittest.TestCase):
+
+    def setUp(self):
+        from contentdb import RowIndex
+        self.RowIndex = RowIndex
+        rng = numpy.random.RandomState(0)
+        n = 1000
+        self.cols = [rng.randint(1, 5000, n).astype(numpy.int64),
+                     rng.randint(0, 2, n).astype(numpy.int64)] + [
+            rng.randint(0, 4, n).astype(numpy.int32) for i in xrange(3)]
+
+    def naiveFind(self, *sid):
+        match = numpy.flatnonzero(numpy.all(
+                [col == v for col, v in zip(self.cols, sid)], axis=0))
+        return int(match[-1]) if len(match) else None
+
+    def testFind(self):
+        index = self.RowIndex.build(self.cols)
+        for row in xrange(len(self.cols[0])):
+            sid = [int(col[row]) for col in self.cols]
+            self.assertEqual(index.find(*sid), self.naiveFind(*sid))
+
+    def testDuplicates(self):
+        # The last duplicate is returned
+        for col in self.cols:
+            col[700] = col[100]
+            col[900] = col[100]
+        index = self.RowIndex.build(self.cols)
+        self.assertEqual(
+            index.find(*[int(col[100]) for col in self.cols]), 900)
+
+    def testMissing(self):
+        index = self.RowIndex.build(self.cols)
+        rng = numpy.random.RandomState(1)
+        for i in xrange(200):
+            sid = [int(rng.randint(0, 6000)), int(rng.randint(0, 2))] + [
+                int(x) for x in rng.randint(0, 4, 3)]
+            self.assertEqual(index.find(*sid), self.naiveFind(*sid))
+        # Values outside the range of a column
+        self.assertTrue(index.find(-1, 0, 0, 0, 0) is None)
+        self.assertTrue(index.find(1, 0, 0, 0, 100) is None)
+        self.assertTrue(index.find(10 ** 6, 0, 0, 0, 0) is None)
+
+    def testUnindexable(self):
+        cols = [col.astype(numpy.int64) for col in self.cols]
+        cols[1][5] = -1
+        self.assertTrue(self.RowIndex.build(cols) is None)
+        cols[1][5] = 0
+        cols[0][5] = 2 ** 62
+        self.assertTrue(self.RowIndex.build(cols) is None)
+
+    def testEmpty(self):
+        cols = [numpy.zeros(0, dtype=numpy.int64) for i in xrange(5)]
+        self.assertTrue(self.RowIndex.build(cols).find(1, 0, 0, 0, 0) is None)
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestColumnarScale(unittest.TestCase):
+
+    def setUp(self):
+        self.s = columnarScale(clusteredFeatures(200, 6, 4))
+
+    def testFindRow(self):
+        for row in (0, 1, 57, 199):
+            self.assertEqual(self.s.findRow(
+                    *[int(x) for x in self.s.superid(row).split('.')]), row)
+        self.assertTrue(self.s.findRow(1000, 0, 0, 0, 0) is None)
+
+    def testStackedRows(self):
+        from contentdb import StackedRows
+        a = numpy.arange(12, dtype=numpy.float32).reshape((4, 3))
+        b = numpy.arange(12, 18, dtype=numpy.float32).reshape((2, 3))
+        s = StackedRows(a, b)
+        full = numpy.vstack((a, b))
+        self.assertEqual(len(s), 6)
+        for rows in (slice(0, 6), slice(1, 3), slice(3, 6), slice(4, 6),
+                     slice(0, 6, 2), [5, 0, 4], numpy.arange(6)):
+            numpy.testing.assert_array_equal(s[rows], full[rows])
+        numpy.testing.assert_array_equal(s[4], full[4])
+
+    def testOverlaidFindRow(self):
+        from contentdb import ColumnarScale
+        import journal
+        rows = journal.contentRows([
+                {'time': 1, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [1, 0, 1, 0, 0], 'feats': [0.0] * 6},
+                {'time': 2, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [500, 0, 0, 0, 0], 'feats': [1.0] * 6}])
+        s = self.s.overlaid(ColumnarScale.fromRows(1.0, rows[1.0]))
+        self.assertEqual(len(s), 202)
+        self.assertEqual(s.storedRows, 200)
+        # Row 1 is 1.0.1.0.0, replaced by the first journal row
+        self.assertEqual(s.findRow(1, 0, 1, 0, 0), 200)
+        self.assertEqual(s.findRow(500, 0, 0, 0, 0), 201)
+        self.assertEqual(s.findRow(1, 0, 0, 0, 0), 0)
+        self.assertEqual(numpy.flatnonzero(~s.live).tolist(), [1])
+        numpy.testing.assert_array_equal(s.feats[201], [1.0] * 6)
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestExportNpz(unittest.TestCase):
+
+    def setUp(self):
+        import contentdb
+        self.contentdb = contentdb
+        self.db = contentdb.ColumnarContentDB('slf33', {
+                1.0: columnarScale(clusteredFeatures(50, 4, 2)),
+                0.5: columnarScale(clusteredFeatures(30, 4, 2), 0.5, 1)})
+
+    def export(self, db, selected=None):
+        data = ''.join(self.contentdb.iterNpz(db, selected))
+        out = StringIO()
+        self.contentdb.exportNpz(db, out, selected)
+        # The archives only differ in their modification times
+        npz = numpy.load(StringIO(data))
+        written = numpy.load(StringIO(out.getvalue()))
+        self.assertEqual(sorted(written.files), sorted(npz.files))
+        for k in npz.files:
+            numpy.testing.assert_array_equal(written[k], npz[k])
+        return npz
+
+    def assertColumns(self, npz, n, s, rows):
+        for k in self.contentdb.EXPORT_COLUMNS:
+            numpy.testing.assert_array_equal(
+                npz['%s_%d' % (k, n)], getattr(s, k)[rows])
+
+    def testAll(self):
+        npz = self.export(self.db)
+        self.assertEqual(npz['info'].tolist(), ['slf33'])
+        self.assertEqual(npz['scales'].tolist(), [0.5, 1.0])
+        self.assertColumns(npz, 0, self.db.scales[0.5], slice(None))
+        self.assertColumns(npz, 1, self.db.scales[1.0], slice(None))
+
+    def testSelected(self):
+        s = self.db.scales[1.0]
+        selected = lambda cdbscale: (
+            numpy.flatnonzero(cdbscale.owner == 2)
+            if cdbscale.scale == 1.0 else None)
+        npz = self.export(self.db, selected)
+        self.assertEqual(npz['scales'].tolist(), [1.0])
+        self.assertColumns(npz, 0, s, numpy.flatnonzero(s.owner == 2))
+
+    def testBlocks(self):
+        block = self.contentdb.EXPORT_BLOCK_BYTES
+        self.contentdb.EXPORT_BLOCK_BYTES = 100
+        try:
+            npz = self.export(self.db)
+        finally:
+            self.contentdb.EXPORT_BLOCK_BYTES = block
+        self.assertColumns(npz, 1, self.db.scales[1.0], slice(None))
+
+    def testJournalRows(self):
+        import journal
+        s = self.db.scales[1.0]
+        rows = journal.contentRows([
+                {'time': 1, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [int(s.iid[0]), 0, int(s.c[0]), 0, 0],
+                 'feats': [1.0] * 4}])
+        db = self.db.overlaid(rows)
+        npz = self.export(db)
+        # The replaced row is only exported once, from the journal
+        live = numpy.flatnonzero(db.scales[1.0].live)
+        self.assertEqual(len(live), 50)
+        self.assertFalse(0 in live)
+        self.assertColumns(npz, 1, db.scales[1.0], live)
+
+
+def probeLock(path, release=None):
+    """
+    Try to take an exclusive lock on a file from another process
+    @param release if not None keep a shared lock until this is set instead
+    """
+    def run(result):
+        with open(path, 'r+') as f:
+            if release is not None:
+                fcntl.lockf(f, fcntl.LOCK_SH)
+                result.set()
+                release.wait()
+                return
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                result.set()
+            except IOError:
+                pass
+
+    result = multiprocessing.Event()
+    p = multiprocessing.Process(target=run, args=(result,))
+    p.start()
+    if release is not None:
+        result.wait(10)
+        return p
+    p.join()
+    return result.is_set()
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestGenerations(TempDirTestCase):
+
+    def setUp(self):
+        import contentdb
+        super(TestGenerations, self).setUp()
+        self.contentdb = contentdb
+        self.saved = contentdb.omero_contentdb_path
+        contentdb.omero_contentdb_path = self.dir
+
+    def tearDown(self):
+        self.contentdb.omero_contentdb_path = self.saved
+        super(TestGenerations, self).tearDown()
+
+    def generation(self, suffix):
+        generation = 'slf33.%012d' % suffix
+        for ext in ('lock', 'feats.npy', 'ids.npy'):
+            open(os.path.join(self.dir, '%s.%s' % (generation, ext)),
+                 'w').close()
+        return generation
+
+    def files(self, generation):
+        return sorted(n for n in os.listdir(self.dir)
+                      if n.startswith(generation + '.'))
+
+    def testUnused(self):
+        old, current = self.generation(1), self.generation(2)
+        self.contentdb.removeUnusedGenerations('slf33_content_db_3', current)
+        self.assertEqual(self.files(old), [])
+        self.assertEqual(len(self.files(current)), 3)
+        self.assertTrue(self.contentdb.GenerationLock.acquire(old) is None)
+
+    def testHeld(self):
+        old, current = self.generation(1), self.generation(2)
+        lock = self.contentdb.GenerationLock.acquire(old)
+        self.assertTrue(lock is not None)
+        self.contentdb.removeUnusedGenerations('slf33_content_db_3', current)
+        self.assertEqual(len(self.files(old)), 3)
+        # The shared lock is still held
+        path = self.contentdb.generationLockPath(old)
+        self.assertFalse(probeLock(path))
+
+        del lock
+        self.assertTrue(probeLock(path))
+        self.contentdb.removeUnusedGenerations('slf33_content_db_3', current)
+        self.assertEqual(self.files(old), [])
+
+    def testOtherProcess(self):
+        old, current = self.generation(1), self.generation(2)
+        release = multiprocessing.Event()
+        p = probeLock(self.contentdb.generationLockPath(old), release)
+        try:
+            self.contentdb.removeUnusedGenerations(
+                'slf33_content_db_3', current)
+            self.assertEqual(len(self.files(old)), 3)
+        finally:
+            release.set()
+            p.join()
+        self.contentdb.removeUnusedGenerations('slf33_content_db_3', current)
+        self.assertEqual(self.files(old), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for featurequeue
+"""
+
+import argparse
+import os
+import time
+import unittest
+
+from searchertest import TempDirTestCase, importPackaged, omero, pyslid
+
+
+PARAMS = {
+    'featureset': 'slf33',
+    'scale': 1.0,
+    'channels': [False, 0, 1],
+    'zselect': [True, 1],
+    'tselect': [False, 0],
+    'recalc': False,
+    'attempts': 2,
+    }
+
+
+class Image(object):
+
+    def __init__(self, iid, sizeZ=3):
+        self.iid = iid
+        self.sizeZ = sizeZ
+
+    def getId(self):
+        return self.iid
+
+    def getSizeZ(self):
+        return self.sizeZ
+
+    def getSizeT(self):
+        return 1
+
+    def getSizeC(self):
+        return 1
+
+
+class ImageConn(object):
+    """
+    A connection which finds a list of images, and nothing else
+    """
+
+    def __init__(self, images):
+        self.images = dict((im.getId(), im) for im in images)
+        self.closed = False
+
+    def getObjects(self, type, ids):
+        return [self.images[iid] for iid in ids if iid in self.images]
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(pyslid is None or omero is None,
+                 'pyslid or OMERO is not installed')
+class TestWorkQueue(TempDirTestCase):
+
+    def setUp(self):
+        super(TestWorkQueue, self).setUp()
+        self.fq = importPackaged('featurequeue')
+        self.queue = self.fq.WorkQueue(os.path.join(self.dir, 'q'))
+        self.queue.create(dict(PARAMS), [1, 2, 3, 4, 5], 2)
+
+        self.saved = []
+        self.calculated = []
+        featurecalc = self.fq.featurecalc
+        self.patch(featurecalc, 'existingFeatures',
+                   lambda conn, images, ftset, recalc: (
+                       (im, []) for im in images))
+        self.patch(featurecalc, 'extractFeatures', self.extractFeatures)
+
+    def tearDown(self):
+        for obj, name, value in reversed(self.saved):
+            setattr(obj, name, value)
+        super(TestWorkQueue, self).tearDown()
+
+    def patch(self, obj, name, value):
+        self.saved.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def extractFeatures(self, conn, image, scale, ftset, scaleSet, channels,
+                        zselect, tselect, recalc, disableCdb, cdbJournal,
+                        existing=None):
+        """
+        Image 3 raises an exception and 4 fails, the rest succeed
+        """
+        iid = image.getId()
+        self.calculated.append(iid)
+        if iid == 3:
+            raise RuntimeError('Lost connection')
+        if iid == 4:
+            return 'Feature calculation failed for image:4\n'
+        cdbJournal.append('NA', 2, scale, iid, 0, 0, 1, 0, ['f1'], [iid])
+        return ''
+
+    def setAge(self, unit, age):
+        t = time.time() - age
+        os.utime(self.queue.claimPath(unit), (t, t))
+
+    def testClaim(self):
+        self.assertEqual(self.queue.units(), ['000000', '000001', '000002'])
+        token = self.queue.claim('000000', 3600)
+        self.assertTrue(token)
+        self.assertTrue(self.queue.owns('000000', token))
+        self.assertTrue(self.queue.claim('000000', 3600) is None)
+
+        unit, token1 = self.queue.claimNext(3600)
+        self.assertEqual(unit, '000001')
+        self.assertNotEqual(token1, token)
+
+        # Only the holder can release a claim
+        self.queue.release('000000', token1)
+        self.assertTrue(self.queue.owns('000000', token))
+        self.queue.release('000000', token)
+        self.assertFalse(os.path.exists(self.queue.claimPath('000000')))
+
+        # Finished units aren't claimed
+        open(self.queue.shardPath('000000'), 'w').close()
+        self.assertTrue(self.queue.claim('000000', 3600) is None)
+        self.assertFalse(os.path.exists(self.queue.claimPath('000000')))
+        self.assertEqual(self.queue.claimNext(3600)[0], '000002')
+        self.assertEqual(self.queue.claimNext(3600), (None, None))
+
+    def testStaleTakeover(self):
+        token = self.queue.claim('000000', 3600)
+        self.setAge('000000', 100)
+        self.assertTrue(self.queue.claim('000000', 200) is None)
+
+        token1 = self.queue.claim('000000', 50)
+        self.assertTrue(token1)
+        self.assertFalse(self.queue.owns('000000', token))
+        # The old worker can't update or release the new claim
+        self.setAge('000000', 100)
+        self.queue.heartbeat('000000', token)
+        self.queue.release('000000', token)
+        self.assertTrue(self.queue.owns('000000', token1))
+        self.assertTrue(
+            time.time() - os.path.getmtime(self.queue.claimPath('000000'))
+            > 50)
+        self.queue.heartbeat('000000', token1)
+        self.assertTrue(
+            time.time() - os.path.getmtime(self.queue.claimPath('000000'))
+            < 50)
+
+    def testStaleTakeoverRace(self):
+        # Another worker takes over the stale claim after its age is read,
+        # but before it's renamed
+        token = self.queue.claim('000000', 3600)
+        getmtime = os.path.getmtime
+        ages = [100]
+
+        def staleMtime(path):
+            return getmtime(path) - (ages.pop() if ages else 0)
+
+        self.patch(os.path, 'getmtime', staleMtime)
+        self.assertTrue(self.queue.claim('000000', 50) is None)
+        self.assertTrue(self.queue.owns('000000', token))
+        self.assertEqual(os.listdir(self.queue.sub('claims')),
+                         ['000000.lock'])
+
+    def testProcessUnit(self):
+        # Image 2 doesn't have the requested Z-slice and image 5 is missing
+        conn = ImageConn([Image(1), Image(2, 1), Image(3), Image(4)])
+        queue = self.fq.WorkQueue(os.path.join(self.dir, 'q1'))
+        queue.create(dict(PARAMS), [1, 2, 3, 4, 5], 5)
+        token = queue.claim('000000', 3600)
+        failures = self.fq.processUnit(conn, queue, '000000', token, PARAMS)
+
+        self.assertEqual(sorted(failures), [2, 3, 4, 5])
+        self.assertTrue('Z-slice 1 not found' in failures[2])
+        self.assertTrue('Lost connection' in failures[3])
+        self.assertEqual(self.calculated, [1, 3, 4])
+        self.assertTrue(queue.finished('000000'))
+        fids, rows = self.fq.journal.readJournal([queue.shardPath('000000')])
+        self.assertEqual(fids, ['f1'])
+        self.assertEqual([r['id'][0] for r in rows], [1])
+
+        # Only the images which may succeed are queued again
+        self.assertEqual(queue.units(), ['000000', '000000-r1'])
+        self.assertEqual(queue.images('000000-r1'), [3, 4])
+        self.assertEqual(sorted(queue.failed()), [2, 5])
+
+        token = queue.claim('000000-r1', 3600)
+        failures = self.fq.processUnit(conn, queue, '000000-r1', token,
+                                       PARAMS)
+        self.assertEqual(sorted(failures), [3, 4])
+        # The maximum number of attempts has been reached
+        self.assertEqual(queue.units(), ['000000', '000000-r1'])
+        self.assertEqual(sorted(queue.failed()), [2, 3, 4, 5])
+
+    def testMerge(self):
+        import pyslid.database.direct
+        jroot = os.path.join(self.dir, 'cdb')
+        self.patch(self.fq.journal, 'omero_contentdb_path', jroot)
+        self.patch(pyslid.database.direct, 'getCurrentGroupId',
+                   lambda conn: 3)
+        conn = ImageConn([Image(1), Image(3)])
+        self.patch(self.fq, 'connect', lambda args: conn)
+        compacted = []
+        self.patch(self.fq.contentdb, 'compactJournal',
+                   lambda conn, ftset: (compacted.append(ftset) or True,
+                                        'Merged'))
+        self.patch(self.fq.contentdb, 'rebuildStore',
+                   lambda conn, ftset: (True, ''))
+        for unit in ('000000', '000001'):
+            token = self.queue.claim(unit, 3600)
+            self.fq.processUnit(conn, self.queue, unit, token, PARAMS)
+
+        args = argparse.Namespace(queue=self.queue.path, partial=False)
+        self.assertRaises(SystemExit, self.fq.merge, args)
+        self.assertEqual(self.queue.merged(), set())
+
+        args.partial = True
+        self.fq.merge(args)
+        self.assertTrue(conn.closed)
+        self.assertEqual(compacted, ['slf33'])
+        self.assertEqual(self.queue.merged(), set(['000000', '000001']))
+        # No images in unit 000001 succeeded so its shard is empty
+        jdir = self.fq.journal.journalDir(conn, 'slf33')
+        suffix = self.fq.journal.JOURNAL_SUFFIX
+        self.assertEqual(os.listdir(jdir), ['queue-q-000000' + suffix])
+
+        # Later merges only add the newly finished units
+        os.remove(os.path.join(jdir, 'queue-q-000000' + suffix))
+        conn.images[5] = Image(5)
+        token = self.queue.claim('000002', 3600)
+        self.fq.processUnit(conn, self.queue, '000002', token, PARAMS)
+        self.fq.merge(args)
+        self.assertEqual(compacted, ['slf33', 'slf33'])
+        self.assertEqual(self.queue.merged(), set(['000000', '000001',
+                                                   '000002']))
+        self.assertEqual(os.listdir(jdir), ['queue-q-000002' + suffix])
+        fids, rows = self.fq.journal.readJournal(
+            self.fq.journal.journalFiles(jdir))
+        self.assertEqual([r['id'][0] for r in rows], [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
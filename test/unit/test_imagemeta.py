@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for the imagemeta registry and refreshes
+"""
+
+import threading
+import time
+import unittest
+
+from searchertest import MetadataConn, omero, pyslid
+
+
+def conn(iids, userid=1):
+    return MetadataConn([(iid, userid, 'im%d' % iid) for iid in iids],
+                        userid=userid)
+
+
+@unittest.skipIf(pyslid is None or omero is None,
+                 'pyslid or OMERO is not installed')
+class TestImageMetadata(unittest.TestCase):
+
+    def setUp(self):
+        import imagemeta
+        self.imagemeta = imagemeta
+        self.saved = pyslid.database.direct.getCurrentGroupId
+        pyslid.database.direct.getCurrentGroupId = lambda conn: 3
+        imagemeta._metadata.clear()
+
+    def tearDown(self):
+        pyslid.database.direct.getCurrentGroupId = self.saved
+        self.imagemeta._metadata.clear()
+
+    def testUsers(self):
+        # In a private group each user only sees their own images
+        md1 = self.imagemeta.getMetadata(conn([1, 2], 1))
+        md2 = self.imagemeta.getMetadata(conn([3], 2))
+        self.assertTrue(md1 is not md2)
+        self.assertTrue(md1.exists(2))
+        self.assertFalse(md2.exists(2))
+        self.assertTrue(md2.exists(3))
+        self.assertTrue(self.imagemeta.getMetadata(conn([1, 2], 1)) is md1)
+
+    def testIncrementalRefresh(self):
+        c = conn([1, 2])
+        md = self.imagemeta.getMetadata(c)
+        self.assertEqual(c.queries, 4)
+        self.imagemeta.getMetadata(c)
+        self.assertEqual(c.queries, 4)
+
+        c.results[0][1].append((5, 1, 'im5'))
+        md.checked = 1
+        # Skipped while another thread is refreshing
+        with md.refreshLock:
+            self.assertTrue(self.imagemeta.getMetadata(c) is md)
+        self.assertEqual(c.queries, 4)
+        self.assertFalse(md.exists(5))
+
+        generation = md.generation
+        self.assertTrue(self.imagemeta.getMetadata(c) is md)
+        self.assertEqual(c.queries, 8)
+        self.assertTrue(md.exists(5))
+        self.assertEqual(md.generation, generation + 1)
+
+    def testFullRefresh(self):
+        c = conn([1, 2])
+        md = self.imagemeta.getMetadata(c)
+        # Image 2 is deleted, which is only seen by a full refresh
+        del c.results[0][1][1]
+        md.created = 1
+        # The old metadata is used until the new metadata has been read
+        self.assertTrue(self.imagemeta.getMetadata(c) is md)
+        md.replacer.join()
+        self.assertTrue(md.exists(2))
+
+        new = self.imagemeta.getMetadata(c)
+        self.assertTrue(new is not md)
+        self.assertTrue(new.exists(1))
+        self.assertFalse(new.exists(2))
+        self.assertTrue(new.replacer is None)
+
+    def testFailedFullRefresh(self):
+        c = conn([1, 2])
+        md = self.imagemeta.getMetadata(c)
+        c.results = []
+        md.created = 1
+        md.checked = time.time()
+        self.assertTrue(self.imagemeta.getMetadata(c) is md)
+        # The failed replacer resets md.replacer, so it may already be None
+        for t in threading.enumerate():
+            if t.name.startswith('imagemeta-'):
+                t.join()
+        # The old metadata is kept, and replaced after the next interval
+        self.assertTrue(self.imagemeta.getMetadata(c) is md)
+        self.assertTrue(md.replacer is None)
+        self.assertTrue(md.created > 1)
+        self.assertTrue(md.exists(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for journal
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from searchertest import pyslid
+
+
+def row(t, iid, feats, owner=2, scale=1.0):
+    return {'time': t, 'scale': scale, 'server': 'NA', 'owner': owner,
+            'id': [iid, 0, 0, 0, 0], 'feats': feats}
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        import journal
+        self.journal = journal
+        self.dir = tempfile.mkdtemp()
+        self.saved = {'path': journal.omero_contentdb_path}
+        journal.omero_contentdb_path = self.dir
+
+        # Record the ContentDB updates made by compaction
+        self.updates = []
+        self.failUpdates = False
+        direct = pyslid.database.direct
+        for name in ('getCurrentGroupId', 'updateDataset',
+                     'removeDuplicates'):
+            self.saved[name] = getattr(direct, name)
+        direct.getCurrentGroupId = lambda conn: 3
+        direct.updateDataset = self.updateDataset
+        direct.removeDuplicates = lambda conn, scale, ftset, did=None: (
+            True, '')
+        self.jdir = journal.journalDir(None, 'slf33')
+        os.makedirs(self.jdir)
+
+    def tearDown(self):
+        self.journal.omero_contentdb_path = self.saved.pop('path')
+        for name, fn in self.saved.iteritems():
+            setattr(pyslid.database.direct, name, fn)
+        shutil.rmtree(self.dir)
+
+    def updateDataset(self, conn, server, owner, scale, iid, px, c, z, t,
+                      fids, feats, ftset, did=None):
+        if self.failUpdates:
+            return False, 'failed'
+        self.updates.append((owner, scale, iid, feats))
+        return True, 'updated'
+
+    def writeFile(self, name, rows, partial=''):
+        with open(os.path.join(self.jdir, name), 'w') as f:
+            f.write(json.dumps({'fids': ['f1', 'f2']}) + '\n')
+            for r in rows:
+                f.write(json.dumps(r) + '\n')
+            f.write(partial)
+
+    def testReadOrder(self):
+        # Rows are ordered by time, not by file, and a partly written last
+        # line is ignored
+        self.writeFile('a.jsonl', [row(2, 20, [2, 2])], '{"time": 4, "sc')
+        self.writeFile('b.jsonl', [row(1, 10, [1, 1]), row(3, 30, [3, 3])])
+        fids, rows = self.journal.readJournal(
+            self.journal.journalFiles(self.jdir))
+        self.assertEqual(fids, ['f1', 'f2'])
+        self.assertEqual([r['time'] for r in rows], [1, 2, 3])
+
+        cdb = self.journal.readRows(self.jdir)
+        self.assertEqual(cdb.keys(), [1.0])
+        self.assertEqual([r[6:] for r in cdb[1.0]], [
+                [10, 0, 0, 0, 0, 1, 1], [20, 0, 0, 0, 0, 2, 2],
+                [30, 0, 0, 0, 0, 3, 3]])
+
+    def testSize(self):
+        self.assertEqual(self.journal.size(self.jdir), 0)
+        self.writeFile('a.jsonl', [row(1, 10, [1, 1])])
+        self.writeFile('b.jsonl', [row(2, 20, [2, 2])], '{"time": 4')
+        self.assertEqual(self.journal.size(self.jdir), sum(
+                os.path.getsize(os.path.join(self.jdir, n))
+                for n in ('a.jsonl', 'b.jsonl')))
+        self.assertEqual(self.journal.size(os.path.join(self.dir, 'none')), 0)
+
+    def testBuffer(self):
+        writer = self.journal.JournalWriter(None, 'slf33')
+        buf = self.journal.JournalBuffer(writer)
+        buf.append('NA', 2, 1.0, 10, 0, 0, 0, 0, ['f1', 'f2'], [1, 1])
+        buf.append('NA', 2, 1.0, 11, 0, 0, 0, 0, ['f1', 'f2'], [2, 2])
+        buf.append('NA', 2, 1.0, 10, 0, 0, 0, 0, ['f1', 'f2'], [3, 3])
+        self.assertEqual(buf.flush(), 2)
+        self.assertEqual(buf.flush(), 0)
+        writer.append('NA', 2, 1.0, 12, 0, 0, 0, 0, ['f1', 'f2'], [4, 4])
+
+        with open(writer.path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0], {'fids': ['f1', 'f2']})
+        self.assertEqual([(r['id'][0], r['feats']) for r in lines[1:]],
+                         [(11, [2, 2]), (10, [3, 3]), (12, [4, 4])])
+
+    def testCompact(self):
+        merged = []
+        # The later row for image 10 is in the earlier file
+        self.writeFile('a.jsonl', [row(5, 10, [5, 5]), row(6, 30, [6, 6], 4)])
+        self.writeFile('b.jsonl', [row(1, 10, [1, 1]), row(2, 20, [2, 2])])
+        self.assertNotEqual(self.journal.signature(self.jdir), '')
+
+        a, m = self.journal.compact(None, 'slf33', merged=merged.append)
+        self.assertTrue(a, m)
+        self.assertEqual(sorted(self.updates), [
+                (2, 1.0, [20, 10], [[2, 2], [5, 5]]),
+                (4, 1.0, [30], [[6, 6]])])
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(sorted(merged[0][1.0]), [[2, 2], [5, 5], [6, 6]])
+        self.assertEqual(self.journal.journalFiles(self.jdir), [])
+        self.assertEqual(self.journal.signature(self.jdir), '')
+
+    def testCompactFailure(self):
+        self.writeFile('a.jsonl', [row(1, 10, [1, 1])])
+        self.failUpdates = True
+        a, m = self.journal.compact(None, 'slf33')
+        self.assertFalse(a)
+        # The rows are still read, and merged by the next compaction
+        self.assertEqual(len(self.journal.readRows(self.jdir)[1.0]), 1)
+        self.failUpdates = False
+        self.writeFile('b.jsonl', [row(2, 10, [2, 2])])
+        a, m = self.journal.compact(None, 'slf33')
+        self.assertTrue(a, m)
+        self.assertEqual(self.updates, [(2, 1.0, [10], [[2, 2]])])
+        self.assertEqual(self.journal.journalFiles(self.jdir), [])
+
+    def testMergeRows(self):
+        cdb = {'info': {},
+               1.0: [[1L, 'NA', 2, '', '', '', 10, 0, 0, 0, 0, 1.0],
+                     [2L, 'NA', 2, '', '', '', 20, 0, 0, 0, 0, 2.0],
+                     [3L, 'NA', 2, '', '', '', 30, 0, 0, 0, 0, 3.0]]}
+        rows = self.journal.contentRows([
+                row(1, 20, [4.0]), row(2, 40, [5.0]),
+                row(3, 50, [6.0], scale=0.5)])
+        self.journal.mergeRows(cdb, rows)
+        self.assertEqual([(r[0], r[6], r[11]) for r in cdb[1.0]], [
+                (1, 10, 1.0), (3, 30, 3.0), (4, 20, 4.0), (5, 40, 5.0)])
+        self.assertEqual([(r[0], r[6]) for r in cdb[0.5]], [(1, 50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
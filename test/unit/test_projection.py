@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for projection
+"""
+
+import os
+import unittest
+
+import numpy
+
+from searchertest import TempDirTestCase, clusteredFeatures, normalised
+
+from projection import PcaProjection
+
+
+class TestPcaProjection(TempDirTestCase):
+
+    def testLowRank(self):
+        # Rows in a 4 dimensional subspace are reconstructed exactly from 4
+        # components
+        rng = numpy.random.RandomState(0)
+        basis = rng.normal(size=(4, 12))
+        z = numpy.dot(rng.normal(size=(500, 4)), basis)
+        pca = PcaProjection.fit(z, 4)
+        self.assertEqual(pca.dims, 4)
+        self.assertAlmostEqual(pca.explained, 1.0)
+        p = pca.projectAll(z, numpy.empty((len(z), 4)))
+        numpy.testing.assert_allclose(
+            numpy.dot(p, pca.components) + pca.mean, z, atol=1e-8)
+        # Components are orthonormal
+        numpy.testing.assert_allclose(
+            numpy.dot(pca.components, pca.components.T), numpy.eye(4),
+            atol=1e-10)
+
+    def testDistances(self):
+        # Projecting onto all components preserves distances
+        z = normalised(clusteredFeatures(300, 8, 5))
+        pca = PcaProjection.fit(z, 8)
+        p = pca.project(z)
+        d = numpy.square(z[:, numpy.newaxis] - z[:20]).sum(axis=2)
+        dp = numpy.square(p[:, numpy.newaxis] - p[:20]).sum(axis=2)
+        numpy.testing.assert_allclose(dp, d, rtol=1e-4, atol=1e-4)
+
+    def testSaveLoad(self):
+        z = normalised(clusteredFeatures(300, 8, 5))
+        pca = PcaProjection.fit(z, 3)
+        self.assertTrue(0 < pca.explained < 1)
+        path = os.path.join(self.dir, 'pca.npz')
+        pca.save(path)
+        loaded = PcaProjection.load(path)
+        self.assertEqual(loaded.dims, 3)
+        self.assertEqual(loaded.explained, pca.explained)
+        numpy.testing.assert_array_equal(loaded.project(z), pca.project(z))
+
+
+if __name__ == '__main__':
+    unittest.main()
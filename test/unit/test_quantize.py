@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for quantize
+"""
+
+import os
+import unittest
+
+import numpy
+
+from searchertest import TempDirTestCase, clusteredFeatures, normalised
+
+import quantize
+
+
+class TestCodecs(TempDirTestCase):
+
+    def setUp(self):
+        super(TestCodecs, self).setUp()
+        self.z = normalised(clusteredFeatures(2000, 20, 10))
+
+    def roundTrip(self, codec):
+        path = os.path.join(self.dir, 'codec.npz')
+        quantize.save(codec, path)
+        return quantize.load(path)
+
+    def testFloat16(self):
+        codec = quantize.train('float16', self.z, 0)
+        codes = codec.encodeAll(
+            self.z, numpy.empty(codec.codeShape(self.z), codec.dtype))
+        numpy.testing.assert_allclose(
+            codec.decode(codes), self.z, rtol=1e-3, atol=1e-3)
+        self.assertTrue(isinstance(self.roundTrip(codec),
+                                   quantize.Float16Codec))
+
+    def testScalar(self):
+        codec = quantize.train('sq8', self.z, 0)
+        codes = codec.encodeAll(
+            self.z, numpy.empty(codec.codeShape(self.z), codec.dtype))
+        self.assertEqual(codes.dtype, numpy.uint8)
+        # Each feature is within half a quantization step
+        error = numpy.abs(codec.decode(codes) - self.z)
+        self.assertTrue((error <= codec.step / 2 + 1e-6).all())
+
+        loaded = self.roundTrip(codec)
+        numpy.testing.assert_array_equal(loaded.lo, codec.lo)
+        numpy.testing.assert_array_equal(loaded.step, codec.step)
+        numpy.testing.assert_array_equal(loaded.encode(self.z), codes)
+
+    def testScalarConstantFeature(self):
+        z = self.z.copy()
+        z[:, 3] = 0
+        codec = quantize.ScalarCodec.train(z)
+        numpy.testing.assert_array_equal(
+            codec.decode(codec.encode(z))[:, 3], 0)
+
+    def testProduct(self):
+        # 20 features don't divide into 6 subspaces, so they're padded
+        codec = quantize.train('pq8', self.z, 6)
+        self.assertEqual(codec.subspaces, 6)
+        codes = codec.encodeAll(
+            self.z, numpy.empty(codec.codeShape(self.z), codec.dtype))
+        self.assertEqual(codes.shape, (len(self.z), 6))
+
+        # Distances from the lookup tables are the distances to the
+        # reconstructed rows
+        q = numpy.asarray(self.z[:3], dtype=numpy.float64)
+        d2 = codec.distances(codes, codec.prepare(q))
+        m, k, dsub = codec.centroids.shape
+        decoded = numpy.hstack([codec.centroids[j][codes[:, j]]
+                                for j in xrange(m)])[:, :self.z.shape[1]]
+        expected = numpy.square(
+            decoded[:, numpy.newaxis, :] - q).sum(axis=2)
+        numpy.testing.assert_allclose(d2, expected, rtol=1e-6, atol=1e-6)
+
+        # Reconstruction is much closer than the distance between rows
+        error = numpy.square(decoded - self.z).sum(axis=1).mean()
+        spread = numpy.square(self.z - self.z.mean(axis=0)).sum(axis=1).mean()
+        self.assertTrue(error < 0.1 * spread, (error, spread))
+
+        loaded = self.roundTrip(codec)
+        numpy.testing.assert_array_equal(loaded.encode(self.z), codes)
+
+
+if __name__ == '__main__':
+    unittest.main()
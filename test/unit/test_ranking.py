@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for ranking
+"""
+
+import multiprocessing
+import os
+import unittest
+
+import numpy
+
+from searchertest import TempDirTestCase, clusteredFeatures, columnarScale
+from searchertest import pyslid
+
+import ranking
+
+
+def naiveFalcon(zfeats, refs, alpha=ranking.ALPHA):
+    """
+    The FALCON distance of each row to a reference set, one row at a time in
+    the same way as ricerca.content.distance
+    """
+    zfeats = numpy.asarray(zfeats, dtype=numpy.float64)
+    scores = []
+    for row in zfeats:
+        total = 0.0
+        for r in refs:
+            d = numpy.sqrt(numpy.square(row - zfeats[r]).sum())
+            with numpy.errstate(divide='ignore'):
+                total += numpy.power(d, float(alpha))
+        total /= len(refs)
+        scores.append(numpy.power(total, float(alpha)) if total != 0 else 0)
+    return numpy.array(scores)
+
+
+def assertScores(actual, expected):
+    # The vectorised distance of a reference to itself may not be exactly
+    # zero, which gives a tiny score instead of zero
+    numpy.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-100)
+
+
+def refsDict(cdbscale, pos, neg=()):
+    refs = {}
+    for rows, pn in ((pos, 1), (neg, -1)):
+        for r in rows:
+            refs[cdbscale.superid(r)] = [(cdbscale.scale, ''), pn]
+    return refs
+
+
+def exactOrder(keys, rows):
+    """
+    Rows in increasing key order, ties broken by row
+    """
+    rows = numpy.asarray(rows)
+    return rows[numpy.lexsort((rows, keys[rows]))]
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestFalconScores(unittest.TestCase):
+
+    def setUp(self):
+        self.s = columnarScale(clusteredFeatures(300, 12, 6))
+
+    def testAllRows(self):
+        refs = [3, 50, 299]
+        scores = ranking.falconScores(self.s, [refs])[0]
+        assertScores(scores, naiveFalcon(self.s.zfeats, refs))
+        # References have a distance of zero to themselves
+        self.assertTrue((scores[refs] < 1e-100).all())
+
+    def testSelectedRows(self):
+        refs = [7]
+        rows = numpy.array([0, 1, 7, 120, 250, 299])
+        scores = ranking.falconScores(self.s, [refs], rows)[0]
+        assertScores(scores, naiveFalcon(self.s.zfeats, refs)[rows])
+
+    def testSeveralReferenceSets(self):
+        refsets = [[1], [2, 30], [100, 200, 201]]
+        scores = ranking.falconScores(self.s, refsets)
+        self.assertEqual(len(scores), 3)
+        for refs, s in zip(refsets, scores):
+            assertScores(s, naiveFalcon(self.s.zfeats, refs))
+
+    def testChunks(self):
+        chunk = ranking.CHUNK_ROWS
+        ranking.CHUNK_ROWS = 64
+        try:
+            scores = ranking.falconScores(self.s, [[5, 6]])[0]
+        finally:
+            ranking.CHUNK_ROWS = chunk
+        assertScores(scores, naiveFalcon(self.s.zfeats, [5, 6]))
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestRankingWrapper(unittest.TestCase):
+
+    def setUp(self):
+        import contentdb
+        self.s = columnarScale(clusteredFeatures(400, 10, 8))
+        self.db = contentdb.ColumnarContentDB(None, {1.0: self.s})
+        self.refs = [10, 11]
+        self.exact = naiveFalcon(self.s.zfeats, self.refs)
+
+    def testTop(self):
+        r, dscale = ranking.rankingWrapper(
+            self.db, refsDict(self.s, self.refs))
+        self.assertEqual(dscale, 1.0)
+        expected = exactOrder(self.exact, numpy.arange(len(self.s)))
+        numpy.testing.assert_array_equal(r.top(25), expected[:25])
+        numpy.testing.assert_array_equal(r.top(10), expected[:10])
+        assertScores([r.score(row) for row in r.top(5)],
+                     self.exact[expected[:5]])
+
+    def testFilter(self):
+        owner = self.s.owner
+        r, dscale = ranking.rankingWrapper(
+            self.db, refsDict(self.s, self.refs),
+            eligible=lambda s: s.owner == 2)
+        expected = exactOrder(self.exact, numpy.flatnonzero(owner == 2))
+        self.assertEqual(len(r), len(expected))
+        numpy.testing.assert_array_equal(r.top(20), expected[:20])
+        rows = numpy.concatenate(list(r.batches(5, 0, start=3)))
+        numpy.testing.assert_array_equal(rows, expected[3:])
+
+    def testMissingReferences(self):
+        r, dscale = ranking.rankingWrapper(
+            self.db, {'999999.0.0.0.0': [(1.0, ''), 1]})
+        self.assertTrue(r is None)
+
+    def testApproximateFallback(self):
+        from annindex import IvfIndex
+        self.s.ivf = IvfIndex.build(self.s.zfeats, 16)
+        eligible = lambda s: s.owner != 1
+        r, dscale = ranking.rankingWrapper(
+            self.db, refsDict(self.s, self.refs), eligible=eligible, nprobe=1)
+        probed = self.s.ivf.probe(self.s.zfeats[self.refs], 1)
+        probed = probed[self.s.owner[probed] != 1]
+        self.assertEqual(len(r), len(probed))
+        numpy.testing.assert_array_equal(
+            r.top(len(probed)), exactOrder(self.exact, probed))
+
+        # Once the probed rows are exhausted the remaining eligible rows are
+        # returned in exact order without repeating any
+        rows = numpy.concatenate(list(r.batches(5, 0)))
+        expected = numpy.flatnonzero(self.s.owner != 1)
+        self.assertEqual(len(rows), len(expected))
+        numpy.testing.assert_array_equal(numpy.sort(rows), expected)
+        numpy.testing.assert_array_equal(
+            rows[len(probed):], exactOrder(
+                self.exact, numpy.setdiff1d(expected, probed)))
+
+    def testJournalRows(self):
+        import journal
+        # Replace row 0 with a copy of a reference, and add a new row
+        feats = self.s.feats
+        rows = [{'time': 1, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [int(self.s.iid[0]), 0, int(self.s.c[0]), 0, 0],
+                 'feats': feats[self.refs[0]].tolist()},
+                {'time': 2, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [1000, 0, 0, 0, 0], 'feats': feats[300].tolist()}]
+        db = self.db.overlaid(journal.contentRows(rows))
+        s = db.scales[1.0]
+        self.assertEqual(len(s), len(self.s) + 2)
+        self.assertEqual(s.findRow(int(self.s.iid[0]), 0, 0, 0, 0),
+                         len(self.s))
+
+        r, dscale = ranking.rankingWrapper(
+            db, refsDict(self.s, self.refs))
+        top = r.top(len(r))
+        self.assertEqual(len(top), len(self.s) + 1)
+        self.assertFalse(0 in top)
+        # The journal copy of the reference has a distance of zero
+        self.assertTrue(len(self.s) in top[:3])
+        self.assertTrue(r.score(len(self.s)) < 1e-100)
+
+
+@unittest.skipIf(pyslid is None, 'pyslid is not installed')
+class TestShards(TempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+
+    def setUp(self):
+        import contentdb
+        super(TestShards, self).setUp()
+        self.saved = (ranking._shardPool, ranking.search_shard_rows)
+        ranking._shardPool = self.pool
+        ranking.search_shard_rows = 64
+        self.s = columnarScale(clusteredFeatures(1000, 8, 6))
+        self.s.zfeatsPath = os.path.join(self.dir, 'zfeats.npy')
+        numpy.save(self.s.zfeatsPath, self.s.zfeats)
+        self.db = contentdb.ColumnarContentDB(None, {1.0: self.s})
+        self.refs = [10, 700]
+
+    def tearDown(self):
+        ranking._shardPool, ranking.search_shard_rows = self.saved
+        super(TestShards, self).tearDown()
+
+    def unsharded(self, fn, *args, **kwargs):
+        ranking._shardPool = None
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            ranking._shardPool = self.pool
+
+    def testFalconScores(self):
+        self.assertTrue(ranking.sharded(self.s, len(self.s)))
+        rows = numpy.flatnonzero(self.s.owner != 2)
+        for r in (None, rows):
+            for a, b in zip(
+                ranking.falconScores(self.s, [[1], self.refs], r),
+                self.unsharded(
+                    ranking.falconScores, self.s, [[1], self.refs], r)):
+                assertScores(a, b)
+
+    def testFalconTop(self):
+        refsets = [[1], self.refs]
+        exact = naiveFalcon(self.s.zfeats, [1]), naiveFalcon(
+            self.s.zfeats, self.refs)
+        rows = numpy.flatnonzero(self.s.owner != 2)
+        for r in (None, rows):
+            candidates = numpy.arange(len(self.s)) if r is None else r
+            for keys, (best, scores) in zip(
+                exact, ranking.falconTop(self.s, refsets, 30, r)):
+                self.assertEqual(sorted(best),
+                                 sorted(exactOrder(keys, candidates)[:30]))
+                assertScores(scores, keys[best])
+
+    def testRankingWrapper(self):
+        keys = naiveFalcon(self.s.zfeats, self.refs)
+        owner = self.s.owner
+        for eligible, candidates in (
+            (None, numpy.arange(len(self.s))),
+            (lambda s: s.owner != 2, numpy.flatnonzero(owner != 2))):
+            expected = exactOrder(keys, candidates)
+            r, dscale = ranking.rankingWrapper(
+                self.db, refsDict(self.s, self.refs), eligible, n=20)
+            # Only the best rows of each shard are scored at first
+            self.assertTrue(len(r) < len(candidates))
+            numpy.testing.assert_array_equal(r.top(20), expected[:20])
+            # Then more are scored as needed, twice as many each time
+            rows = numpy.concatenate(list(r.batches(10, 0)))
+            numpy.testing.assert_array_equal(rows, expected)
+            assertScores([r.score(row) for row in rows], keys[expected])
+
+    def testJournalRows(self):
+        import journal
+        rows = [{'time': 1, 'scale': 1.0, 'server': 'NA', 'owner': 2,
+                 'id': [5000, 0, 0, 0, 0],
+                 'feats': self.s.feats[self.refs[0]].tolist()}]
+        db = self.db.overlaid(journal.contentRows(rows))
+        r, dscale = ranking.rankingWrapper(
+            db, refsDict(self.s, self.refs), n=5)
+        top = r.top(5)
+        self.assertTrue(len(self.s) in top[:3])
+        numpy.testing.assert_array_equal(top, self.unsharded(
+                ranking.rankingWrapper, db, refsDict(self.s, self.refs),
+                n=5)[0].top(5))
+
+    def testBatchRankingWrapper(self):
+        queries = [(1.0, {self.s.superid(1): 1}),
+                   (None, {self.s.superid(10): 1, self.s.superid(700): 1}),
+                   (1.0, {self.s.superid(3): 1, self.s.superid(4): -1})]
+        eligible = lambda s: s.owner != 3
+        for e in (None, eligible):
+            results = ranking.batchRankingWrapper(self.db, queries, 15, e)
+            expected = self.unsharded(
+                ranking.batchRankingWrapper, self.db, queries, 15, e)
+            for (sids, scores, dscale), (esids, escores, edscale) in zip(
+                results, expected):
+                self.assertEqual(sids, esids)
+                if escores is None:
+                    self.assertTrue(scores is None)
+                else:
+                    assertScores(scores, escores)
+
+
+if __name__ == '__main__':
+    unittest.main()
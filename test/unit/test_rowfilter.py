@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for rowfilter and the imagemeta inverted indices
+"""
+
+import unittest
+
+import numpy
+
+from searchertest import MetadataConn, clusteredFeatures, columnarScale
+from searchertest import omero, pyslid
+
+
+def metadata(nimages, seed=0):
+    """
+    Random metadata for images 1 to nimages, each with two channels
+    """
+    rng = numpy.random.RandomState(seed)
+    images = [(iid, int(rng.randint(1, 4)), 'im%d' % iid)
+              for iid in xrange(1, nimages + 1)]
+    datasets = [(iid, int(d)) for iid in xrange(1, nimages + 1)
+                for d in set(rng.randint(10, 20, rng.randint(0, 3)))]
+    plates = [(iid, int(rng.randint(30, 33)))
+              for iid in xrange(1, nimages + 1) if rng.rand() < 0.3]
+    channels = [(iid, c, ['DAPI', 'GFP', None][rng.randint(0, 3)])
+                for iid in xrange(1, nimages + 1) for c in (0, 1)]
+    return MetadataConn(images, datasets, plates, channels)
+
+
+@unittest.skipIf(pyslid is None or omero is None,
+                 'pyslid or OMERO is not installed')
+class TestFilterMask(unittest.TestCase):
+
+    def setUp(self):
+        import imagemeta
+        # Images 1-100 have rows, but only 1-90 have metadata
+        self.conn = metadata(90)
+        self.md = imagemeta.ImageMetadata()
+        self.md.refresh(self.conn)
+        self.s = columnarScale(clusteredFeatures(200, 4, 2))
+
+    def naiveMask(self, channels, owners, datasets, plates, chnames):
+        import imagemeta
+        images = dict((r[0], r[1]) for r in self.conn.results[0][1])
+        links = set(self.conn.results[1][1])
+        wells = set(self.conn.results[2][1])
+        names = dict(((r[0], r[1]), r[2] or imagemeta.UNNAMED_CHANNEL)
+                     for r in self.conn.results[3][1])
+        mask = []
+        for row in xrange(len(self.s)):
+            iid, c = int(self.s.iid[row]), int(self.s.c[row])
+            ok = channels is None or c in channels
+            ok &= owners is None or images.get(iid) in owners
+            if datasets is not None or plates is not None:
+                ok &= (any((iid, d) in links for d in datasets or []) or
+                       any((iid, p) in wells for p in plates or []))
+            ok &= chnames is None or names.get((iid, c)) in chnames
+            mask.append(ok)
+        return numpy.array(mask)
+
+    def check(self, *filters):
+        import rowfilter
+        numpy.testing.assert_array_equal(
+            rowfilter.filterMask(self.md, self.s, *filters),
+            self.naiveMask(*filters))
+
+    def testFilters(self):
+        import imagemeta
+        self.check(None, None, None, None, None)
+        self.check([1], None, None, None, None)
+        self.check(None, [1, 3], None, None, None)
+        self.check(None, None, [10, 11, 15], None, None)
+        self.check(None, None, [12], [31], None)
+        self.check(None, None, None, [30, 32], None)
+        self.check(None, None, None, None, ['GFP', imagemeta.UNNAMED_CHANNEL])
+        self.check([0], [2], range(10, 20), [], ['DAPI'])
+
+    def testEmptyAndUnknownValues(self):
+        self.check([], None, None, None, None)
+        self.check(None, [99], None, None, None)
+        self.check(None, None, [], [], None)
+        self.check(None, None, None, None, ['No such channel'])
+
+    def testAllDatasets(self):
+        # Selecting every dataset only excludes images which aren't in one
+        self.check(None, None, range(10, 20), None, None)
+        self.assertEqual(self.md.keys('dataset', range(10, 20)).tolist(),
+                         sorted(set(r[0] for r in self.conn.results[1][1])))
+
+    def testBitmapCache(self):
+        import rowfilter
+        bitmaps = rowfilter.getBitmaps(self.md, self.s)
+        for owner in xrange(rowfilter.ROW_BITMAPS + 5):
+            bitmaps.mask(None, [owner], None, None, None)
+        self.assertEqual(len(bitmaps.bitmaps), rowfilter.ROW_BITMAPS)
+        # The most recently used bitmaps are kept
+        self.assertTrue(('owner', (rowfilter.ROW_BITMAPS + 4,)) in
+                        bitmaps.bitmaps)
+        self.assertFalse(('owner', (0,)) in bitmaps.bitmaps)
+
+    def testMetadataChange(self):
+        import rowfilter
+        self.check(None, [1], None, None, None)
+        bitmaps = rowfilter.getBitmaps(self.md, self.s)
+        # Image 95 now exists and belongs to owner 1
+        self.conn.results[0][1].append((95, 1, 'im95'))
+        self.md.refresh(self.conn)
+        self.check(None, [1], None, None, None)
+        self.assertTrue(rowfilter.getBitmaps(self.md, self.s) is not bitmaps)
+        self.assertTrue(95 in self.md.keys('owner', [1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
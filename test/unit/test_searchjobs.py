@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for searchjobs
+"""
+
+import os
+import threading
+import time
+import unittest
+
+from searchertest import TempDirTestCase
+
+import searchjobs
+
+
+def waitFor(pool, userid, jobid, status):
+    for i in xrange(500):
+        job = pool.get(userid, jobid)
+        if job.status == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError('Job %s is %s' % (jobid, job.status))
+
+
+class TestJobPool(TempDirTestCase):
+
+    def setUp(self):
+        super(TestJobPool, self).setUp()
+        self.path = os.path.join(self.dir, 'searchjobs')
+        self.pool = searchjobs.JobPool(self.path, 1, 2, 600)
+        # Another OMERO.web process sharing the ContentDB directory
+        self.other = searchjobs.JobPool(self.path, 1, 2, 600)
+        self.started = threading.Event()
+        self.finish = threading.Event()
+
+    def tearDown(self):
+        self.finish.set()
+        self.pool.queue.join()
+        super(TestJobPool, self).tearDown()
+
+    def search(self, progress):
+        progress('Ranking')
+        self.started.set()
+        self.finish.wait()
+        return {'images': [1, 2]}, {'position': 2}
+
+    def testLifecycle(self):
+        job = self.pool.submit(5, self.search)
+        self.started.wait()
+        for pool in (self.pool, self.other):
+            j = pool.get(5, job.id)
+            self.assertEqual((j.status, j.progress), ('running', 'Ranking'))
+            # Only the user who submitted the job can read it
+            self.assertTrue(pool.get(6, job.id) is None)
+        self.assertTrue(self.other.get(5, 'f00') is None)
+
+        self.finish.set()
+        j = waitFor(self.other, 5, job.id, 'done')
+        self.assertEqual(j.progress, 'Finished')
+        self.assertEqual(j.result(), ({'images': [1, 2]}, {'position': 2}))
+
+    def testFailure(self):
+        def fail(progress):
+            raise ValueError('No references')
+        job = self.pool.submit(5, fail)
+        j = waitFor(self.other, 5, job.id, 'failed')
+        self.assertEqual(j.progress, 'Search failed: No references')
+
+    def testQueueFull(self):
+        self.pool.submit(5, self.search)
+        self.started.wait()
+        self.assertTrue(self.pool.submit(5, self.search) is not None)
+        self.assertTrue(self.pool.submit(5, self.search) is not None)
+        self.assertTrue(self.pool.submit(5, self.search) is None)
+        self.assertEqual(len(os.listdir(self.path)), 3)
+
+    def testExpiry(self):
+        self.finish.set()
+        job = self.pool.submit(5, self.search)
+        waitFor(self.pool, 5, job.id, 'done')
+        old = time.time() - 601
+        for name in os.listdir(self.path):
+            os.utime(os.path.join(self.path, name), (old, old))
+        self.assertEqual(self.pool.get(5, job.id).status, 'done')
+        self.other.start()
+        self.other.expire()
+        self.assertTrue(self.pool.get(5, job.id) is None)
+        self.assertTrue(job.result() is None)
+
+    def testInterrupted(self):
+        # A job left queued by a process which has gone
+        job = searchjobs.SearchJob(self.path, 5, None)
+        self.other.start()
+        job.save()
+        self.assertEqual(self.pool.get(5, job.id).status, 'queued')
+        old = time.time() - 601
+        os.utime(job.statePath(), (old, old))
+        j = self.pool.get(5, job.id)
+        self.assertEqual(j.status, 'failed')
+        self.assertEqual(j.progress,
+                         'Search was interrupted, please search again.')
+
+
+if __name__ == '__main__':
+    unittest.main()
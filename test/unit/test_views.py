@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Tests for views, these require OMERO.web
+"""
+
+import unittest
+from cStringIO import StringIO
+
+import numpy
+
+from searchertest import clusteredFeatures, columnarScale
+
+try:
+    import views
+except Exception:
+    # ImportError, or the Django settings aren't configured
+    views = None
+
+
+class Post(dict):
+    """
+    The POST parameters of a request, each a list of values
+    """
+
+    def get(self, k, default=None):
+        return self[k][-1] if k in self else default
+
+    def getlist(self, k):
+        return dict.get(self, k, [])
+
+
+class Request(object):
+
+    def __init__(self, **post):
+        self.POST = Post(post)
+
+
+class Metadata(object):
+    """
+    Image metadata with the datasets of each image
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def keys(self, field, values):
+        assert field == 'dataset'
+        return numpy.array(sorted(iid for iid, d in self.datasets.iteritems()
+                                  if d in values), dtype=numpy.int64)
+
+
+@unittest.skipIf(views is None, 'OMERO.web is not installed')
+class TestExportContentDBNpz(unittest.TestCase):
+
+    def setUp(self):
+        import contentdb
+        self.db = contentdb.ColumnarContentDB('slf33', {
+                1.0: columnarScale(clusteredFeatures(40, 4, 2)),
+                0.5: columnarScale(clusteredFeatures(20, 4, 2), 0.5, 1)})
+        self.saved = (views.contentdb.load, views.imagemeta.getMetadata)
+        views.contentdb.load = lambda conn, ftset: (
+            (self.db, 'Good') if ftset == 'slf33' else (None, 'Not found'))
+        # Images 1-10 are in dataset 7, the rest in dataset 8
+        md = Metadata(dict((iid, 7 if iid <= 10 else 8)
+                           for iid in xrange(1, 21)))
+        views.imagemeta.getMetadata = lambda conn: md
+
+    def tearDown(self):
+        views.contentdb.load, views.imagemeta.getMetadata = self.saved
+
+    def export(self, request):
+        response = views.exportContentDBNpz(request, None, 'slf33')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="contentdb_slf33.npz"')
+        return numpy.load(StringIO(''.join(response)))
+
+    def testAll(self):
+        npz = self.export(Request())
+        self.assertEqual(npz['scales'].tolist(), [0.5, 1.0])
+        numpy.testing.assert_array_equal(
+            npz['feats_1'], self.db.scales[1.0].feats)
+
+    def testSelected(self):
+        s = self.db.scales[1.0]
+        npz = self.export(Request(export_scales=['1.0'], export_owners=['2'],
+                                  export_datasets=['7']))
+        self.assertEqual(npz['scales'].tolist(), [1.0])
+        rows = numpy.flatnonzero((s.owner == 2) & (s.iid <= 10))
+        self.assertTrue(len(rows) > 0)
+        for k in ('feats', 'iid', 'c', 'owner'):
+            numpy.testing.assert_array_equal(npz[k + '_0'], getattr(s, k)[rows])
+
+    def testNotFound(self):
+        self.assertTrue(
+            views.exportContentDBNpz(Request(), None, 'slf34') is None)
+
+
+class ParentsConn(object):
+    """
+    A connection answering the getImageParents queries
+    @param links lists of (image-id, parent-id, parent-name) for each of
+    'Dataset' and 'Plate', in link ID order
+    """
+
+    SERVICE_OPTS = None
+
+    def __init__(self, links):
+        self.links = links
+        self.queried = []
+
+    def getQueryService(self):
+        return self
+
+    def projection(self, query, params, opts):
+        from omero.rtypes import unwrap
+        ids = unwrap(params.map['ids'])
+        ptype = 'Dataset' if 'DatasetImageLink' in query else 'Plate'
+        self.queried.append((ptype, sorted(ids)))
+        return [list(r) for r in self.links[ptype] if r[0] in ids]
+
+
+@unittest.skipIf(views is None, 'OMERO.web is not installed')
+class TestImageParents(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = ParentsConn({
+                'Dataset': [(1, 10, 'd10'), (2, 11, 'd11'), (1, 12, 'd12'),
+                            (4, 10, 'd10')],
+                'Plate': [(2, 20, 'p20'), (3, 21, 'p21'), (5, 22, 'p22')]})
+
+    def testParents(self):
+        parents = views.getImageParents(self.conn, [4, 1, 2, 3, 5, 6, 1])
+        # The first dataset link wins, and datasets are preferred to plates
+        self.assertEqual(parents, {
+                1: (10, 'Dataset', 'd10'), 2: (11, 'Dataset', 'd11'),
+                3: (21, 'Plate', 'p21'), 4: (10, 'Dataset', 'd10'),
+                5: (22, 'Plate', 'p22')})
+        self.assertEqual(self.conn.queried, [
+                ('Dataset', [1, 2, 3, 4, 5, 6]),
+                ('Plate', [1, 2, 3, 4, 5, 6])])
+
+    def testBatches(self):
+        batch = views.EXPORT_QUERY_IDS
+        views.EXPORT_QUERY_IDS = 4
+        try:
+            parents = views.getImageParents(self.conn, range(1, 7))
+        finally:
+            views.EXPORT_QUERY_IDS = batch
+        self.assertEqual(len(parents), 5)
+        self.assertEqual([ids for ptype, ids in self.conn.queried],
+                         [[1, 2, 3, 4], [1, 2, 3, 4], [5, 6], [5, 6]])
+
+    def testNoImages(self):
+        self.assertEqual(views.getImageParents(self.conn, []), {})
+        self.assertEqual(self.conn.queried, [])
+
+    def testExportRows(self):
+        images = [{'id': 1, 'superid': '1.0.0.0.0', 'ranki': 1, 'czt': '0.0.0',
+                   'name': u'caf\xe9', 'score': 0.5},
+                  {'id': 6, 'superid': '6.0.1.0.0', 'ranki': 2, 'czt': '1.0.0',
+                   'name': 'b', 'score': 0.75}]
+        rows = list(views.exportRows(
+                images, views.getImageParents(self.conn, [1, 6])))
+        self.assertEqual(rows, [
+                'ImageID,ImageSID,Rank,CZT,Name,Score,ParentID,ParentType,'
+                'ParentName\r\n',
+                '1,1.0.0.0.0,1,0.0.0,caf\xc3\xa9,0.5,10,Dataset,d10\r\n',
+                '6,6.0.1.0.0,2,1.0.0,b,0.75,,,\r\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,10 @@ else:
 from django.views.static import serve
 
 from . import views
+from . import warmup
+
+# Already started by SearcherConfig.ready() with Django 1.7+
+warmup.start()
 
 urlpatterns = patterns('django.views.generic.simple',
 
@@ -31,6 +35,12 @@ urlpatterns = patterns('django.views.generic.simple',
     url( r'^searchpage/$', views.searchpage, name="searchpage" ), 
 
     url( r'^contentsearch/$', views.contentsearch, name="contentsearch"), 
+    url( r'^contentsearch/more/$', views.contentsearchmore, name="contentsearchmore"),
+    url( r'^contentsearch/start/$', views.contentsearchstart, name="contentsearchstart"),
+    url( r'^contentsearch/job/(?P<jobid>[0-9a-f]+)/$', views.contentsearchstatus, name="contentsearchstatus"),
+    url( r'^contentsearch/job/(?P<jobid>[0-9a-f]+)/result/$', views.contentsearchresult, name="contentsearchresult"),
+    url( r'^api/search/$', views.searchapi, name="searchapi"),
+    url( r'^status/warmup/$', views.warmupstatus, name="warmupstatus"),
     url( r'^exportsearch/$', views.exportsearch, name="exportsearch"),
     url( r'^exportcontentdb/$', views.exportcontentdb, name="exportcontentdb"),
     url( r'^featureCalculationConfig/(?:(?P<object_type>[a-zA-Z0-9]+))/(?:(?P<object_ID>[0-9]+)/)?$', views.featureCalculationConfig, name="featureCalculationConfig"),  ## BK 
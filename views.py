@@ -9,23 +9,34 @@
 # Version: 1.0
 #
 
+import json
 import logging
 from collections import defaultdict
 from datetime import datetime
-from itertools import izip, chain
 from operator import itemgetter
 
-# These two are needed for the CSV export
-from django.http import HttpResponse
-from django.template import loader, Context
+# These are needed for the CSV export
+import csv
+from django.http import HttpResponse, HttpResponseNotAllowed
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Before Django 1.5 HttpResponse streams an iterator
+    StreamingHttpResponse = HttpResponse
 
 # For ContentDB export
-import pickle
+import cPickle
+import os
+import tempfile
+from wsgiref.util import FileWrapper
+
+import numpy
 
 from omeroweb.webclient.decorators import login_required, render_response
 from webclient.webclient_gateway import OmeroWebGateway
 
 import omero
+import omero.gateway
 from omero.rtypes import rint, wrap, unwrap
 
 # import featuresetInfo     # TODO import currently failing
@@ -35,8 +46,24 @@ logger = logging.getLogger('searcher')
 import pyslid
 from omero_searcher_config import omero_contentdb_path
 from omero_searcher_config import enabled_featuresets
+from omero_searcher_config import search_candidate_margin
+from omero_searcher_config import ann_nprobe
+from omero_searcher_config import search_rerank_rows
+from omero_searcher_config import search_async
+from omero_searcher_config import search_api_max_queries
 pyslid.database.direct.set_contentdb_path(omero_contentdb_path)
-import ricerca
+
+import contentdb
+import ranking
+import imagemeta
+import journal
+import rowfilter
+import searchjobs
+import warmup
+from imagemeta import UNNAMED_CHANNEL
+
+# Maximum number of image IDs in each query used to export search results
+EXPORT_QUERY_IDS = 5000
 
 
 # Note some of these views can be called from either the standard OMERO.web
@@ -178,6 +205,34 @@ def getImageDatasetMap(conn):
     return imDsMap
 
 
+def getImageParents(conn, imageIds):
+    """
+    Get the first dataset or plate of each image using bulk queries instead
+    of calling im.listParents() on every image
+    Returns a dictionary of image-id: (parent-id, parent-type, parent-name)
+    """
+    qs = conn.getQueryService()
+    queries = [
+        ('Dataset',
+         'select dl.child.id, d.id, d.name from DatasetImageLink dl '
+         'join dl.parent d where dl.child.id in (:ids) order by dl.id'),
+        ('Plate',
+         'select ws.image.id, p.id, p.name from WellSample ws '
+         'join ws.well w join w.plate p where ws.image.id in (:ids) '
+         'order by ws.id'),
+        ]
+    imageIds = sorted(set(imageIds))
+    parents = {}
+    for start in xrange(0, len(imageIds), EXPORT_QUERY_IDS):
+        params = omero.sys.ParametersI()
+        params.addIds(imageIds[start:start + EXPORT_QUERY_IDS])
+        for ptype, query in queries:
+            for r in qs.projection(query, params, conn.SERVICE_OPTS):
+                iid, pid, name = [unwrap(x) for x in r]
+                parents.setdefault(iid, (pid, ptype, name))
+    return parents
+
+
 def getChannelIndices(conn, limit_channelidxs=None):
     """
     Get a list of (channel-index, str(channel-index), enabled?)
@@ -189,8 +244,6 @@ def getChannelIndices(conn, limit_channelidxs=None):
     return channels
 
 
-UNNAMED_CHANNEL = '[No channel name]'
-
 def getChannelNames(conn, limit_channelnames=None):
     """
     Get a list of (channel-name, channel-name, enabled?)
@@ -221,105 +274,6 @@ def getImageChannelMap(conn):
     return imChMap
 
 
-def filterImageUserChannels(conn, iids, uids=None, chnames=None):
-    """
-    Queries the database to see which images fit the requested criteria
-    TODO: Check whether this query is correct or not... it might not be
-    """
-    if not iids:
-        return {}
-
-    qs = conn.getQueryService()
-    query = ('select p from Pixels p join '
-             'fetch p.channels as c join '
-             'fetch c.logicalChannel as lc join '
-             'fetch p.image as im '
-             'where im.id in (:iids)')
-
-    params = omero.sys.ParametersI()
-    params.add('iids', wrap([long(u) for u in iids]))
-
-    logger.debug('iids:%s uids:%s chnames:%s', iids, uids, chnames)
-
-    if uids:
-        query += 'and p.details.owner.id in (:uids) '
-        params.add('uids', wrap([long(u) for u in uids]))
-    if chnames:
-        if UNNAMED_CHANNEL in chnames:
-            query += 'and (lc.name in (:chns) or lc.name is NULL) '
-        else:
-            query += 'and lc.name in (:chns) '
-        params.add('chns', wrap([str(chn) for chn in chnames]))
-
-    ps = qs.findAllByQuery(query, params, conn.SERVICE_OPTS)
-
-    def getChName(pixels, c):
-        try:
-            ch = p.getChannel(c)
-        except IndexError:
-            return None
-        if not ch:
-            return None
-        name = ch.getLogicalChannel(c).name
-        if name is None:
-            return UNNAMED_CHANNEL
-        return unwrap(name)
-
-    imChMap = {}
-    for p in ps:
-        iid = unwrap(p.image.id)
-
-        # The HQL query restricted the channel search, so some channels won't
-        # be loaded. Unloaded trailing channels won't be created either.
-        cs = [getChName(p, c) for c in xrange(unwrap(p.getSizeC()))]
-        imChMap[iid] = cs
-    return imChMap
-
-
-def filterByDataset(conn, iids, dids):
-    """
-    Check whether the supplied image ids are contained in one of the specified
-    datasets, given as IDs
-    """
-    if len(dids) == 0 or len(iids) == 0:
-        return set()
-
-    qs = conn.getQueryService()
-    query = ('select dl from DatasetImageLink dl '
-             'where dl.parent.id in (:dids) '
-             'and dl.child.id in (:iids) ')
-
-    params = omero.sys.ParametersI()
-    params.add('dids', wrap([long(u) for u in dids]))
-    params.add('iids', wrap([long(u) for u in iids]))
-
-    dls = qs.findAllByQuery(query, params, conn.SERVICE_OPTS)
-    filteredIids = set(dl.child.id.val for dl in dls)
-    return filteredIids
-
-
-def filterByPlate(conn, iids, pids):
-    """
-    Check whether the supplied image ids are contained in one of the specified
-    plates, given as IDs
-    """
-    if len(pids) == 0 or len(iids) == 0:
-        return set()
-
-    qs = conn.getQueryService()
-    query = ('select ws.image.id from WellSample ws '
-             'where ws.well.plate.id in (:pids) '
-             'and ws.image.id in (:iids) ')
-
-    params = omero.sys.ParametersI()
-    params.add('pids', wrap([long(u) for u in pids]))
-    params.add('iids', wrap([long(u) for u in iids]))
-
-    filteredIids = qs.projection(query, params, conn.SERVICE_OPTS)
-    filteredIids = set(chain(*unwrap(filteredIids)))
-    return filteredIids
- 
-
 def listAvailableCZTS(conn, imageId, ftset):
     """
     List the available CZT and scales for features associated with an image
@@ -455,6 +409,7 @@ def searchpage( request, iIds=None, dId = None, fset = None, numret = None, negI
     """
 
     context = {'template': 'searcher/contentsearch/searchpage.html'}
+    context['search_async'] = search_async
 
     logger.debug('searchpage POST:%s', request.POST)
 
@@ -541,44 +496,154 @@ def searchpage( request, iIds=None, dId = None, fset = None, numret = None, negI
 
 
 # import omeroweb.searcher.searchContent as searchContent   TODO: import currently failing
-@login_required(setGroupContext=True)
-@render_response()
-def contentsearch( request, conn=None, **kwargs):
-    startTime = datetime.now()
+def filterEligible(md, filters):
+    """
+    Get a function which returns the mask of the rows of a ContentDB scale
+    passing a search filter, or None if filters is empty
+    @param filters a dictionary of sorted lists, see parseSearchRequest, or
+    None for fields which aren't restricted
+    """
+    if not filters:
+        return None
 
-    #server_name=request.META['SERVER_NAME']
-    #owner=request.session['username']
+    # Filters are applied before ranking. Reference rows are still used
+    # as queries even if they are excluded from the results.
+    # E.g. Reference channel 1 against query channel 2.
+    def eligible(cdbscale):
+        return rowfilter.filterMask(
+            md, cdbscale, filters['channelidxs'], filters['users'],
+            filters['datasets'], filters['plates'],
+            filters['channelnames'])
+    return eligible
 
-    logger.debug('contentsearch POST:%s', request.POST)
 
-    dId = request.POST.get("dataset_ID", None)
-    fset = request.POST.get("featureset_Name")
-    numret = request.POST.get("NumRetrieve")
+def rankSearch(conn, db, cursor):
+    """
+    Rank a ContentDB for a search, see contentsearch for the cursor
+    Returns (ranking, ContentDB scale, ImageMetadata), the ranking is None if
+    the references weren't found
+    """
+    md = imagemeta.getMetadata(conn)
+    eligible = filterEligible(md, cursor['filters'])
+    try:
+        ranked, dscale = ranking.rankingWrapper(
+            db, cursor['refs'], eligible, ann_nprobe.get(cursor['ftset'], 0),
+            search_rerank_rows,
+            cursor['position'] + cursor['numret'] + search_candidate_margin)
+    except Exception as e:
+        logger.error(str(e))
+        raise
+
+    cdbscale = db.scales[dscale]
+    if ranked is not None:
+        logger.debug('rankSearch ranking %d of %d rows dscale:%s',
+                     len(ranked), len(cdbscale), dscale)
+    return ranked, cdbscale, md
+
+
+def image_batch_load(conn, md, ranked, cdbscale, numret, start=0):
+    """
+    We don't want to load all images, and it's possible for images to
+    have been deleted but remain in the contentDB.
+    Only the top numret rows plus a margin after start are initially
+    selected from the ranking. Rows whose images aren't in the local metadata
+    index are skipped, and the remaining images are then retrieved with a
+    single query to check they still exist. Only if some have been deleted
+    since the index was refreshed are more images retrieved.
+
+    Returns a list of (row, superid, image) in rank order, and the rank
+    position after the last returned row
+    """
+    results = []
+    pending = []
+
+    def retrieve():
+        ims = conn.getObjects(
+            'Image', set(cdbscale.iid[r] for n, r in pending))
+        iid_ims_map = dict((im.getId(), im) for im in ims)
+        logger.debug('image_batch_load: %d -> %d',
+                     len(pending), len(iid_ims_map))
+        for n, r in pending:
+            im = iid_ims_map.get(cdbscale.iid[r])
+            if im is not None:
+                results.append((r, cdbscale.superid(r), im))
+                if len(results) == numret:
+                    return n + 1
+        del pending[:]
+
+    n = start
+    for selected in ranked.batches(numret, search_candidate_margin, start):
+        for r in selected:
+            if md.exists(cdbscale.iid[r]):
+                pending.append((n, r))
+            n += 1
+            if len(results) + len(pending) == numret:
+                end = retrieve()
+                if end is not None:
+                    return results, end
+    if pending:
+        retrieve()
+    return results, n
+
+
+def searchPage(conn, db, cursor):
+    """
+    Get the next page of results for a search and advance the cursor, see
+    contentsearch
+    Returns (images, message), message is an error message or None
+    """
+    ranked, cdbscale, md = rankSearch(conn, db, cursor)
+    if ranked is None:
+        return [], ('The reference images were not found in the ContentDB '
+                    'for feature-set %s.') % cursor['ftset']
+
+    img_list, cursor['position'] = image_batch_load(
+        conn, md, ranked, cdbscale, cursor['numret'], cursor['position'])
+    logger.debug('img_list: [%d] %s', len(img_list), img_list)
+
+    images = []
+    for ranki, (r, sid, img) in enumerate(img_list, cursor['shown'] + 1):
+        # id.px.c.z.t
+        czt = sid.split(".", 2)[2]
+        images.append({
+                'name':img.getName(),
+                'id': img.getId(),
+                'getPermsCss': img.getPermsCss(),
+                'ranki': ranki,
+                'superid': sid,
+                'czt': czt,
+                'score': ranked.score(r),
+                })
+    cursor['shown'] += len(images)
+    return images, None
+
+
+def parseSearchRequest(conn, post):
+    """
+    Get the search cursor for a contentsearch request, see contentsearch
+    Returns (cursor, message), if the request is invalid cursor is None and
+    message is an error message
+    """
+    dId = post.get("dataset_ID", None)
+    fset = post.get("featureset_Name")
+    numret = post.get("NumRetrieve")
     numret = int(numret)
-    enable_filters = request.POST.get("enable_filters") == 'enable'
+    enable_filters = post.get("enable_filters") == 'enable'
     logger.debug('Got enable_filters: %s', enable_filters)
 
-    limit_users = request.POST.getlist("limit_users")
+    limit_users = post.getlist("limit_users")
     if enable_filters and len(limit_users) == 0:
-        context = {
-            'template': 'searcher/contentsearch/search_error.html',
-            'message': 'No users selected'
-            }
-        return context
+        return None, 'No users selected'
 
 
     limit_users = set(int(x) for x in limit_users)
     logger.debug('Got limit_users: %s', limit_users)
 
-    limit_datasets = request.POST.getlist("limit_datasets")
-    limit_plates = request.POST.getlist("limit_plates")
+    limit_datasets = post.getlist("limit_datasets")
+    limit_plates = post.getlist("limit_plates")
 
     if enable_filters and len(limit_datasets) == 0 and len(limit_plates) == 0:
-        context = {
-            'template': 'searcher/contentsearch/search_error.html',
-            'message': 'No datasets or plates selected'
-            }
-        return context
+        return None, 'No datasets or plates selected'
 
     limit_datasets = set(int(x) for x in limit_datasets)
     logger.debug('Got limit_datasets: %s', limit_datasets)
@@ -586,35 +651,27 @@ def contentsearch( request, conn=None, **kwargs):
     logger.debug('Got limit_plates: %s', limit_plates)
 
 
-    limit_channelidxs = request.POST.getlist("limit_channelidxs")
+    limit_channelidxs = post.getlist("limit_channelidxs")
     if enable_filters and len(limit_channelidxs) == 0:
-        context = {
-            'template': 'searcher/contentsearch/search_error.html',
-            'message': 'No channel indices selected'
-            }
-        return context
+        return None, 'No channel indices selected'
 
     limit_channelidxs = set(int(x) for x in limit_channelidxs)
     logger.debug('Got limit_channelidxs: %s', limit_channelidxs)
 
-    limit_channelnames = request.POST.getlist("limit_channelnames")
+    limit_channelnames = post.getlist("limit_channelnames")
     if enable_filters and len(limit_channelnames) == 0:
-        context = {
-            'template': 'searcher/contentsearch/search_error.html',
-            'message': 'No channel names selected'
-            }
-        return context
+        return None, 'No channel names selected'
 
     limit_channelnames = set(limit_channelnames)
     logger.debug('Got limit_channelnames: %s', limit_channelnames)
 
 
-    superIds = request.POST.getlist("superIds")
+    superIds = post.getlist("superIds")
     logger.debug('Got superIDs: %s', superIds)
-    idCztPn = getIdCztPnFromSuperIds(superIds, request.POST)
+    idCztPn = getIdCztPnFromSuperIds(superIds, post)
     imageIds = idCztPn.keys()
 
-    ftset = request.POST.get("featureset_Name")
+    ftset = post.get("featureset_Name")
     image_refs_dict = {}
     for i in imageIds:
         available = listAvailableCZTS(conn, i, str(fset))
@@ -635,7 +692,53 @@ def contentsearch( request, conn=None, **kwargs):
             image_refs_dict[ipczt] = [(scale, ''), pn]
     logger.debug('contentsearch image_refs_dict:%s', image_refs_dict)
 
-    cdb, s = pyslid.database.direct.retrieve(conn, ftset)
+    if len(image_refs_dict) == 0:
+        # No images had features
+        return None, (
+            'No features were found for the reference images. Please use the '
+            'Omero Searcher Feature Calculation script to calculate them '
+            'before running a search.')
+
+    filters = None
+    if enable_filters:
+        filters = {
+            'channelidxs': sorted(limit_channelidxs),
+            'users': sorted(limit_users),
+            'datasets': sorted(limit_datasets),
+            'plates': sorted(limit_plates),
+            'channelnames': sorted(limit_channelnames),
+            }
+
+    # Everything needed to continue the search later, see contentsearchmore
+    # The version of the ContentDB is filled in by runSearch
+    cursor = {
+        'ftset': ftset,
+        'version': None,
+        'refs': image_refs_dict,
+        'filters': filters,
+        'numret': numret,
+        'position': 0,
+        'shown': 0,
+        }
+    return cursor, None
+
+
+def runSearch(conn, cursor, progress=None):
+    """
+    Run a search, returning the context for the first page of results
+    @param progress optional function which is called with a description of
+    each stage of the search
+    """
+    startTime = datetime.now()
+
+    def setProgress(message):
+        logger.debug('runSearch: %s', message)
+        if progress:
+            progress(message)
+
+    ftset = cursor['ftset']
+    setProgress('Loading ContentDB')
+    db, s = contentdb.load(conn, ftset)
 
     if s != 'Good':
         context = {'template':
@@ -645,29 +748,6 @@ def contentsearch( request, conn=None, **kwargs):
             'Have you calculated any features?') % ftset
         return context
 
-    def processIds(cdbr):
-        return ['.'.join(str(c) for c in cdbr[6:11]), cdbr[2], cdbr[1]]
-
-    def processSearchSet(cdb, im_ref_dict, dscale):
-        # TODO: this is called multiple times by Ricerca- we shouldn't need to
-        # rebuild id_cdb_dict (mapping of superids to features) each time
-        logger.debug('processSearchSet cdb.keys():%s', cdb.keys())
-        id_cdb_dict = dict(
-            ('.'.join(str(c) for c in r[6:11]), r) for r in cdb[dscale])
-        goodset_pos = []
-
-        logger.debug('id_cdb_dict.keys %s', id_cdb_dict.keys())
-        for id in im_ref_dict:
-            iid = long(id.split('.')[0])
-            logger.debug('id %s iid %s', id, iid)
-            feats = id_cdb_dict[id][11:]
-            #logger.debug('feats %s', feats)
-            goodset_pos.append([id, 1, feats])
-            #logger.debug('%s', [id, 1, feats])
-
-        #logger.debug('goodset_pos %s', goodset_pos)
-        return goodset_pos
-
     # TODO:
     # Reminder: scale is currently partially hard coded until we work out
     # what it's meant to be and how it should be set
@@ -675,175 +755,345 @@ def contentsearch( request, conn=None, **kwargs):
     # If ContentDB contain duplicate entries for an image at the same scale
     # rankingWrapper() will return duplicate results
 
-    logger.debug('contentsearch cdb.keys():%s', cdb.keys())
-    if len(image_refs_dict) == 0:
-        # No images had features
+    logger.debug('contentsearch scales:%s', db.scales.keys())
+    cursor['version'] = list(db.version) if db.version else None
+
+    setProgress('Ranking')
+    images, message = searchPage(conn, db, cursor)
+    if message is None and len(images) == 0:
+        message = (
+            'No results found. Please try widening your search parameters, '
+            'or calculating features for more images.')
+    if message:
         context = {'template':
                        'searcher/contentsearch/search_error.html'}
-        context['message'] = (
-            'No features were found for the reference images. Please use the '
-            'Omero Searcher Feature Calculation script to calculate them '
-            'before running a search.')
+        context['message'] = message
         return context
 
-    try:
-        final_result, dscale = ricerca.content.rankingWrapper(
-            cdb, image_refs_dict, processIds, processSearchSet)
-        logger.debug('contentsearch final_results:%s dscale:%s',
-                     final_result, dscale)
-    except Exception as e:
-        logger.error(str(e))
-        raise
+    context = {'template': 'searcher/contentsearch/searchresult.html'}
+    context['images'] = images
+    context['more'] = len(images) == cursor['numret']
+    #logger.debug('context images:%s', images)
 
-    im_ids_sorted = [r[0] for r in final_result[0]]
-    if final_result[1]:
-        im_scores = dict(izip(im_ids_sorted, final_result[1]))
-    else:
-        im_scores = dict(izip(im_ids_sorted, [0] * len(im_ids_sorted)))
-    logger.debug('contentsearch im_ids_sorted:%s', im_ids_sorted)
-    logger.debug('contentsearch im_scores:%s', im_scores)
+    endTime = datetime.now()
+    dd = endTime - startTime
+    context['performance'] = '%d results returned in %d.%03d seconds' % (
+        len(images), dd.seconds, dd.microseconds / 1000)
+    return context
 
 
-    def filter_superid(im_id):
-        """
-        Ideally we'd filter before performing the query. However we can't just
-        strip out unwanted rows from the ContentDB because we want to keep the
-        reference image even if it doesn't fit the criteria.
-        E.g. Reference channel 1 against query channel 2.
-        """
-        return int(im_id.split('.')[2]) in limit_channelidxs
+def saveSearch(request, context, cursor):
+    """
+    Save a successful search so that it can be continued or exported
+    """
+    if 'images' in context:
+        request.session['OMEROsearcher:SearchCursor'] = cursor
+        request.session['OMEROsearcher:LastImageResults'] = context['images']
 
-    if enable_filters:
-        im_ids_sorted = [sid for sid in im_ids_sorted if filter_superid(sid)]
-    logger.debug('Filtered im_ids_sorted:%s', im_ids_sorted)
 
+@login_required(setGroupContext=True)
+@render_response()
+def contentsearch( request, conn=None, **kwargs):
+    #server_name=request.META['SERVER_NAME']
+    #owner=request.session['username']
 
-    context = {'template': 'searcher/contentsearch/searchresult.html'}
+    logger.debug('contentsearch POST:%s', request.POST)
 
-    def split_sid(sid):
-        iid, p, c, z, t = sid.split('.')
-        return int(iid), int(p), int(c), int(z), int(t)
-
-    def image_batch_load(conn, im_ids_sorted, numret):
-        """
-        We don't want to load all images, but since we'll filter out some we
-        don't know how many to load, and it's also possible for images to
-        have been deleted but remain in the contentDB.
-        Read in chunks until we have the required number of images.
-
-        1. Discard sids which aren't in a selected dataset
-        2. Discard sids which aren't
-           * owned by a selected user
-           * contain at least one channel with a selected name
-        3. Retrieve the corresponding image objects
-        4. Build a map of sids to image objects, discarding sids whose images
-           no longer exist
-        """
-        img_map = {}
-
-        # We need to choose the batch size
-        # Remember getObjects() returns objects in an unspecified order, so we
-        # must iterate through the entire result and re-order
-        batch_size = max(numret, 100)
-
-        i = 0
-        while i < len(im_ids_sorted):
-            batch_sids = dict((sid, split_sid(sid)[0])
-                              for sid in im_ids_sorted[i:i + batch_size])
-
-            if enable_filters:
-                filter1ids = set.union(
-                    filterByDataset(
-                        conn, batch_sids.values(), limit_datasets),
-                    filterByPlate(
-                        conn, batch_sids.values(), limit_plates)
-                    )
-
-                imChMap = filterImageUserChannels(
-                    conn, filter1ids, uids=limit_users,
-                    chnames=limit_channelnames)
-
-                # Now discard superids where C does not correspond to a required
-                # channel name
-                batch_filtered_sids = {}
-                for sid in batch_sids:
-                    iid, p, c, z, t = split_sid(sid)
-                    if (iid in imChMap and
-                        imChMap[iid][int(c)] in limit_channelnames):
-                        batch_filtered_sids[sid] = iid
+    cursor, message = parseSearchRequest(conn, request.POST)
+    if message:
+        context = {'template':
+                       'searcher/contentsearch/search_error.html'}
+        context['message'] = message
+        return context
 
-            else:
-                batch_filtered_sids = batch_sids
+    context = runSearch(conn, cursor)
+    saveSearch(request, context, cursor)
+    return context
 
-            if batch_filtered_sids:
-                batch_ims = conn.getObjects(
-                    'Image', batch_filtered_sids.values())
-            else:
-                batch_ims = []
-            iid_ims_map = dict((im.getId(), im) for im in batch_ims)
 
-            logger.debug('image_batch_load filter: %d -> %d -> %d -> %d) ',
-                         len(batch_sids),
-                         len(filter1ids) if enable_filters else -1,
-                         len(imChMap) if enable_filters else -1,
-                         len(iid_ims_map))
+@login_required(setGroupContext=True)
+@render_response()
+def contentsearchstart(request, conn=None, **kwargs):
+    """
+    Start a search in the background, the request is the same as for
+    contentsearch
+    Returns JSON containing the job id, use contentsearchstatus to check
+    whether it has finished and contentsearchresult to get the results
+    """
+    logger.debug('contentsearchstart POST:%s', request.POST)
+
+    cursor, message = parseSearchRequest(conn, request.POST)
+    if message is None:
+        # The request's connection may be closed before the search runs, so
+        # the job joins the session with its own connection
+        props = conn.c.getPropertyMap()
+        sessionKey = conn.c.getSessionId()
+        gid = conn.SERVICE_OPTS.getOmeroGroup()
+
+        def search(progress):
+            client = omero.client(pmap=props)
+            try:
+                client.joinSession(sessionKey)
+                jobConn = omero.gateway.BlitzGateway(client_obj=client)
+                if gid is not None:
+                    jobConn.SERVICE_OPTS.setOmeroGroup(gid)
+                context = runSearch(jobConn, cursor, progress)
+            finally:
+                # Only detaches from the session, which is still used by
+                # OMERO.web
+                client.closeSession()
+            return context, cursor
+
+        job = searchjobs.submit(conn.getUserId(), search)
+        if job is None:
+            message = ('Too many searches are running, please try again '
+                       'later.')
+    if message:
+        data = {'status': 'failed', 'progress': message}
+    else:
+        data = {'jobid': job.id, 'status': job.status,
+                'progress': job.progress}
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
-            img_map.update((sid, iid_ims_map[iid])
-                           for sid, iid in batch_filtered_sids.iteritems())
 
-            if len(img_map) >= numret:
-                break
+@login_required(setGroupContext=True)
+@render_response()
+def contentsearchstatus(request, jobid, conn=None, **kwargs):
+    """
+    Get the status of a background search as JSON
+    """
+    job = searchjobs.get(conn.getUserId(), jobid)
+    if job is None:
+        data = {'status': 'failed', 'progress': 'Search not found'}
+    else:
+        data = {'jobid': job.id, 'status': job.status,
+                'progress': job.progress}
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
-            i += batch_size
 
-        return img_map
+@login_required(setGroupContext=True)
+@render_response()
+def contentsearchresult(request, jobid, conn=None, **kwargs):
+    """
+    Get the results of a finished background search, these are the same as
+    the results from contentsearch
+    """
+    job = searchjobs.get(conn.getUserId(), jobid)
+    result = None
+    if job is not None and job.status == 'done':
+        result = job.result()
+    if result is None:
+        context = {'template':
+                       'searcher/contentsearch/search_error.html'}
+        if job is None or job.status == 'done':
+            context['message'] = 'Search not found, please search again.'
+        elif job.status == 'failed':
+            context['message'] = job.progress
+        else:
+            context['message'] = 'Search has not finished.'
+        return context
 
+    context, cursor = result
+    saveSearch(request, context, cursor)
+    return context
 
-    img_map = image_batch_load(conn, im_ids_sorted, numret)
-    logger.debug('img_map: [%d] %s', len(img_map), img_map)
 
-    images = []
-    ranki = 0
-    for sid in im_ids_sorted:
-        iid = int(sid.split(".")[0])
-        if sid in img_map:
-            img = img_map[sid]
-            # id.px.c.z.t
-            czt = sid.split(".", 2)[2]
-            ranki += 1
-            images.append({
-                    'name':img.getName(),
-                    'id': iid,
-                    'getPermsCss': img.getPermsCss(),
-                    'ranki': ranki,
-                    'superid': sid,
-                    'czt': czt,
-                    'score': im_scores[sid],
-                    })
-        if ranki == numret:
-            break
+@login_required(setGroupContext=True)
+@render_response()
+def contentsearchmore(request, conn=None, **kwargs):
+    """
+    Get the next page of results for the last search. The ranking is reused
+    so this only needs to load the additional images. This must be a POST
+    since it advances the search saved in the session.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    startTime = datetime.now()
+    context = {'template': 'searcher/contentsearch/searchresult_rows.html'}
 
-    if len(images) == 0:
-        context = {'template':
-                       'searcher/contentsearch/search_error.html'}
+    cursor = request.session.get('OMEROsearcher:SearchCursor')
+    if not cursor:
+        context['message'] = 'No search found, please search again.'
+        return context
+
+    db, s = contentdb.load(conn, cursor['ftset'])
+    if (s != 'Good' or not db.version or
+        list(db.version) != cursor['version']):
         context['message'] = (
-            'No results found. Please try widening your search parameters, '
-            'or calculating features for more images.')
+            'The ContentDB has changed since this search was run, please '
+            'search again.')
+        return context
+
+    images, message = searchPage(conn, db, cursor)
+    if message:
+        context['message'] = message
         return context
 
     context['images'] = images
-    #logger.debug('context images:%s', images)
+    context['more'] = len(images) == cursor['numret']
 
     endTime = datetime.now()
     dd = endTime - startTime
-    context['performance'] = '%d results returned in %d.%03d seconds' % (
-        len(images), dd.seconds, dd.microseconds / 1000)
+    logger.debug('contentsearchmore: %d results returned in %d.%03d seconds',
+                 len(images), dd.seconds, dd.microseconds / 1000)
 
-    # Save the search results in case we need them for export
-    request.session['OMEROsearcher:LastImageResults'] = context['images']
+    request.session['OMEROsearcher:SearchCursor'] = cursor
+    request.session['OMEROsearcher:LastImageResults'] = (
+        request.session.get('OMEROsearcher:LastImageResults', []) + images)
     return context
 
 
+def parseBatchQuery(query, numret):
+    """
+    Check a query from a searchapi request
+    Returns (scale, refs, numret), raises ValueError if the query is invalid
+    """
+    refs = {}
+    for sid, pn in query['refs'].iteritems():
+        if len(sid.split('.')) != 5 or pn not in (1, -1):
+            raise ValueError('Invalid reference: %s %s' % (sid, pn))
+        # Check the superid is numeric, and ignore the pixels ID
+        iid, px, c, z, t = [long(x) for x in sid.split('.')]
+        refs['%d.0.%d.%d.%d' % (iid, c, z, t)] = pn
+    if not refs:
+        raise ValueError('No references')
+    scale = query.get('scale')
+    if scale is not None:
+        scale = float(scale)
+    return scale, refs, int(query.get('numret', numret))
+
+
+@login_required(setGroupContext=True)
+@render_response()
+def searchapi(request, conn=None, **kwargs):
+    """
+    Run many independent searches in one request
+    The request body is JSON:
+      {"featureset": "slf33", "numret": 10, "filters": {...},
+       "queries": [{"refs": {"superid": 1 or -1, ...}, "scale": 1.0,
+                    "numret": 10}, ...]}
+    numret, filters and each query's scale and numret are optional. filters
+    has the same keys as the search cursor, see parseSearchRequest, keys
+    which are omitted don't restrict the results. Results must be in one of
+    the datasets or plates, if only one of these is given the other is
+    treated as empty. If scale is omitted the largest scale containing a
+    reference is used.
+    Returns JSON with a result for each query:
+      {"results": [{"scale": 1.0, "superids": [...], "scores": [...]}, ...]}
+    scores is null for queries with positive and negative references. A query
+    which couldn't be run has an "error" instead.
+    Results are ranked ContentDB rows, images are not checked for existence.
+    """
+    def respond(data, status=200):
+        return HttpResponse(json.dumps(data), status=status,
+                            content_type='application/json')
+
+    try:
+        # request.body was called raw_post_data before Django 1.4
+        body = json.loads(request.body if hasattr(request, 'body')
+                          else request.raw_post_data)
+        ftset = str(body['featureset'])
+        numret = int(body.get('numret', 10))
+        filters = body.get('filters')
+        if filters:
+            # Omitted keys don't restrict the results
+            filters = dict(
+                (k, sorted(filters[k]) if k in filters else None) for k in (
+                    'channelidxs', 'users', 'datasets', 'plates',
+                    'channelnames'))
+        queries = body['queries']
+        if not isinstance(queries, list):
+            raise ValueError('queries must be a list')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return respond({'error': 'Invalid request: %s' % e}, 400)
+    if ftset not in enabled_featuresets:
+        return respond({'error': 'Unknown featureset: %s' % ftset}, 400)
+    if len(queries) > search_api_max_queries:
+        return respond({'error': 'Too many queries, the limit is %d' %
+                        search_api_max_queries}, 400)
+
+    startTime = datetime.now()
+    results = [None] * len(queries)
+    valid = []
+    for i, q in enumerate(queries):
+        try:
+            valid.append((i, parseBatchQuery(q, numret)))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            results[i] = {'error': 'Invalid query: %s' % e}
+
+    db, s = contentdb.load(conn, ftset)
+    if s != 'Good':
+        return respond({'error': 'The ContentDB for feature-set %s could '
+                        'not be found' % ftset}, 404)
+
+    eligible = filterEligible(imagemeta.getMetadata(conn), filters)
+    maxret = max([n for i, (scale, refs, n) in valid] or [0])
+    ranked = ranking.batchRankingWrapper(
+        db, [(scale, refs) for i, (scale, refs, n) in valid], maxret,
+        eligible)
+    for (i, (scale, refs, n)), (superids, scores, dscale) in zip(
+            valid, ranked):
+        if superids is None:
+            results[i] = {'error': 'No features found for the references'}
+        else:
+            results[i] = {
+                'scale': dscale,
+                'superids': superids[:n],
+                'scores': scores[:n] if scores is not None else None,
+                }
+
+    dd = datetime.now() - startTime
+    logger.debug('searchapi: %d queries in %d.%03d seconds', len(queries),
+                 dd.seconds, dd.microseconds / 1000)
+    return respond({'results': results})
+
+
+def warmupstatus(request, **kwargs):
+    """
+    Report whether this OMERO.web process has finished loading the
+    ContentDBs at startup, see warmup. This doesn't require a login so it can
+    be used by load balancer health checks.
+    Returns JSON from warmup.status() with status 200 when ready or if the
+    warmup is disabled, otherwise 503
+    """
+    data = warmup.status()
+    return HttpResponse(json.dumps(data), status=200 if data['ready'] else 503,
+                        content_type='application/json')
+
+
+class CsvLine(object):
+    """
+    A file-like object which returns whatever is written to it, so a
+    csv.writer returns each formatted line
+    """
+
+    def write(self, value):
+        return value
+
+
+def exportRows(images, parents):
+    """
+    Generate the lines of a CSV file of search results
+    @param parents see getImageParents
+    """
+    def encode(v):
+        if v is None:
+            return ''
+        if isinstance(v, unicode):
+            return v.encode('utf-8')
+        return v
+
+    writer = csv.writer(CsvLine())
+    yield writer.writerow([
+            'ImageID', 'ImageSID', 'Rank', 'CZT', 'Name', 'Score',
+            'ParentID', 'ParentType', 'ParentName'])
+    for im in images:
+        parent = parents.get(im['id'], (None, None, None))
+        yield writer.writerow([encode(v) for v in (
+                    im['id'], im['superid'], im['ranki'], im['czt'],
+                    im['name'], im['score']) + parent])
+
+
 @login_required(setGroupContext=True)
 @render_response()
 def exportsearch(request, conn=None, **kwargs):
@@ -852,50 +1102,29 @@ def exportsearch(request, conn=None, **kwargs):
         # TODO: Handle this with a proper error message
         raise Exception('Last search results are empty.')
 
-    imwraps = conn.getObjects('Image', (im['id'] for im in images))
-    img_map = dict((imwrap.id, imwrap) for imwrap in imwraps)
+    parents = getImageParents(conn, [im['id'] for im in images])
+    logger.debug('Exporting %d search results', len(images))
 
-    for im in images:
-        # Get the name of the first parent
-        im['parentid'] = None
-        im['parenttype'] = None
-        im['parentname'] = None
-        parents = img_map[im['id']].listParents()
-        if parents:
-            p = parents[0]
-            if p.OMERO_CLASS == 'WellSample':
-                # WellSample > Well > Plate
-                p = p.getParent().getParent()
-            im['parentid'] = p.id
-            im['parenttype'] = p.OMERO_CLASS
-            im['parentname'] = p.name
-
-    response = HttpResponse(content_type='text/csv')
+    response = StreamingHttpResponse(exportRows(images, parents),
+                                     content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="searchresults.csv"'
-
-    t = loader.get_template('searcher/contentsearch/searchresult.csv')
-    c = Context({
-            'images': images,
-    })
-
-    logger.debug('Exporting search results: %s', images)
-    response.write(t.render(c))
     return response
 
 
 @login_required(setGroupContext=True)
 @render_response()
 def exportcontentdb(request, conn=None, **kwargs):
+    """
+    Download the ContentDB for a feature set
+    If export_format is 'npz' the ContentDB is exported as an NPZ archive
+    (see contentdb.iterNpz), optionally restricted to the scales, owner
+    IDs and dataset IDs given by the export_scales, export_owners and
+    export_datasets parameters. Otherwise the pickled ContentDB is sent.
+    """
     logger.debug('exportcontentdb POST:%s', request.POST)
     ftset = request.POST.get('featureset_Name')
 
-    # Two separate calls, one to get the filename and one to get the contents
-    # TODO: Maybe modify pyslid to return a file handle instead of re-pickling
-    dbname, dbname_next, result = pyslid.database.direct.getRecentName(
-        conn, ftset)
-    cdb, s = pyslid.database.direct.retrieve(conn, ftset)
-
-    if s != 'Good':
+    def notFound():
         context = {'template':
                        'searcher/contentsearch/search_error.html'}
         context['message'] = (
@@ -903,11 +1132,73 @@ def exportcontentdb(request, conn=None, **kwargs):
             'Have you calculated any features?') % ftset
         return context
 
+    if request.POST.get('export_format') == 'npz':
+        return exportContentDBNpz(request, conn, ftset) or notFound()
+
+    # The ContentDB cache only holds the columnar form, so send the pickled
+    # ContentDB file as it is instead of loading and re-pickling it, unless
+    # rows in the journal have to be merged in
+    dbname, dbname_next, result = pyslid.database.direct.getRecentName(
+        conn, ftset)
+    try:
+        dbfile = open(os.path.join(omero_contentdb_path, dbname), 'rb')
+    except (TypeError, IOError):
+        return notFound()
+
+    rows = journal.readRows(journal.journalDir(conn, ftset))
+    if rows:
+        cdb = cPickle.load(dbfile)
+        dbfile.close()
+        journal.mergeRows(cdb, rows)
+        del rows
+        dbfile = tempfile.TemporaryFile()
+        cPickle.dump(cdb, dbfile, cPickle.HIGHEST_PROTOCOL)
+        del cdb
+        dbfile.seek(0)
+
     logger.debug('Exporting contentdb: %s', dbname)
 
-    response = HttpResponse(content_type='application/python-pickle')
+    response = StreamingHttpResponse(
+        FileWrapper(dbfile), content_type='application/python-pickle')
     response['Content-Disposition'] = 'attachment; filename="%s"' % dbname
-    pickle.dump(cdb, response)
+    response['Content-Length'] = os.fstat(dbfile.fileno()).st_size
+    return response
+
+
+def exportContentDBNpz(request, conn, ftset):
+    """
+    Export a subset of a ContentDB as NPZ, see exportcontentdb
+    Returns None if the ContentDB could not be found
+    """
+    db, s = contentdb.load(conn, ftset)
+    if s != 'Good':
+        return None
+
+    scales = set(db.closestScale(float(x))
+                 for x in request.POST.getlist('export_scales') if x)
+    owners = [int(x) for x in request.POST.getlist('export_owners') if x]
+    datasets = [int(x) for x in request.POST.getlist('export_datasets') if x]
+    iids = None
+    if datasets:
+        iids = imagemeta.getMetadata(conn).keys('dataset', datasets)
+
+    def selected(cdbscale):
+        if scales and cdbscale.scale not in scales:
+            return None
+        mask = numpy.ones(len(cdbscale), dtype=bool)
+        if owners:
+            mask &= numpy.in1d(cdbscale.owner, owners)
+        if iids is not None:
+            mask &= numpy.in1d(cdbscale.iid, iids)
+        return numpy.flatnonzero(mask)
+
+    logger.debug('Exporting contentdb %s as NPZ scales:%s owners:%s '
+                 'datasets:%s', ftset, sorted(scales), owners, datasets)
+    # The archive is sent as it's generated, so its size isn't known
+    response = StreamingHttpResponse(contentdb.iterNpz(db, selected),
+                                     content_type='application/octet-stream')
+    response['Content-Disposition'] = (
+        'attachment; filename="contentdb_%s.npz"' % ftset)
     return response
 
 
@@ -969,8 +1260,6 @@ def featureCalculationConfig( request, object_type = None, object_ID = None, con
 #import pyslid.utilities
 #import pyslid.database.direct
 
-import numpy
-
 @login_required()
 def featureCalculation( request, object_type = None, object_ID = None, featureset = None, contentDB_config = None, conn=None, **kwargs):
 
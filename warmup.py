@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Use is subject to license terms supplied in LICENSE.txt
+#
+"""
+Warm up the ContentDB cache when OMERO.web starts
+
+If contentdb_warmup is enabled each OMERO.web process loads the ContentDBs of
+all enabled_featuresets into its cache in a background thread when it starts,
+and builds the row indices and norms used by searches, so the first search
+doesn't pay for this. There is no OMERO session at startup, so the ContentDB
+of each group is found by listing omero_contentdb_path (see
+contentdb.localContentDBs). If a search finds a different ContentDB it's
+loaded as usual.
+
+status() reports the progress for the warmup status view.
+"""
+
+import logging
+import threading
+import time
+
+from omero_searcher_config import enabled_featuresets
+from omero_searcher_config import contentdb_warmup
+
+import contentdb
+import ranking
+
+logger = logging.getLogger('searcher')
+
+
+class Warmup(object):
+    """
+    Loads ContentDBs in a background thread, started at most once
+    state is one of 'disabled', 'pending', 'running', 'ready' or 'failed'
+    featuresets is a dictionary of (feature-set, group-id): message
+    """
+
+    def __init__(self, enabled):
+        self.state = 'pending' if enabled else 'disabled'
+        self.featuresets = {}
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.state != 'pending' or self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name='contentdb-warmup')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        self.state = 'running'
+        self.started = time.time()
+        try:
+            for ftset in enabled_featuresets:
+                for gid, dbname in sorted(
+                    contentdb.localContentDBs(ftset).iteritems()):
+                    self.featuresets[(ftset, gid)] = 'Loading %s' % dbname
+                    self.featuresets[(ftset, gid)] = warmContentDB(
+                        gid, ftset, dbname)
+            self.state = 'ready'
+        except Exception:
+            logger.error('ContentDB warmup failed', exc_info=True)
+            self.state = 'failed'
+        self.finished = time.time()
+        logger.info('ContentDB warmup %s in %.1fs', self.state,
+                    self.finished - self.started)
+
+    def status(self):
+        """
+        A JSON serialisable summary of the progress
+        """
+        return {
+            'state': self.state,
+            'ready': self.state in ('disabled', 'ready'),
+            'started': self.started,
+            'finished': self.finished,
+            'featuresets': [
+                {'featureset': ftset, 'group': gid, 'message': m}
+                for (ftset, gid), m in sorted(self.featuresets.items())],
+            }
+
+
+def warmContentDB(gid, ftset, dbname):
+    """
+    Load one ContentDB and precalculate everything searches use
+    @return a message describing the result
+    """
+    t0 = time.time()
+    db, message = contentdb.preload(gid, ftset, dbname)
+    if db is None:
+        logger.warn('Failed to warm up ContentDB %s: %s', dbname, message)
+        return message
+    for s in db.scales.itervalues():
+        s.getRowIndex()
+        if s.zfeats is not None:
+            s.rowNorms()
+    m = 'Loaded %s, %d rows in %.1fs' % (
+        dbname, sum(len(s) for s in db.scales.itervalues()), time.time() - t0)
+    logger.info('ContentDB warmup: %s', m)
+    return m
+
+
+_warmup = Warmup(contentdb_warmup)
+
+
+def start():
+    """
+    Start the shard scoring processes (see ranking.startShardPool), and the
+    warmup if it's enabled and hasn't already been started. The processes
+    are forked first, before the warmup thread exists.
+    """
+    ranking.startShardPool()
+    _warmup.start()
+
+
+def status():
+    return _warmup.status()